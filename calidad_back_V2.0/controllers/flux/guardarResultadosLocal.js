@@ -220,7 +220,9 @@ async function guardarResultadosLocal(fechaInicio, fechaFin, baseDatos, indices,
     
     return {
       id_transaccion: idTransaccion,
-      insertedCount: result.insertedCount
+      insertedCount: result.insertedCount,
+      // Lo mismo que queda en Mongo: el servicio Python genera el informe sin releerlo
+      documentos: documentosResultados
     };
   } catch (err) {
     console.error('❌ Error al insertar resultados en MongoDB:', err.message);
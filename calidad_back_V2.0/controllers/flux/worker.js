@@ -66,6 +66,7 @@ if (require.main === module) {
 
       // 💾 Guardar en Mongo
       let transaccionId = null;
+      let documentosGuardados = null;
       try {
         console.log('💾 Intentando guardar en MongoDB...');
         console.log(`   - URI: ${process.env.MONGODB_URI ? 'Definida' : 'NO DEFINIDA'}`);
@@ -79,8 +80,10 @@ if (require.main === module) {
           indices,
           resultados
         );
-        console.log('✅ Resultados guardados en DB local:', JSON.stringify(resumenGuardado, null, 2));
+        const { documentos, ...resumenLog } = resumenGuardado;
+        console.log('✅ Resultados guardados en DB local:', JSON.stringify(resumenLog, null, 2));
         transaccionId = resumenGuardado.id_transaccion;
+        documentosGuardados = resumenGuardado.documentos || null;
 
       } catch (err) {
         console.error('⛔ CRÍTICO: Error al guardar en DB local (Mongo):', err);
@@ -109,14 +112,23 @@ if (require.main === module) {
           console.log(`   🔸 URL Configurada: ${pythonServiceUrl}`);
           console.log(`   🔸 Transacción ID: ${transaccionId}`);
           
-          console.log(`🐍 Enviando POST a: ${pythonServiceUrl}/informe?id_transaccion=${transaccionId}`);
+          // Con los resultados recién guardados se envían en el cuerpo (/informe/datos)
+          // y Python no tiene que releerlos de Mongo; si no, /informe los lee
+          const endpointInforme = documentosGuardados ? 'informe/datos' : 'informe';
+          const cuerpoInforme = documentosGuardados
+            ? { id_transaccion: transaccionId, resultados: documentosGuardados }
+            : {};
+          console.log(`🐍 Enviando POST a: ${pythonServiceUrl}/${endpointInforme}?id_transaccion=${transaccionId}`);
           
           const response = await axios.post(
-            `${pythonServiceUrl}/informe?id_transaccion=${transaccionId}`, 
-            {}, 
+            `${pythonServiceUrl}/${endpointInforme}?id_transaccion=${transaccionId}`, 
+            cuerpoInforme, 
             { 
+              maxBodyLength: Infinity,
               responseType: 'stream',
-              timeout: 120000 // Aumentamos timeout a 2 minutos para generación de PDF
+              // Al menos el plazo del servicio (RENDER_PLAZO_SEGUNDOS, 150 s por defecto) más
+              // un margen: antes de cortar hay que dejar que Python responda 504 o el PDF
+              timeout: Number(process.env.PYTHON_INFORME_TIMEOUT_MS || 180000)
             }
           );
 
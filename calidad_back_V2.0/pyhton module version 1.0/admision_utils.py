@@ -0,0 +1,192 @@
+"""
+Control de admisión de renders de informes: límite de renders simultáneos y
+presupuesto de memoria, cola acotada con prioridad (interactiva > lote >
+pregeneración) y rechazo con Retry-After cuando la cola está llena, para que
+una ráfaga de peticiones no dispare la memoria del contenedor
+"""
+
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cancelacion_utils import Cancelacion, RenderCancelado
+
+
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_LOTE = 1
+PRIORIDAD_PREGENERACION = 2
+PRIORIDADES = {"interactiva": PRIORIDAD_INTERACTIVA, "lote": PRIORIDAD_LOTE, "pregeneracion": PRIORIDAD_PREGENERACION}
+
+RENDER_CONCURRENCIA = max(1, int(os.getenv("RENDER_CONCURRENCIA", "2")))
+RENDER_MEMORIA_MB = float(os.getenv("RENDER_MEMORIA_MB", "1024"))
+RENDER_COLA_MAX = int(os.getenv("RENDER_COLA_MAX", "8"))
+RENDER_ESPERA_MAX = float(os.getenv("RENDER_ESPERA_MAX_SEGUNDOS", "120"))
+
+# Pico de memoria medido con benchmark_informe: ~80 MB + ~0,22 MB por
+# documento de resultados (60 docs: 94 MB, 300: 173 MB, 1200: 349 MB)
+MB_BASE_RENDER = float(os.getenv("RENDER_MB_BASE", "80"))
+MB_POR_DOCUMENTO = float(os.getenv("RENDER_MB_POR_DOC", "0.25"))
+
+_MUESTRAS = 200  # ventana de tiempos para las métricas
+_SONDEO_CANCELACION = 1.0  # segundos entre comprobaciones de la cancelación mientras espera
+
+
+def estimar_memoria_mb(num_docs: int) -> float:
+    """Pico de memoria estimado de un informe con `num_docs` resultados."""
+    return MB_BASE_RENDER + MB_POR_DOCUMENTO * max(0, num_docs)
+
+
+class ColaLlena(Exception):
+    """No se admite el render: cola llena o espera máxima agotada (-> 429)."""
+
+    def __init__(self, motivo: str, retry_after: int):
+        super().__init__(motivo)
+        self.retry_after = retry_after
+
+
+class ControlAdmision:
+    """
+    Semáforo con prioridad, presupuesto de memoria y cola acotada
+
+    Un render entra cuando es el primero de la cola (menor prioridad y, a
+    igualdad, el más antiguo), hay hueco de concurrencia y su coste cabe en
+    la memoria libre; con nada en curso se admite siempre, aunque supere el
+    presupuesto, para no bloquear informes grandes.
+    """
+
+    def __init__(self, limite: int = RENDER_CONCURRENCIA, memoria_mb: float = RENDER_MEMORIA_MB,
+                 cola_max: int = RENDER_COLA_MAX, espera_max: float = RENDER_ESPERA_MAX):
+        self.limite = limite
+        self.memoria_mb = memoria_mb
+        self.cola_max = cola_max
+        self.espera_max = espera_max
+        self._cond = threading.Condition()
+        self._cola: List[Tuple[int, int]] = []  # heap de (prioridad, orden)
+        self._orden = itertools.count()
+        self._activos = {p: 0 for p in PRIORIDADES.values()}
+        self._memoria_en_uso = 0.0
+        self._esperas: deque = deque(maxlen=_MUESTRAS)
+        self._duraciones: deque = deque(maxlen=_MUESTRAS)
+        self._contadores = {"admitidos": 0, "rechazados": 0, "caducados": 0, "cancelados": 0, "cola_maxima": 0}
+
+    # ---------- Estado interno (con _cond adquirido) ----------
+    def _en_curso(self) -> int:
+        return sum(self._activos.values())
+
+    def _cabe(self, ticket: Tuple[int, int], coste_mb: float) -> bool:
+        if not self._cola or self._cola[0] != ticket or self._en_curso() >= self.limite:
+            return False
+        return self._en_curso() == 0 or self._memoria_en_uso + coste_mb <= self.memoria_mb
+
+    def _retry_after(self) -> int:
+        """Segundos estimados hasta que haya hueco: duración media x turnos por delante."""
+        duracion = sum(self._duraciones) / len(self._duraciones) if self._duraciones else 10.0
+        return max(1, math.ceil(duracion * (len(self._cola) + 1) / self.limite))
+
+    def _comprobar_sin_lock(self, cancelacion: Cancelacion) -> None:
+        """
+        cancelacion.comprobar("cola") soltando _cond: con HTTP la desconexión
+        se consulta en el bucle de eventos y no debe bloquear a los demás hilos.
+        """
+        self._cond.release()
+        try:
+            cancelacion.comprobar("cola")
+        finally:
+            self._cond.acquire()
+
+    # ---------- API ----------
+    @contextmanager
+    def admitir(self, prioridad: int = PRIORIDAD_INTERACTIVA, coste_mb: float = MB_BASE_RENDER,
+                rechazable: bool = True, cancelacion: Optional[Cancelacion] = None) -> Iterator[None]:
+        """
+        Espera turno y ejecuta el bloque como render admitido.
+
+        Args:
+            rechazable: False para trabajo de fondo, que espera sin límite de
+                cola ni de tiempo (su propio hilo es quien espera)
+            cancelacion: Plazo / desconexión de la petición: se comprueba
+                también mientras espera turno (sale de la cola sin renderizar)
+
+        Raises:
+            ColaLlena: Si la cola está llena o se agota RENDER_ESPERA_MAX
+            cancelacion_utils.RenderCancelado: Si se cancela durante la espera
+        """
+        t0 = time.monotonic()
+        with self._cond:
+            if rechazable and len(self._cola) >= self.cola_max:
+                self._contadores["rechazados"] += 1
+                raise ColaLlena(f"Cola de informes llena ({len(self._cola)} en espera)", self._retry_after())
+            ticket = (prioridad, next(self._orden))
+            heapq.heappush(self._cola, ticket)
+            self._contadores["cola_maxima"] = max(self._contadores["cola_maxima"], len(self._cola))
+            try:
+                while not self._cabe(ticket, coste_mb):
+                    restante = t0 + self.espera_max - time.monotonic() if rechazable else None
+                    if restante is not None and restante <= 0:
+                        self._contadores["caducados"] += 1
+                        raise ColaLlena(f"Sin hueco para el informe tras {self.espera_max:.0f}s", self._retry_after())
+                    if cancelacion is not None:
+                        self._comprobar_sin_lock(cancelacion)
+                        # Mientras se soltaba el lock ha podido quedar hueco (y su notify, perderse)
+                        if self._cabe(ticket, coste_mb):
+                            break
+                        restante = min(restante or _SONDEO_CANCELACION, _SONDEO_CANCELACION)
+                    self._cond.wait(restante)
+            except BaseException as e:
+                if isinstance(e, RenderCancelado):
+                    self._contadores["cancelados"] += 1
+                self._cola.remove(ticket)
+                heapq.heapify(self._cola)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._cola)
+            self._activos[prioridad] += 1
+            self._memoria_en_uso += coste_mb
+            self._contadores["admitidos"] += 1
+            self._esperas.append(time.monotonic() - t0)
+            # El siguiente de la cola puede caber también (hay más de un hueco)
+            self._cond.notify_all()
+
+        t_inicio = time.monotonic()
+        try:
+            yield
+        except RenderCancelado:
+            with self._cond:
+                self._contadores["cancelados"] += 1
+            raise
+        finally:
+            with self._cond:
+                self._activos[prioridad] -= 1
+                self._memoria_en_uso -= coste_mb
+                self._duraciones.append(time.monotonic() - t_inicio)
+                self._cond.notify_all()
+
+    def activos(self, prioridad: int) -> int:
+        return self._activos[prioridad]
+
+    def estado(self) -> Dict[str, Any]:
+        """Profundidad de cola, renders en curso y tiempos de espera / render."""
+        with self._cond:
+            esperas = sorted(self._esperas)
+            duraciones = list(self._duraciones)
+            nombres = {v: k for k, v in PRIORIDADES.items()}
+            return {
+                "limite": self.limite,
+                "memoria_mb": self.memoria_mb,
+                "memoria_en_uso_mb": round(self._memoria_en_uso, 1),
+                "cola_max": self.cola_max,
+                "en_cola": len(self._cola),
+                "en_cola_por_prioridad": {nombres[p]: sum(1 for q, _ in self._cola if q == p) for p in nombres},
+                "en_curso": {nombres[p]: n for p, n in self._activos.items()},
+                **self._contadores,
+                "espera_media_s": round(sum(esperas) / len(esperas), 3) if esperas else None,
+                "espera_p95_s": round(esperas[min(len(esperas) - 1, int(0.95 * len(esperas)))], 3) if esperas else None,
+                "render_medio_s": round(sum(duraciones) / len(duraciones), 3) if duraciones else None,
+                "retry_after_s": self._retry_after(),
+            }
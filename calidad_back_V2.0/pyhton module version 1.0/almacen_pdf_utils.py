@@ -0,0 +1,292 @@
+"""
+Almacenamiento de informes PDF en GridFS: el PDF se guarda linealizado
+("vista web rápida") en trozos y se lee por rangos sin materializar una
+copia completa en memoria. Incluye el ciclo de vida de la caché: uso por
+entrada, caducidad (TTL), presupuesto de tamaño con expulsión LRU/LFU y
+retirada de informes de versiones de plantilla anteriores
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional
+
+from bson.binary import Binary
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+from pymongo.errors import OperationFailure
+
+
+COLECCION_INFORMES = "informes_pdf"
+BUCKET_PDF = "informes_pdf_fs"
+TAM_TROZO = 255 * 1024  # tamaño de trozo por defecto de GridFS
+TAM_BLOQUE_ENVIO = 256 * 1024
+
+# Ciclo de vida de la caché (configurable por entorno)
+TTL_DIAS = float(os.getenv("INFORMES_TTL_DIAS", "30"))
+PRESUPUESTO_BYTES = int(float(os.getenv("INFORMES_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+POLITICA = os.getenv("INFORMES_POLITICA", "lru").lower()  # lru | lfu
+INTERVALO_EVICCION = float(os.getenv("INFORMES_EVICCION_SEGUNDOS", "600"))
+# Un fichero sin entrada solo se borra pasado este tiempo desde que se subió o se retiró:
+# cubre la subida previa al upsert de su entrada y las lecturas por rangos en curso
+GRACIA_HUERFANOS = float(os.getenv("INFORMES_GRACIA_HUERFANOS_SEGUNDOS", "900"))
+
+_INDICE_CONFLICTO = 85  # IndexOptionsConflict: mismo índice con otras opciones
+
+ORDEN_POLITICA = {
+    "lru": [("ultimo_acceso", 1)],
+    "lfu": [("lecturas", 1), ("ultimo_acceso", 1)],
+}
+
+
+def linealizar_pdf(pdf_bytes: bytes) -> bytes:
+    """
+    PDF linealizado (primera página al principio y tabla de sugerencias) para
+    que los visores lo muestren antes de terminar la descarga. Requiere
+    pikepdf; sin él se devuelve el PDF tal cual.
+    """
+    try:
+        import pikepdf
+    except ImportError:
+        return pdf_bytes
+
+    try:
+        out = BytesIO()
+        with pikepdf.open(BytesIO(pdf_bytes)) as pdf:
+            # Los streams ya vienen comprimidos de ReportLab: solo se reordena
+            pdf.save(out, linearize=True, compress_streams=False)
+        return out.getvalue()
+    except Exception as e:
+        print(f"⚠️ No se pudo linealizar el PDF: {e}")
+        return pdf_bytes
+
+
+def es_linealizado(cabecera: bytes) -> bool:
+    """True si los primeros bytes del PDF contienen el diccionario de linealización."""
+    return b"/Linearized" in cabecera[:1024]
+
+
+def bucket(db) -> GridFSBucket:
+    return GridFSBucket(db, bucket_name=BUCKET_PDF, chunk_size_bytes=TAM_TROZO)
+
+
+def subir_pdf(db, nombre: str, pdf_bytes: bytes, metadatos: Dict[str, Any]) -> Any:
+    """Sube el PDF a GridFS y devuelve el id del fichero."""
+    return bucket(db).upload_from_stream(nombre, pdf_bytes, metadata=metadatos)
+
+
+def borrar_pdf(db, archivo_id: Any) -> None:
+    try:
+        bucket(db).delete(archivo_id)
+    except NoFile:
+        pass
+
+
+def retirar_pdf(db, archivo_id: Any) -> None:
+    """
+    Marca el fichero como retirado (sustituido o expulsado) sin borrarlo: lo
+    recoge el evictor como huérfano pasado GRACIA_HUERFANOS, de modo que las
+    descargas por rangos que ya lo tenían abierto pueden terminar.
+    """
+    db[f"{BUCKET_PDF}.files"].update_one({"_id": archivo_id}, {"$set": {"retirado_en": datetime.now(timezone.utc)}})
+
+
+def abrir_pdf(db, doc: Dict[str, Any]) -> Optional[BinaryIO]:
+    """
+    Fichero de solo lectura con seek() del informe guardado: GridOut (lee los
+    trozos bajo demanda) o, en documentos antiguos con el PDF embebido, una
+    vista sobre el Binary sin copiarlo.
+    """
+    if doc.get("archivo_id") is not None:
+        try:
+            return bucket(db).open_download_stream(doc["archivo_id"])
+        except NoFile:
+            return None
+    pdf = doc.get("pdf")
+    if isinstance(pdf, (Binary, bytes, bytearray)):
+        return BytesIO(pdf)
+    return None
+
+
+def iter_rango(fuente: BinaryIO, inicio: int, fin: int, bloque: int = TAM_BLOQUE_ENVIO) -> Iterator[bytes]:
+    """Bytes [inicio, fin] (ambos incluidos) de la fuente en bloques de `bloque`."""
+    try:
+        fuente.seek(inicio)
+        restante = fin - inicio + 1
+        while restante > 0:
+            datos = fuente.read(min(bloque, restante))
+            if not datos:
+                break
+            restante -= len(datos)
+            yield datos
+    finally:
+        fuente.close()
+
+
+# =========================
+# CICLO DE VIDA DE LA CACHÉ
+# =========================
+def asegurar_indices_informes(db) -> None:
+    """
+    Clave del informe, orden de expulsión y TTL sobre el último acceso
+    (MongoDB borra solo los documentos; el evictor recoge sus ficheros).
+    """
+    col = db[COLECCION_INFORMES]
+    col.create_index([("id_transaccion", 1), ("ponderado", 1), ("plantilla", 1)])
+    col.create_index([("lecturas", 1), ("ultimo_acceso", 1)])
+    if TTL_DIAS > 0:
+        ttl = int(TTL_DIAS * 86400)
+        try:
+            col.create_index("ultimo_acceso", expireAfterSeconds=ttl)
+        except OperationFailure as e:
+            if e.code != _INDICE_CONFLICTO:
+                raise
+            # INFORMES_TTL_DIAS ha cambiado: se ajusta el índice existente sin recrearlo
+            db.command("collMod", COLECCION_INFORMES,
+                       index={"keyPattern": {"ultimo_acceso": 1}, "expireAfterSeconds": ttl})
+            print(f"🔧 TTL de {COLECCION_INFORMES} ajustado a {TTL_DIAS:g} días")
+
+
+def registrar_acceso(db, filtro: Dict[str, Any], contar: bool = True) -> None:
+    """Último acceso (LRU/TTL) y contador de lecturas (LFU) de una entrada."""
+    cambios: Dict[str, Any] = {"$set": {"ultimo_acceso": datetime.now(timezone.utc)}}
+    if contar:
+        cambios["$inc"] = {"lecturas": 1}
+    db[COLECCION_INFORMES].update_one(filtro, cambios)
+
+
+def _borrar_entradas(db, docs: List[Dict[str, Any]]) -> Dict[str, int]:
+    col = db[COLECCION_INFORMES]
+    borrados = {"entradas": 0, "bytes": 0}
+    for doc in docs:
+        col.delete_one({"_id": doc["_id"]})
+        if doc.get("archivo_id") is not None:
+            retirar_pdf(db, doc["archivo_id"])
+        borrados["entradas"] += 1
+        borrados["bytes"] += int(doc.get("tamano") or 0)
+    return borrados
+
+
+def _borrar_huerfanos(db, gracia_segundos: float = GRACIA_HUERFANOS) -> int:
+    """
+    Ficheros GridFS sin entrada (caducada por TTL, retirados o de una
+    escritura interrumpida) subidos y retirados hace más de gracia_segundos.
+    """
+    limite = datetime.now(timezone.utc) - timedelta(seconds=gracia_segundos)
+    referenciados = set(db[COLECCION_INFORMES].distinct("archivo_id"))
+    candidatos = db[f"{BUCKET_PDF}.files"].find(
+        {"uploadDate": {"$lt": limite},
+         "$or": [{"retirado_en": {"$exists": False}}, {"retirado_en": {"$lt": limite}}]},
+        {"_id": 1},
+    )
+    huerfanos = [f["_id"] for f in candidatos if f["_id"] not in referenciados]
+    for archivo_id in huerfanos:
+        borrar_pdf(db, archivo_id)
+    return len(huerfanos)
+
+
+def evictar(db, versiones: Dict[str, str], presupuesto_bytes: int = PRESUPUESTO_BYTES,
+            politica: str = POLITICA) -> Dict[str, Any]:
+    """
+    Una pasada del evictor: retira informes de versiones de plantilla
+    anteriores (o de plantillas que ya no existen), ficheros huérfanos y,
+    si la caché supera el presupuesto, las entradas menos usadas (LRU) o
+    menos leídas (LFU) hasta quedar por debajo.
+
+    Args:
+        versiones: Versión vigente por plantilla ({nombre: version})
+    """
+    t0 = time.perf_counter()
+    col = db[COLECCION_INFORMES]
+    proy = {"_id": 1, "archivo_id": 1, "tamano": 1}
+
+    obsoletos = list(col.find({"$nor": [{"plantilla": p, "version_plantilla": v} for p, v in versiones.items()]}, proy))
+    resultado = {"obsoletas": _borrar_entradas(db, obsoletos)["entradas"], "huerfanos": _borrar_huerfanos(db)}
+
+    total = ocupacion_bytes(db)
+    expulsados: List[Dict[str, Any]] = []
+    if total > presupuesto_bytes:
+        exceso = total - presupuesto_bytes
+        for doc in col.find({}, proy).sort(ORDEN_POLITICA.get(politica, ORDEN_POLITICA["lru"])):
+            if exceso <= 0:
+                break
+            expulsados.append(doc)
+            exceso -= int(doc.get("tamano") or 0)
+    borrados = _borrar_entradas(db, expulsados)
+    resultado.update({
+        "expulsadas": borrados["entradas"],
+        "bytes_liberados": borrados["bytes"],
+        "bytes": ocupacion_bytes(db),
+        "segundos": round(time.perf_counter() - t0, 3),
+    })
+    return resultado
+
+
+def ocupacion_bytes(db) -> int:
+    fila = next(db[COLECCION_INFORMES].aggregate([{"$group": {"_id": None, "bytes": {"$sum": "$tamano"}}}]), None)
+    return int(fila["bytes"]) if fila else 0
+
+
+def ocupacion(db, versiones: Dict[str, str], top: int = 10) -> Dict[str, Any]:
+    """Resumen de la caché para administración (no lee ningún PDF)."""
+    col = db[COLECCION_INFORMES]
+    por_plantilla = {
+        f["_id"]: {"entradas": f["entradas"], "bytes": f["bytes"], "lecturas": f["lecturas"]}
+        for f in col.aggregate([{"$group": {
+            "_id": "$plantilla",
+            "entradas": {"$sum": 1},
+            "bytes": {"$sum": "$tamano"},
+            "lecturas": {"$sum": "$lecturas"},
+        }}])
+    }
+    total = sum(v["bytes"] for v in por_plantilla.values())
+    obsoletas = col.count_documents({"$nor": [{"plantilla": p, "version_plantilla": v} for p, v in versiones.items()]})
+    proy = {"_id": 0, "id_transaccion": 1, "plantilla": 1, "ponderado": 1, "tamano": 1, "lecturas": 1,
+            "generado_en": 1, "ultimo_acceso": 1}
+    return {
+        "entradas": sum(v["entradas"] for v in por_plantilla.values()),
+        "bytes": total,
+        "presupuesto_bytes": PRESUPUESTO_BYTES,
+        "ocupacion": round(total / PRESUPUESTO_BYTES, 4) if PRESUPUESTO_BYTES else None,
+        "politica": POLITICA,
+        "ttl_dias": TTL_DIAS,
+        "obsoletas": obsoletas,
+        "por_plantilla": por_plantilla,
+        "mas_leidos": list(col.find({}, proy).sort("lecturas", -1).limit(top)),
+        "ultima_eviccion": _EVICTOR["ultima"],
+    }
+
+
+_EVICTOR: Dict[str, Any] = {"hilo": None, "ultima": None}
+
+
+def iniciar_evictor(conectar: Callable[[], Any], versiones: Dict[str, str],
+                    intervalo: float = INTERVALO_EVICCION) -> Optional[threading.Thread]:
+    """Hilo demonio que asegura los índices y ejecuta evictar() cada `intervalo` segundos."""
+    if intervalo <= 0 or (_EVICTOR["hilo"] is not None and _EVICTOR["hilo"].is_alive()):
+        return _EVICTOR["hilo"]
+
+    def _bucle():
+        indices = False
+        while True:
+            try:
+                db = conectar()
+                if not indices:
+                    # Un fallo en los índices se reintenta en la siguiente pasada sin frenar la expulsión
+                    try:
+                        asegurar_indices_informes(db)
+                        indices = True
+                    except Exception as e:
+                        print(f"⚠️ Índices de {COLECCION_INFORMES}: {e}")
+                _EVICTOR["ultima"] = {**evictar(db, versiones), "fecha": datetime.now(timezone.utc)}
+                print(f"🧹 Evictor informes_pdf: {_EVICTOR['ultima']}")
+            except Exception as e:
+                print(f"⚠️ Evictor informes_pdf: {e}")
+            time.sleep(intervalo)
+
+    hilo = threading.Thread(target=_bucle, name="evictor-informes", daemon=True)
+    hilo.start()
+    _EVICTOR["hilo"] = hilo
+    return hilo
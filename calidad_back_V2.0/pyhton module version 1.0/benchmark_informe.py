@@ -0,0 +1,277 @@
+"""
+Benchmark de maquetación del informe PDF con redes grandes (50 y 200 centros)
+
+Compara la plantilla compacta, que mide cada sección y pagina las que no
+caben, con la misma plantilla sin partir secciones (KeepTogether siempre,
+el comportamiento anterior). Las gráficas se generan una vez por tamaño y
+se reutilizan como miniaturas con la misma proporción, de modo que el tiempo
+medido es el de maquetación y no el de codificar imágenes (--graficas reales
+para incluirlo).
+
+Con --modo imagenes compara el canal de imagen compacto (gráficas a la
+resolución de impresión y PNG con paleta) con el original (dpi=200 RGBA):
+tiempo total con gráficas reales, tamaño del PDF (lo que se guarda en
+informes_pdf) y peso de los PNG de las gráficas.
+
+Con --modo registros compara el dataset de registros con __slots__
+(registros_utils) con la representación dict anterior: memoria retenida,
+tiempo de construcción y tiempo de los recorridos del pipeline (paleta,
+filtrado de las gráficas, agrupación por región y filas de la tabla).
+
+Uso:
+    python benchmark_informe.py [--centros 50 200] [--indicadores 6] [--repeticiones 3] [--graficas reales]
+    python benchmark_informe.py --modo imagenes [--centros 50 200] [--indicadores 6]
+    python benchmark_informe.py --modo registros [--centros 200 2000] [--indicadores 40]
+"""
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Tuple
+
+import estadisticas_utils
+import graficas_utils
+import main
+import plantillas_utils
+import registros_utils
+
+
+def _filas_planas(n_centros: int, n_indicadores: int, semilla: int = 0) -> List[Tuple]:
+    """
+    Una tupla por (indicador, centro) con los valores ya creados, para que
+    las dos representaciones del benchmark de registros compartan los mismos
+    objetos y solo se mida la estructura.
+    """
+    rnd = random.Random(semilla)
+    filas = []
+    for i in range(n_indicadores):
+        ind = (f"IND{i}", f"Indicador {i}", f"Categoría {i % 3}", "%" if i % 2 == 0 else "mg/dL")
+        for c in range(n_centros):
+            v = round(rnd.uniform(0, 100), 2)
+            filas.append(ind + (f"Centro {c:03d}", f"Región {c % 5}", f"DB{c}", v, rnd.randint(10, 300)))
+    return filas
+
+
+def _indicadores_registros(filas: List[Tuple]) -> List[registros_utils.Indicador]:
+    agrupado: Dict[str, registros_utils.Indicador] = {}
+    for id_code, titulo, categoria, unidad, centro, region, centro_id, valor, pacientes in filas:
+        ind = agrupado.get(id_code)
+        if ind is None:
+            ind = agrupado[id_code] = registros_utils.Indicador(id_code, titulo, categoria, "", unidad)
+        ind.items.append(registros_utils.ItemCentro(centro, region, centro_id, valor, valor, pacientes))
+    return list(agrupado.values())
+
+
+def _indicadores_dicts(filas: List[Tuple]) -> List[Dict[str, Any]]:
+    """Mismo dataset en la representación anterior (un dict por indicador y por item)."""
+    agrupado: Dict[str, Dict[str, Any]] = {}
+    for id_code, titulo, categoria, unidad, centro, region, centro_id, valor, pacientes in filas:
+        if id_code not in agrupado:
+            agrupado[id_code] = {"id_code": id_code, "titulo": titulo, "categoria": categoria,
+                                 "objetivo": "", "unidad": unidad, "items": []}
+        agrupado[id_code]["items"].append({"centro": centro, "region": region, "centro_id": centro_id,
+                                           "valor": valor, "valor_num": valor, "pacientes": pacientes})
+    return list(agrupado.values())
+
+
+def dataset_sintetico(n_centros: int, n_indicadores: int, semilla: int = 0) -> Dict[str, Any]:
+    """Dataset con el formato de recopilar_datos_informe (sin MongoDB)."""
+    meta = {"id_transaccion": f"bench-{n_centros}", "generado_en": "", "num_docs": n_centros * n_indicadores}
+    return {"meta": meta, "indicadores": _indicadores_registros(_filas_planas(n_centros, n_indicadores, semilla))}
+
+
+def _miniatura(buf, ancho: int = 48) -> bytes:
+    """PNG reducido con la misma proporción (mismo alto en página, coste de imagen despreciable)."""
+    from PIL import Image
+
+    if buf is None:
+        return b""
+    img = Image.open(buf)
+    alto = max(1, round(img.height * ancho / img.width))
+    out = BytesIO()
+    img.convert("RGB").resize((ancho, alto)).save(out, format="PNG")
+    return out.getvalue()
+
+
+def _graficas_precalculadas(dataset: Dict[str, Any], miniaturas: bool = True):
+    """Sustituye las funciones de gráficas por PNG ya renderizados (una vez por indicador)."""
+    palette = main._build_center_palette(dataset["indicadores"])
+    por_titulo: Dict[str, bytes] = {}
+    regiones: Dict[str, bytes] = {}
+    rollup = main.estadisticas_utils.calcular_rollup_regiones(dataset["indicadores"])
+    reducir = _miniatura if miniaturas else (lambda buf: buf.getvalue() if buf else b"")
+    for i, ind in enumerate(dataset["indicadores"]):
+        por_titulo[ind.titulo] = reducir(main._select_chart(ind.items, ind.titulo, ind.unidad, palette))
+        filas = main.estadisticas_utils.filas_rollup_indicador(rollup, i)
+        regiones[ind.titulo] = reducir(
+            main._plot_comparativa_regiones(ind.items, filas, ind.titulo, ind.unidad, palette))
+
+    def _select_chart(items, titulo, *args, **kwargs):
+        png = por_titulo.get(titulo)
+        return BytesIO(png) if png else None
+
+    def _plot_comparativa_regiones(items, filas_region, titulo, *args, **kwargs):
+        png = regiones.get(titulo)
+        return BytesIO(png) if png else None
+
+    main._select_chart = _select_chart
+    main._plot_comparativa_regiones = _plot_comparativa_regiones
+
+
+def _medir(dataset: Dict[str, Any], plantilla: str, repeticiones: int) -> Dict[str, Any]:
+    tiempos: List[float] = []
+    tam = 0
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        pdf = main.generar_informe_pdf(dataset, plantilla=plantilla)
+        tiempos.append(time.perf_counter() - t0)
+        tam = len(pdf)
+    return {"segundos": min(tiempos), "bytes": tam}
+
+
+def _peso_graficas(dataset: Dict[str, Any]) -> Dict[str, Any]:
+    """Bytes y píxeles de las gráficas principales del dataset."""
+    palette = main._build_center_palette(dataset["indicadores"])
+    tpl = plantillas_utils.compilar_plantilla()
+    total, pixeles = 0, 0
+    for ind in dataset["indicadores"]:
+        buf = main._select_chart(ind.items, ind.titulo, ind.unidad, palette, None,
+                                 tpl.max_centros_grafica, tpl.extremos_grafica)
+        if buf is None:
+            continue
+        total += len(buf.getvalue())
+        w, h = main.ImageReader(buf).getSize()
+        pixeles += w * h
+    return {"bytes": total, "pixeles": pixeles}
+
+
+def _benchmark_imagenes(args) -> None:
+    print(f"{'centros':>8} {'canal':>10} {'segundos':>9} {'PDF KB':>8} {'PNG KB':>8} {'Mpx':>6}")
+    compacto_original = graficas_utils.GRAFICAS_COMPACTAS
+    for n in args.centros:
+        dataset = dataset_sintetico(n, args.indicadores)
+        for compacto in (False, True):
+            graficas_utils.GRAFICAS_COMPACTAS = compacto
+            r = _medir(dataset, plantillas_utils.PLANTILLA_POR_DEFECTO, args.repeticiones)
+            g = _peso_graficas(dataset)
+            print(f"{n:>8} {'compacto' if compacto else 'original':>10} {r['segundos']:>9.2f} "
+                  f"{r['bytes'] / 1024:>8.0f} {g['bytes'] / 1024:>8.0f} {g['pixeles'] / 1e6:>6.1f}")
+    graficas_utils.GRAFICAS_COMPACTAS = compacto_original
+
+
+def _recorrer_dicts(indicadores: List[Dict[str, Any]]) -> int:
+    """Accesos del pipeline con dicts: .get() con valores por defecto y limpieza del centro en cada uso."""
+    centros, por_region, filas = set(), {}, 0
+    for ind in indicadores:
+        unidad = ind.get("unidad") or ""
+        for it in ind.get("items") or []:
+            c = main._clean_text(it.get("centro") or "")
+            if c:
+                centros.add(c)
+            v = it.get("valor_num")
+            if v is not None and (it.get("centro") or "").strip():
+                valor = max(0.0, min(100.0, float(v))) if unidad == "%" else float(v)
+                r = main._clean_text(it.get("region") or "") or estadisticas_utils.SIN_REGION
+                por_region.setdefault(r, []).append(((it.get("centro") or "").strip(), valor))
+            fila = [it.get("centro", ""),
+                    "" if it.get("valor") is None else str(it.get("valor")),
+                    "" if it.get("pacientes") is None else str(it.get("pacientes"))]
+            filas += len(fila)
+    return len(centros) + len(por_region) + filas
+
+
+def _recorrer_registros(indicadores: List[registros_utils.Indicador]) -> int:
+    """Los mismos accesos sobre registros con campos ya normalizados."""
+    centros, por_region, filas = set(), {}, 0
+    for ind in indicadores:
+        unidad = ind.unidad
+        for it in ind.items:
+            if it.centro:
+                centros.add(it.centro)
+            if it.valor_num is not None and it.centro:
+                valor = max(0.0, min(100.0, it.valor_num)) if unidad == "%" else it.valor_num
+                por_region.setdefault(it.region or estadisticas_utils.SIN_REGION, []).append((it.centro, valor))
+            fila = [it.centro,
+                    "" if it.valor is None else str(it.valor),
+                    "" if it.pacientes is None else str(it.pacientes)]
+            filas += len(fila)
+    return len(centros) + len(por_region) + filas
+
+
+def _memoria_retenida(construir: Callable[[List[Tuple]], Any], filas: List[Tuple]) -> int:
+    """Bytes que quedan reservados tras construir el dataset (tracemalloc)."""
+    gc.collect()
+    tracemalloc.start()
+    datos = construir(filas)
+    actual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del datos
+    return actual
+
+
+def _mejor_tiempo(funcion: Callable[[], Any], repeticiones: int) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - t0)
+    return min(tiempos)
+
+
+def _benchmark_registros(args) -> None:
+    print(f"{'items':>8} {'repr.':>10} {'MB':>8} {'B/item':>7} {'construir ms':>13} {'recorrer ms':>12}")
+    for n in args.centros:
+        filas = _filas_planas(n, args.indicadores)
+        for nombre, construir, recorrer in (("dict", _indicadores_dicts, _recorrer_dicts),
+                                            ("registros", _indicadores_registros, _recorrer_registros)):
+            memoria = _memoria_retenida(construir, filas)
+            t_construir = _mejor_tiempo(lambda: construir(filas), args.repeticiones)
+            indicadores = construir(filas)
+            t_recorrer = _mejor_tiempo(lambda: recorrer(indicadores), args.repeticiones)
+            print(f"{len(filas):>8} {nombre:>10} {memoria / 2 ** 20:>8.2f} {memoria / len(filas):>7.0f} "
+                  f"{1000 * t_construir:>13.1f} {1000 * t_recorrer:>12.1f}")
+
+
+def main_benchmark(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark de maquetación del informe con muchos centros")
+    parser.add_argument("--centros", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--indicadores", type=int, default=6)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--graficas", choices=["miniatura", "reales"], default="miniatura",
+                        help="reales: incluye el coste de incrustar las imágenes a resolución completa")
+    parser.add_argument("--modo", choices=["maquetacion", "imagenes", "registros"], default="maquetacion")
+    args = parser.parse_args(argv)
+    # Se mide el render completo en cada repetición, sin reutilizar gráficas
+    graficas_utils.CACHE_GRAFICAS.max_entradas = 0
+
+    if args.modo == "imagenes":
+        _benchmark_imagenes(args)
+        return
+    if args.modo == "registros":
+        _benchmark_registros(args)
+        return
+
+    # Variante sin partir secciones: el comportamiento anterior (KeepTogether siempre)
+    plantillas_utils.PLANTILLAS["compacta_sin_partir"] = {
+        **plantillas_utils.PLANTILLAS["compacta"], "partir_secciones": False,
+    }
+    originales = (main._select_chart, main._plot_comparativa_regiones)
+
+    print(f"{'centros':>8} {'plantilla':>22} {'segundos':>9} {'ms/centro':>10} {'KB':>8}")
+    for n in args.centros:
+        dataset = dataset_sintetico(n, args.indicadores)
+        main._select_chart, main._plot_comparativa_regiones = originales
+        _graficas_precalculadas(dataset, miniaturas=args.graficas == "miniatura")
+        for plantilla in ("compacta", "compacta_sin_partir"):
+            r = _medir(dataset, plantilla, args.repeticiones)
+            print(f"{n:>8} {plantilla:>22} {r['segundos']:>9.2f} "
+                  f"{1000 * r['segundos'] / n:>10.2f} {r['bytes'] / 1024:>8.0f}")
+
+    main._select_chart, main._plot_comparativa_regiones = originales
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,80 @@
+"""
+Caché en memoria (LRU + TTL) segura entre hilos para datasets y
+resultados intermedios del servicio de informes
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class CacheLRU:
+    """Caché LRU con caducidad por entrada, protegida con un lock"""
+
+    def __init__(self, max_entradas: int = 32, ttl_segundos: Optional[float] = 600):
+        """
+        Args:
+            max_entradas: Número máximo de entradas antes de expulsar la menos usada
+            ttl_segundos: Vida máxima de una entrada (None = sin caducidad)
+        """
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self._datos: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave: Hashable) -> Optional[Any]:
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            valor, creado = entrada
+            if self.ttl_segundos is not None and time.monotonic() - creado > self.ttl_segundos:
+                del self._datos[clave]
+                self.fallos += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return valor
+
+    def set(self, clave: Hashable, valor: Any) -> None:
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic())
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def get_or_set(self, clave: Hashable, factoria: Callable[[], Any]) -> Any:
+        """
+        Devuelve el valor cacheado o lo calcula con factoria().
+        El cálculo se hace fuera del lock (dos hilos pueden calcular a la vez
+        la misma clave; el último en terminar gana).
+        """
+        valor = self.get(clave)
+        if valor is not None:
+            return valor
+        valor = factoria()
+        if valor is not None:
+            self.set(clave, valor)
+        return valor
+
+    def invalidar(self, clave: Optional[Hashable] = None) -> None:
+        """Elimina una clave (o toda la caché si clave es None)."""
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entradas": len(self._datos),
+                "max_entradas": self.max_entradas,
+                "ttl_segundos": self.ttl_segundos,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+            }
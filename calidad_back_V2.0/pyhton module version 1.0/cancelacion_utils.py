@@ -0,0 +1,60 @@
+"""
+Plazo por petición y cancelación cooperativa de renders: el informe comprueba
+entre etapas (lectura, dataset, cada gráfica y antes de maquetar) si se ha
+agotado el plazo o el cliente se ha desconectado, y deja de trabajar en un
+PDF que nadie va a recibir
+"""
+
+import os
+import time
+from typing import Callable, Optional
+
+
+RENDER_PLAZO_SEGUNDOS = float(os.getenv("RENDER_PLAZO_SEGUNDOS", "150"))
+
+
+class RenderCancelado(Exception):
+    """Render abandonado en un punto de control (plazo agotado o cliente desconectado)."""
+
+    def __init__(self, motivo: str, etapa: str):
+        super().__init__(f"{motivo} (etapa: {etapa})")
+        self.motivo = motivo
+        self.etapa = etapa
+
+
+class Cancelacion:
+    """
+    Plazo y desconexión de una petición
+
+    Args:
+        plazo_segundos: Tiempo máximo desde ahora (None = sin plazo)
+        desconectado: Devuelve True si el cliente ya no espera la respuesta
+    """
+
+    def __init__(self, plazo_segundos: Optional[float] = RENDER_PLAZO_SEGUNDOS,
+                 desconectado: Optional[Callable[[], bool]] = None):
+        self.plazo_segundos = plazo_segundos
+        self.limite = time.monotonic() + plazo_segundos if plazo_segundos else None
+        self.desconectado = desconectado
+        self.etapa: Optional[str] = None
+
+    def restante(self) -> Optional[float]:
+        """Segundos hasta el plazo (None si no hay plazo)."""
+        return None if self.limite is None else self.limite - time.monotonic()
+
+    def comprobar(self, etapa: str) -> None:
+        """
+        Punto de control entre etapas del render.
+
+        Raises:
+            RenderCancelado: Si se ha agotado el plazo o el cliente se ha ido
+        """
+        self.etapa = etapa
+        if self.limite is not None and time.monotonic() >= self.limite:
+            raise RenderCancelado(f"Plazo de {self.plazo_segundos:.0f}s agotado", etapa)
+        if self.desconectado is not None and self.desconectado():
+            raise RenderCancelado("Cliente desconectado", etapa)
+
+
+# Sin plazo ni cliente (scripts, benchmarks y llamadas directas)
+SIN_CANCELACION = Cancelacion(None)
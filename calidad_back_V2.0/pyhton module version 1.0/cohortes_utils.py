@@ -0,0 +1,330 @@
+"""
+Análisis longitudinal de cohortes de comorbilidad: historial de puntuaciones
+por paciente y matrices de transición entre categorías (p. ej.
+robusto -> prefrágil -> frágil) por centro, con recálculo incremental
+"""
+
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from comorbilidad_utils import (
+    COLECCION_RESPUESTAS,
+    PROYECCION_RESPUESTAS,
+    ReglasComorbilidad,
+    cargar_reglas,
+    columnas_respuestas,
+)
+
+
+COLECCION_PACIENTES = "cohortes_pacientes"
+COLECCION_TRANSICIONES = "cohortes_transiciones"
+COLECCION_ESTADO = "cohortes_estado"
+
+# Las categorías por test (cortes y etiquetas, de mejor a peor situación) son las
+# entradas "categorias" de indicadores_comorbilidad.json: ReglasComorbilidad.categorias
+
+# Tamaño de los bloques de NREGGEN en las consultas $in
+LOTE_PACIENTES = 1000
+
+
+# =========================
+# CÁLCULO (sin E/S)
+# =========================
+def categorizar(test: str, puntuaciones: np.ndarray, reglas: Optional[ReglasComorbilidad] = None) -> np.ndarray:
+    """Índice de categoría (0 = mejor) de cada puntuación del test."""
+    cfg = (reglas or cargar_reglas()).categorias[test]
+    idx = np.digitize(puntuaciones, cfg["cortes"])
+    if not cfg["mayor_es_peor"]:
+        idx = len(cfg["etiquetas"]) - 1 - idx
+    return idx
+
+
+def construir_historiales(
+    respuestas: Iterable[Dict[str, Any]],
+    reglas: Optional[ReglasComorbilidad] = None
+) -> List[Dict[str, Any]]:
+    """
+    Agrupa las respuestas en un historial cronológico por (test, paciente)
+
+    Returns:
+        Documentos de cohortes_pacientes: test, paciente, centro (el de la última
+        evaluación), fechas, puntuaciones, categorias y "pares" (transiciones
+        consecutivas codificadas como origen * n_categorias + destino)
+    """
+    reglas = reglas or cargar_reglas()
+    cols = columnas_respuestas(respuestas, reglas)
+    tests = reglas.tests
+    categorias = reglas.categorias
+    if not len(cols["test"]):
+        return []
+    con_categorias = np.array([t in categorias for t in tests])
+    sel = con_categorias[cols["test"]] & ~np.isnan(cols["puntuacion"])
+    if not sel.any():
+        return []
+
+    test = cols["test"][sel]
+    paciente = cols["paciente"][sel]
+    centro = cols["centro"][sel]
+    fecha = cols["fecha"][sel]
+    punt = cols["puntuacion"][sel]
+    pacientes_ejes, pac_idx = np.unique(paciente, return_inverse=True)
+
+    # Categoría por fila, vectorizada por test
+    categoria = np.zeros(len(punt), dtype=np.int64)
+    for i, t in enumerate(tests):
+        filas = test == i
+        if filas.any() and t in categorias:
+            categoria[filas] = categorizar(t, punt[filas], reglas)
+
+    orden = np.lexsort((fecha, pac_idx, test))
+    clave = test[orden] * len(pacientes_ejes) + pac_idx[orden]
+    cortes = np.flatnonzero(np.r_[True, clave[1:] != clave[:-1]])
+    limites = np.r_[cortes, len(orden)]
+
+    ahora = datetime.utcnow()
+    docs = []
+    for a, b in zip(limites[:-1], limites[1:]):
+        filas = orden[a:b]
+        t = tests[test[filas[0]]]
+        n_cat = len(categorias[t]["etiquetas"])
+        cats = categoria[filas]
+        p = str(paciente[filas[0]])
+        docs.append({
+            "_id": f"{t}|{p}",
+            "test": t,
+            "paciente": p,
+            "centro": str(centro[filas[-1]]),
+            "fechas": fecha[filas].tolist(),
+            "puntuaciones": punt[filas].tolist(),
+            "categorias": cats.tolist(),
+            "pares": (cats[:-1] * n_cat + cats[1:]).tolist(),
+            "actualizado": ahora,
+        })
+    return docs
+
+
+def matriz_desde_pares(pares: Sequence[int], n_categorias: int) -> np.ndarray:
+    """Matriz de transición (origen × destino) a partir de pares codificados."""
+    return np.bincount(np.asarray(pares, dtype=np.int64), minlength=n_categorias * n_categorias) \
+        .reshape(n_categorias, n_categorias)
+
+
+def resumen_matriz(matriz: np.ndarray) -> Dict[str, int]:
+    """Transiciones a mejor categoría, a peor y sin cambio (0 = mejor categoría)."""
+    return {
+        "mejoran": int(np.tril(matriz, -1).sum()),
+        "empeoran": int(np.triu(matriz, 1).sum()),
+        "estables": int(np.trace(matriz)),
+    }
+
+
+# =========================
+# ACTUALIZACIÓN INCREMENTAL (MongoDB)
+# =========================
+def _respuestas_de_pacientes(db, form_ids: List[str], pacientes: List[str]) -> Iterable[Dict[str, Any]]:
+    """Todas las respuestas (de los tests con reglas) de los pacientes indicados."""
+    col = db[COLECCION_RESPUESTAS]
+    for i in range(0, len(pacientes), LOTE_PACIENTES):
+        bloque = pacientes[i:i + LOTE_PACIENTES]
+        filtro = {"metadata.form_id": {"$in": form_ids}, "metadata.NREGGEN": {"$in": bloque}}
+        yield from col.find(filtro, PROYECCION_RESPUESTAS)
+
+
+def _pacientes_tocados(db, form_ids: List[str], desde: Optional[datetime]) -> Tuple[List[str], Optional[datetime]]:
+    """NREGGEN con respuestas nuevas desde la marca y nueva marca (created_at máximo)."""
+    filtro: Dict[str, Any] = {"metadata.form_id": {"$in": form_ids}}
+    if desde is not None:
+        filtro["created_at"] = {"$gt": desde}
+    pacientes = set()
+    marca = desde
+    for r in db[COLECCION_RESPUESTAS].find(filtro, {"_id": 0, "metadata.NREGGEN": 1, "created_at": 1}):
+        nreg = (r.get("metadata") or {}).get("NREGGEN")
+        if nreg:
+            pacientes.add(str(nreg))
+        creado = r.get("created_at")
+        if isinstance(creado, datetime) and (marca is None or creado > marca):
+            marca = creado
+    return sorted(pacientes), marca
+
+
+def _recalcular_matrices(db, celdas: Iterable[Tuple[str, str]], reglas: ReglasComorbilidad) -> int:
+    """Recalcula las matrices (test, centro) indicadas desde los historiales guardados."""
+    from pymongo import ReplaceOne
+
+    col_pac = db[COLECCION_PACIENTES]
+    ops = []
+    ahora = datetime.utcnow()
+    for test, centro in celdas:
+        if test not in reglas.categorias:
+            continue
+        etiquetas = reglas.categorias[test]["etiquetas"]
+        n_cat = len(etiquetas)
+        pares: List[int] = []
+        n_pacientes = 0
+        for doc in col_pac.find({"test": test, "centro": centro}, {"_id": 0, "pares": 1}):
+            n_pacientes += 1
+            pares.extend(doc.get("pares") or [])
+        matriz = matriz_desde_pares(pares, n_cat)
+        ops.append(ReplaceOne(
+            {"_id": f"{test}|{centro}"},
+            {
+                "test": test,
+                "centro": centro,
+                "categorias": etiquetas,
+                "matriz": matriz.tolist(),
+                "n_pacientes": n_pacientes,
+                **resumen_matriz(matriz),
+                "actualizado": ahora,
+            },
+            upsert=True,
+        ))
+    if ops:
+        db[COLECCION_TRANSICIONES].bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def actualizar_cohortes(
+    db,
+    pacientes: Optional[List[str]] = None,
+    completo: bool = False,
+    reglas: Optional[ReglasComorbilidad] = None
+) -> Dict[str, Any]:
+    """
+    Actualiza historiales y matrices solo para los pacientes con respuestas nuevas
+
+    Los pacientes afectados se detectan por created_at posterior a la última
+    marca (o se pasan explícitamente). Se releen sus respuestas, se reescriben
+    sus historiales y se recalculan solo las matrices de sus centros (antiguo
+    y nuevo). El recálculo de una matriz es idempotente, así que dos
+    actualizaciones concurrentes producen el mismo resultado.
+
+    Args:
+        db: Conexión a MongoDB
+        pacientes: NREGGEN a recalcular (ignora la marca)
+        completo: Recalcula todos los pacientes
+        reglas: Reglas compiladas (por defecto cargar_reglas())
+
+    Returns:
+        Resumen: pacientes, historiales y matrices actualizados, segundos
+    """
+    from pymongo import ReplaceOne
+
+    t0 = datetime.utcnow()
+    reglas = reglas or cargar_reglas()
+    form_ids = [f for f, t in reglas.form_ids.items() if t in reglas.categorias]
+    col_estado = db[COLECCION_ESTADO]
+
+    marca = None
+    if pacientes is None:
+        estado = None if completo else col_estado.find_one({"_id": "marca"})
+        desde = (estado or {}).get("created_at")
+        pacientes, marca = _pacientes_tocados(db, form_ids, desde)
+
+    if not pacientes:
+        return {"pacientes": 0, "historiales": 0, "matrices": 0,
+                "segundos": (datetime.utcnow() - t0).total_seconds()}
+
+    historiales = construir_historiales(_respuestas_de_pacientes(db, form_ids, pacientes), reglas)
+
+    # Centros anteriores de esos pacientes: sus matrices también cambian
+    col_pac = db[COLECCION_PACIENTES]
+    celdas = set()
+    for i in range(0, len(pacientes), LOTE_PACIENTES):
+        bloque = pacientes[i:i + LOTE_PACIENTES]
+        for doc in col_pac.find({"paciente": {"$in": bloque}}, {"_id": 0, "test": 1, "centro": 1}):
+            celdas.add((doc["test"], doc["centro"]))
+    celdas.update((h["test"], h["centro"]) for h in historiales)
+
+    if historiales:
+        col_pac.bulk_write([ReplaceOne({"_id": h["_id"]}, h, upsert=True) for h in historiales], ordered=False)
+    n_matrices = _recalcular_matrices(db, sorted(celdas), reglas)
+    if n_matrices:
+        # Nueva versión: los informes guardados con las matrices anteriores dejan de servirse
+        col_estado.replace_one({"_id": "version"}, {"actualizado": datetime.utcnow()}, upsert=True)
+
+    if marca is not None:
+        col_estado.replace_one({"_id": "marca"}, {"created_at": marca}, upsert=True)
+
+    return {
+        "pacientes": len(pacientes),
+        "historiales": len(historiales),
+        "matrices": n_matrices,
+        "segundos": (datetime.utcnow() - t0).total_seconds(),
+    }
+
+
+def version_cohortes(db) -> Optional[str]:
+    """Versión de las matrices guardadas (fecha de la última actualización); None si nunca se han actualizado."""
+    estado = db[COLECCION_ESTADO].find_one({"_id": "version"})
+    actualizado = (estado or {}).get("actualizado")
+    return actualizado.isoformat() if isinstance(actualizado, datetime) else None
+
+
+def asegurar_indices_cohortes(db) -> None:
+    """Índices de las colecciones de cohortes y de la detección de respuestas nuevas."""
+    db[COLECCION_PACIENTES].create_index([("test", 1), ("centro", 1)])
+    db[COLECCION_PACIENTES].create_index("paciente")
+    db[COLECCION_TRANSICIONES].create_index("test")
+    db[COLECCION_RESPUESTAS].create_index("created_at")
+
+
+def obtener_transiciones(
+    db,
+    test: Optional[str] = None,
+    centro: Optional[str] = None,
+    reglas: Optional[ReglasComorbilidad] = None
+) -> List[Dict[str, Any]]:
+    """
+    Matrices de transición guardadas, agrupadas por test, con la matriz de red
+    (suma de centros) y el resumen mejoran/empeoran/estables
+
+    Returns:
+        Lista (una entrada por test) serializable a JSON
+    """
+    categorias = (reglas or cargar_reglas()).categorias
+    filtro: Dict[str, Any] = {}
+    if test:
+        filtro["test"] = test
+    if centro:
+        filtro["centro"] = centro
+
+    por_test: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in db[COLECCION_TRANSICIONES].find(filtro, {"_id": 0, "actualizado": 0}):
+        if doc.get("test") in categorias:
+            por_test.setdefault(doc["test"], []).append(doc)
+
+    salida = []
+    for t in categorias:
+        centros = sorted(por_test.get(t, []), key=lambda d: d.get("centro") or "")
+        if not centros:
+            continue
+        n_cat = len(categorias[t]["etiquetas"])
+        red = np.zeros((n_cat, n_cat), dtype=np.int64)
+        for c in centros:
+            red += np.asarray(c["matriz"], dtype=np.int64).reshape(n_cat, n_cat)
+        salida.append({
+            "test": t,
+            "categorias": categorias[t]["etiquetas"],
+            "red": {
+                "matriz": red.tolist(),
+                "n_pacientes": int(sum(c.get("n_pacientes", 0) for c in centros)),
+                **resumen_matriz(red),
+            },
+            "centros": centros,
+        })
+    return salida
+
+
+if __name__ == "__main__":
+    import argparse
+    from main import conectar_calidad
+
+    parser = argparse.ArgumentParser(description="Actualiza las cohortes longitudinales de comorbilidad")
+    parser.add_argument("--completo", action="store_true", help="Recalcula todos los pacientes")
+    args = parser.parse_args()
+
+    db = conectar_calidad()
+    asegurar_indices_cohortes(db)
+    print(f"✅ Cohortes actualizadas: {actualizar_cohortes(db, completo=args.completo)}")
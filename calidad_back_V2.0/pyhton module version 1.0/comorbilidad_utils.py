@@ -3,55 +3,231 @@ Utilidades para procesar datos de comorbilidad desde MongoDB
 y generar indicadores para el informe PDF
 """
 
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Any, Optional
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from itertools import chain
 import json
+import os
+import threading
+import time
 from pathlib import Path
 
+import numpy as np
+
+from cache_utils import CacheLRU
+
+
+# Campos que usan los indicadores y la cobertura (una sola lectura por transacción)
+PROYECCION_COMORBILIDAD = {
+    "_id": 0,
+    "test_type": 1,
+    "tipo_test": 1,
+    "centro": 1,
+    "base.nombre": 1,
+    "resultados": 1,
+}
+
+# Dentro del directorio del módulo: es el único que entra en la imagen de Docker
+CONFIG_COMORBILIDAD_JSON = Path(os.getenv(
+    "COMORBILIDAD_REGLAS_JSON", Path(__file__).resolve().parent / "indicadores_comorbilidad.json"
+))
+
+COLECCION_RESPUESTAS = "test_responses"
+
+PROYECCION_RESPUESTAS = {
+    "_id": 0,
+    "metadata.form_id": 1,
+    "metadata.NREGGEN": 1,
+    "metadata.centro": 1,
+    "metadata.fecha_insercion": 1,
+    "puntuacion": 1,
+}
+
+_OPERADORES_NP = {
+    ">=": np.greater_equal,
+    ">": np.greater,
+    "<=": np.less_equal,
+    "<": np.less,
+    "==": np.equal,
+}
+
+# Pacientes prevalentes por centro (denominador de la cobertura), una vez por transacción
+DENOMINADOR_CACHE = CacheLRU(max_entradas=64, ttl_segundos=600)
+
+# Historial de los pacientes del periodo: se pide a Mongo por lotes de NREGGEN
+LOTE_PACIENTES = 5000
+
+# Comorbilidad calculada desde test_responses, por periodo (recorrido en segundo plano)
+RESPUESTAS_CACHE = CacheLRU(
+    max_entradas=16,
+    ttl_segundos=float(os.getenv("COMORB_RESPUESTAS_TTL", "1800")),
+)
+# Cuánto espera el informe a un cálculo en curso (0 = no espera: sale sin comorbilidad)
+COMORB_RESPUESTAS_ESPERA = float(os.getenv("COMORB_RESPUESTAS_ESPERA_SEGUNDOS", "0"))
+_EJECUTOR_RESPUESTAS = ThreadPoolExecutor(max_workers=1, thread_name_prefix="comorb-respuestas")
+_CALCULOS_RESPUESTAS: Dict[tuple, Future] = {}
+_CALCULOS_LOCK = threading.Lock()
+
+
+# =========================
+# REGLAS (indicadores_comorbilidad.json)
+# =========================
+def compilar_mascara(operador: str, umbral: float) -> Callable[[np.ndarray], np.ndarray]:
+    """Compila un umbral en una función vectorizada puntuaciones -> bool."""
+    op = _OPERADORES_NP[operador]
+    umbral = float(umbral)
+    return lambda x: op(x, umbral)
+
+
+class ReglaComorbilidad:
+    """Indicador de comorbilidad compilado (test, población y criterio)"""
+
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Args:
+            config: Entrada de indicadores_comorbilidad.json
+        """
+        self.config = config
+        self.id_code = config["id_code"]
+        self.test = config.get("test_asociado") or ""
+        self.tipo = config.get("tipo_calculo") or "porcentaje"
+        self.poblacion = config.get("poblacion") or "prevalentes"
+        self.operador = config.get("operador")
+        self.umbral = config.get("umbral_positivo")
+        self.predicado = None
+        if self.tipo == "porcentaje":
+            if self.operador not in _OPERADORES_NP or self.umbral is None:
+                raise ValueError(f"{self.id_code}: operador/umbral_positivo no válidos")
+            self.predicado = compilar_mascara(self.operador, self.umbral)
+
+
+def compilar_categorias(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compila las categorías de un test (tipo_calculo "categorias"): "cortes" son
+    los límites inferiores de cada categoría salvo la primera, en orden
+    ascendente de puntuación; "etiquetas" van de mejor a peor situación.
+    """
+    cortes = np.asarray(config.get("cortes") or [], dtype=np.float64)
+    etiquetas = list(config.get("etiquetas") or [])
+    if len(etiquetas) != len(cortes) + 1 or (len(cortes) > 1 and not (np.diff(cortes) > 0).all()):
+        raise ValueError(f"{config.get('id_code')}: cortes/etiquetas no válidos")
+    return {"cortes": cortes, "etiquetas": etiquetas, "mayor_es_peor": bool(config.get("mayor_es_peor"))}
+
+
+class ReglasComorbilidad:
+    """Conjunto de reglas indexado por id_code, test y form_id"""
+
+    def __init__(self, configs: List[Dict[str, Any]]):
+        self.por_id: Dict[str, Dict[str, Any]] = {c["id_code"]: c for c in configs}
+        self.reglas: List[ReglaComorbilidad] = []
+        self.por_test: Dict[str, List[ReglaComorbilidad]] = {}
+        self.form_ids: Dict[str, str] = {}
+        self.cobertura: Dict[str, Dict[str, Any]] = {}
+        self.cobertura_matriz: Dict[str, Any] = {}
+        # Categorías por test de las cohortes longitudinales (cohortes_utils)
+        self.categorias: Dict[str, Dict[str, Any]] = {}
+
+        for c in configs:
+            tipo = c.get("tipo_calculo") or "porcentaje"
+            test = c.get("test_asociado")
+            if tipo == "cobertura" and test:
+                self.cobertura[test] = c
+            if tipo == "categorias" and test:
+                self.categorias[test] = compilar_categorias(c)
+            if tipo == "cobertura_matriz":
+                self.cobertura_matriz = c
+            if tipo not in ("porcentaje", "media") or not test:
+                continue
+            regla = ReglaComorbilidad(c)
+            self.reglas.append(regla)
+            self.por_test.setdefault(test, []).append(regla)
+            for form_id in c.get("form_ids") or []:
+                self.form_ids[form_id] = test
+
+        self.tests: List[str] = list(self.por_test)
+        # Tests con cobertura: todos los configurados (con reglas o con indicador de cobertura)
+        self.tests_cobertura: List[str] = self.tests + [t for t in self.cobertura if t not in self.por_test]
+
+    def reglas_porcentaje(self, poblacion: str) -> List[ReglaComorbilidad]:
+        return [r for r in self.reglas if r.tipo == "porcentaje" and r.poblacion == poblacion]
+
+
+@lru_cache(maxsize=None)
+def cargar_reglas(ruta: Path = CONFIG_COMORBILIDAD_JSON) -> ReglasComorbilidad:
+    """
+    Lee y compila las reglas de comorbilidad (una vez por proceso)
+
+    Raises:
+        FileNotFoundError: Si no existe el fichero de reglas
+        ValueError: Si el fichero no es válido
+    """
+    if not ruta.exists():
+        print(f"❌ No existe la configuración de comorbilidad: {ruta}")
+        raise FileNotFoundError(f"Configuración de comorbilidad no encontrada: {ruta}")
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return ReglasComorbilidad(json.load(f))
+    except Exception as e:
+        print(f"❌ Error cargando config de comorbilidad ({ruta}): {e}")
+        raise ValueError(f"Configuración de comorbilidad no válida: {e}") from e
+
 
 class ComorbilityProcessor:
-    """Procesador de datos de comorbilidad para informes"""
+    """Procesador de datos de comorbilidad para informes (sin estado: reutilizable)"""
     
-    def __init__(self, db):
+    def __init__(self, reglas: Optional[ReglasComorbilidad] = None):
         """
         Args:
-            db: Conexión a la base de datos MongoDB
+            reglas: Reglas compiladas (por defecto, las de indicadores_comorbilidad.json)
         """
-        self.db = db
-        self.indicadores_config = self._load_indicadores_config()
+        self.reglas = reglas or cargar_reglas()
+        self.indicadores_config = self.reglas.por_id
     
-    def _load_indicadores_config(self) -> Dict[str, Any]:
-        """Carga la configuración de indicadores de comorbilidad"""
-        config_path = Path(__file__).parent.parent / "documentacion" / "indicadores_comorbilidad.json"
-        
-        if not config_path.exists():
-            return {}
+    def obtener_documentos_comorbilidad(self, db, id_transaccion: str) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Lee en una única consulta (proyectada) todos los documentos de
+        comorbilidad de la transacción, agrupados por tipo de test
         
+        Args:
+            db: Conexión a MongoDB
+            id_transaccion: ID de la transacción
+            
+        Returns:
+            Dict test_type -> lista de documentos
+        """
+        por_test: Dict[str, List[Dict[str, Any]]] = {}
         try:
-            with open(config_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return {item['id_code']: item for item in data}
+            col_comorb = db["comorbilidad"]
+            for doc in col_comorb.find({"id_transaccion": id_transaccion}, PROYECCION_COMORBILIDAD):
+                test_type = doc.get("test_type") or doc.get("tipo_test") or ""
+                por_test.setdefault(test_type, []).append(doc)
         except Exception as e:
-            print(f"Error cargando config de comorbilidad: {e}")
-            return {}
+            print(f"Error obteniendo datos de comorbilidad: {e}")
+        return por_test
     
-    def obtener_datos_comorbilidad(self, id_transaccion: str) -> List[Dict[str, Any]]:
+    def obtener_datos_comorbilidad(
+        self,
+        db,
+        id_transaccion: str,
+        docs_por_test: Optional[Dict[str, List[Dict[str, Any]]]] = None
+    ) -> List[Dict[str, Any]]:
         """
         Obtiene datos de comorbilidad desde MongoDB para una transacción
         
         Args:
+            db: Conexión a MongoDB
             id_transaccion: ID de la transacción
+            docs_por_test: Documentos ya leídos (obtener_documentos_comorbilidad)
             
         Returns:
             Lista de indicadores procesados con formato estándar
         """
         try:
-            # Buscar en la colección de comorbilidad
-            col_comorb = self.db["comorbilidad"]
-            docs = list(col_comorb.find(
-                {"id_transaccion": id_transaccion},
-                {"_id": 0}
-            ))
+            if docs_por_test is None:
+                docs_por_test = self.obtener_documentos_comorbilidad(db, id_transaccion)
+            docs = [d for lista in docs_por_test.values() for d in lista]
             
             if not docs:
                 print(f"No se encontraron datos de comorbilidad para transacción {id_transaccion}")
@@ -63,6 +239,59 @@ class ComorbilityProcessor:
             print(f"Error obteniendo datos de comorbilidad: {e}")
             return []
     
+    def calcular_desde_respuestas(
+        self,
+        db,
+        fecha_inicio: Any,
+        fecha_fin: Any
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Calcula incidentes/prevalentes por centro a partir de las respuestas
+        individuales (colección test_responses) evaluando los umbrales
+        
+        Solo se leen las respuestas del periodo y, de sus pacientes, el resto
+        del historial (necesario para saber si son incidentes); nunca la
+        colección completa.
+        
+        Args:
+            db: Conexión a MongoDB
+            fecha_inicio: Inicio del periodo
+            fecha_fin: Fin del periodo
+            
+        Returns:
+            Dict test_type -> documentos con el mismo formato que la colección
+            comorbilidad (admitido por obtener_datos_comorbilidad)
+        
+        Raises:
+            PyMongoError: Si falla la lectura (no se devuelve un resultado vacío
+                que pudiera cachearse como válido)
+        """
+        ini, fin = _fecha_ordinal(fecha_inicio), _fecha_ordinal(fecha_fin)
+        if ini is None or fin is None:
+            return {}
+        
+        col = db[COLECCION_RESPUESTAS]
+        base = {"metadata.form_id": {"$in": list(self.reglas.form_ids)}, "puntuacion": {"$ne": None}}
+        dias = _dias_periodo(ini, fin)
+        en_periodo = list(col.find(
+            {**base, "metadata.fecha_insercion": {"$in": dias}}, PROYECCION_RESPUESTAS, batch_size=10000
+        ))
+        if not en_periodo:
+            return {}
+        
+        pacientes = list({(r.get("metadata") or {}).get("NREGGEN") for r in en_periodo} - {None, ""})
+        historial = (
+            r
+            for i in range(0, len(pacientes), LOTE_PACIENTES)
+            for r in col.find(
+                {**base,
+                 "metadata.NREGGEN": {"$in": pacientes[i:i + LOTE_PACIENTES]},
+                 "metadata.fecha_insercion": {"$nin": dias}},
+                PROYECCION_RESPUESTAS, batch_size=10000,
+            )
+        )
+        return calcular_comorbilidad_respuestas(chain(en_periodo, historial), ini, fin, self.reglas)
+    
     def _procesar_documentos_comorbilidad(self, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         Procesa documentos de comorbilidad y los transforma al formato de indicadores
@@ -82,117 +311,43 @@ class ComorbilityProcessor:
             # Obtener resultados
             resultados = doc.get("resultados") or {}
             
-            # Procesar según tipo de test
-            if test_type in ["FRAIL", "SARCF", "MNA", "BARTHEL", "LAWTON", 
-                            "CHARLSON", "DOWNTON", "PHQ4", "GIJON"]:
-                
-                # Generar indicadores para incidentes y prevalentes
-                self._procesar_test_individual(
-                    test_type, centro, resultados, indicadores_procesados
+            # Un indicador por regla del test (incidentes, prevalentes, Charlson alto...)
+            for regla in self.reglas.por_test.get(test_type, []):
+                self._generar_indicador_comorbilidad(
+                    regla, centro, resultados.get(regla.poblacion, {}), indicadores_procesados
                 )
         
         # Convertir dict a lista
         return list(indicadores_procesados.values())
     
-    def _procesar_test_individual(
-        self, 
-        test_type: str, 
-        centro: str, 
-        resultados: Dict[str, Any],
-        indicadores_procesados: Dict[str, Any]
-    ):
-        """
-        Procesa un test individual y genera indicadores
-        
-        Args:
-            test_type: Tipo de test (FRAIL, BARTHEL, etc.)
-            centro: Nombre del centro
-            resultados: Resultados del test
-            indicadores_procesados: Diccionario donde acumular resultados
-        """
-        # Configuración de umbrales por test
-        config_umbrales = {
-            "FRAIL": {"umbral": 3, "operador": ">=", "tipo": "porcentaje"},
-            "SARCF": {"umbral": 3, "operador": ">", "tipo": "porcentaje"},
-            "MNA": {"umbral": 11, "operador": "<=", "tipo": "porcentaje"},
-            "BARTHEL": {"umbral": 75, "operador": "<=", "tipo": "porcentaje"},
-            "LAWTON": {"umbral": 8, "operador": "<", "tipo": "porcentaje"},
-            "CHARLSON": {"tipo": "media"},
-            "DOWNTON": {"umbral": 3, "operador": ">=", "tipo": "porcentaje"},
-            "PHQ4": {"umbral": 6, "operador": ">=", "tipo": "porcentaje"},
-            "GIJON": {"umbral": 10, "operador": ">", "tipo": "porcentaje"},
-        }
-        
-        config = config_umbrales.get(test_type, {})
-        
-        # Generar indicadores para incidentes
-        self._generar_indicador_comorbilidad(
-            f"COMORB_{test_type}_INC",
-            test_type,
-            centro,
-            resultados.get("incidentes", {}),
-            config,
-            "incidentes",
-            indicadores_procesados
-        )
-        
-        # Generar indicadores para prevalentes
-        self._generar_indicador_comorbilidad(
-            f"COMORB_{test_type}_PREV",
-            test_type,
-            centro,
-            resultados.get("prevalentes", {}),
-            config,
-            "prevalentes",
-            indicadores_procesados
-        )
-        
-        # Indicador especial para Charlson alto (solo prevalentes)
-        if test_type == "CHARLSON":
-            self._generar_indicador_comorbilidad(
-                "COMORB_CHARLSON_ALTO_PREV",
-                test_type,
-                centro,
-                resultados.get("prevalentes", {}),
-                {"umbral": 5, "operador": ">=", "tipo": "porcentaje"},
-                "prevalentes_alto",
-                indicadores_procesados
-            )
-    
     def _generar_indicador_comorbilidad(
         self,
-        id_code: str,
-        test_type: str,
+        regla: ReglaComorbilidad,
         centro: str,
         datos: Dict[str, Any],
-        config: Dict[str, Any],
-        tipo_poblacion: str,
         indicadores_procesados: Dict[str, Any]
     ):
         """
         Genera un indicador de comorbilidad específico
         
         Args:
-            id_code: Código del indicador
-            test_type: Tipo de test
+            regla: Regla compilada del indicador
             centro: Nombre del centro
-            datos: Datos del test
-            config: Configuración de umbrales
-            tipo_poblacion: Tipo de población (incidentes/prevalentes)
+            datos: Datos del test para la población de la regla
             indicadores_procesados: Diccionario donde acumular
         """
         if not datos:
             return
         
-        # Obtener configuración del indicador
-        ind_config = self.indicadores_config.get(id_code, {})
+        id_code = regla.id_code
+        ind_config = regla.config
         
         # Inicializar indicador si no existe
         if id_code not in indicadores_procesados:
             indicadores_procesados[id_code] = {
                 "id_code": id_code,
-                "titulo": ind_config.get("titulo", f"{test_type} - {tipo_poblacion}"),
-                "categoria": ind_config.get("categoria", f"Comorbilidad - {test_type}"),
+                "titulo": ind_config.get("titulo", f"{regla.test} - {regla.poblacion}"),
+                "categoria": ind_config.get("categoria", f"Comorbilidad - {regla.test}"),
                 "objetivo": ind_config.get("objetivo", ""),
                 "unidad": ind_config.get("unidad", "%"),
                 "items": []
@@ -202,14 +357,15 @@ class ComorbilityProcessor:
         valor = None
         total_pacientes = datos.get("total_pacientes", 0)
         
-        if config.get("tipo") == "media":
+        if regla.tipo == "media":
             # Para Charlson: media de puntuaciones
             suma_total = datos.get("suma_puntuaciones", 0)
             if total_pacientes > 0:
                 valor = suma_total / total_pacientes
         else:
-            # Para porcentajes: calcular según umbral
-            pacientes_positivos = datos.get("pacientes_positivos", 0)
+            # Para porcentajes: positivos de esta regla (o el agregado del test)
+            por_regla = datos.get("positivos_por_regla") or {}
+            pacientes_positivos = por_regla.get(id_code, datos.get("pacientes_positivos", 0))
             if total_pacientes > 0:
                 valor = (pacientes_positivos / total_pacientes) * 100
         
@@ -224,96 +380,443 @@ class ComorbilityProcessor:
                 "pacientes": total_pacientes
             })
     
-    def calcular_cobertura_screening(
-        self, 
+    def denominador_centros(
+        self,
+        db,
+        id_transaccion: str,
+        docs_por_test: Optional[Dict[str, List[Dict[str, Any]]]] = None
+    ) -> Dict[str, int]:
+        """
+        Pacientes prevalentes por centro (denominador de la cobertura)
+
+        Es la misma población repetida en el documento de cada test: se toma el
+        máximo por centro y se cachea por transacción.
+        """
+        def _calcular():
+            docs = docs_por_test if docs_por_test is not None else self.obtener_documentos_comorbilidad(db, id_transaccion)
+            denominador: Dict[str, int] = {}
+            for lista in docs.values():
+                for doc in lista:
+                    centro = doc.get("centro") or doc.get("base", {}).get("nombre") or "Centro"
+                    total = ((doc.get("resultados") or {}).get("prevalentes") or {}).get("total_pacientes") or 0
+                    if total > denominador.get(centro, 0):
+                        denominador[centro] = total
+            # None: una transacción sin datos no se cachea (puede estar escribiéndose)
+            return denominador or None
+
+        return DENOMINADOR_CACHE.get_or_set(id_transaccion, _calcular) or {}
+
+    def calcular_matriz_cobertura(
+        self,
+        db,
         id_transaccion: str,
-        test_type: str
+        docs_por_test: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+        tests: Optional[List[str]] = None
     ) -> Dict[str, Any]:
         """
-        Calcula la cobertura de screening para un test específico
-        
+        Cobertura de screening de todos los tests en un único indicador (centro × test)
+
         Args:
+            db: Conexión a MongoDB
             id_transaccion: ID de la transacción
-            test_type: Tipo de test (FRAIL, MNA, BARTHEL, etc.)
-            
+            docs_por_test: Documentos ya leídos; si se pasan no se consulta MongoDB
+            tests: Tests a incluir (por defecto, todos los configurados)
+
         Returns:
-            Indicador de cobertura
+            Indicador con un item por centro (cobertura media de sus tests) y
+            "matriz" alineada con los items: tests, id_codes, titulos,
+            valores y evaluados (None si el centro no tiene datos del test)
         """
         try:
-            col_comorb = self.db["comorbilidad"]
-            
-            # Obtener datos del test
-            docs = list(col_comorb.find(
-                {
-                    "id_transaccion": id_transaccion,
-                    "test_type": test_type
-                },
-                {"_id": 0}
-            ))
-            
-            if not docs:
+            if docs_por_test is None:
+                docs_por_test = self.obtener_documentos_comorbilidad(db, id_transaccion)
+            denominador = self.denominador_centros(db, id_transaccion, docs_por_test)
+            tests = [t for t in (tests if tests is not None else self.reglas.tests_cobertura) if docs_por_test.get(t)]
+            centros = sorted(c for c, n in denominador.items() if n > 0)
+            if not tests or not centros:
                 return {}
-            
-            # Calcular cobertura
-            id_code = f"COMORB_COBERTURA_{test_type}"
-            ind_config = self.indicadores_config.get(id_code, {})
-            
-            indicador = {
-                "id_code": id_code,
-                "titulo": ind_config.get("titulo", f"Cobertura screening {test_type}"),
-                "categoria": ind_config.get("categoria", "Comorbilidad - Cobertura Screening"),
-                "objetivo": ind_config.get("objetivo", ""),
+
+            pos_centro = {c: i for i, c in enumerate(centros)}
+            evaluados = np.full((len(centros), len(tests)), np.nan)
+            for k, test_type in enumerate(tests):
+                for doc in docs_por_test[test_type]:
+                    centro = doc.get("centro") or doc.get("base", {}).get("nombre") or "Centro"
+                    prevalentes = (doc.get("resultados") or {}).get("prevalentes") or {}
+                    if centro in pos_centro and prevalentes.get("pacientes_evaluados") is not None:
+                        evaluados[pos_centro[centro], k] = prevalentes["pacientes_evaluados"]
+
+            totales = np.array([denominador[c] for c in centros], dtype=float)
+            valores = evaluados / totales[:, None] * 100
+            # Cobertura media del centro sobre los tests que tiene evaluados
+            n_tests = (~np.isnan(valores)).sum(axis=1)
+            medias = np.where(n_tests > 0, np.nansum(valores, axis=1) / np.maximum(n_tests, 1), np.nan)
+
+            cfg = self.reglas.cobertura_matriz
+            configs = [self.reglas.cobertura.get(t, {}) for t in tests]
+
+            def _celdas(m):
+                return [[None if np.isnan(v) else float(v) for v in fila] for fila in m]
+
+            return {
+                "id_code": cfg.get("id_code", "COMORB_COBERTURA"),
+                "titulo": cfg.get("titulo", "Cobertura de screening por centro y test"),
+                "categoria": cfg.get("categoria", "Comorbilidad - Cobertura Screening"),
+                "objetivo": cfg.get("objetivo", ""),
                 "unidad": "%",
-                "items": []
-            }
-            
-            for doc in docs:
-                centro = doc.get("centro", "Centro")
-                resultados = doc.get("resultados", {})
-                prevalentes = resultados.get("prevalentes", {})
-                
-                total_pacientes = prevalentes.get("total_pacientes", 0)
-                pacientes_con_test = prevalentes.get("pacientes_evaluados", 0)
-                
-                if total_pacientes > 0:
-                    cobertura = (pacientes_con_test / total_pacientes) * 100
-                    
-                    indicador["items"].append({
-                        "centro": centro,
+                "items": [
+                    {
+                        "centro": c,
                         "region": None,
                         "centro_id": None,
-                        "valor": cobertura,
-                        "valor_num": cobertura,
-                        "pacientes": total_pacientes
-                    })
-            
-            return indicador
-            
+                        "valor": None if np.isnan(m) else float(m),
+                        "valor_num": None if np.isnan(m) else float(m),
+                        "pacientes": int(n),
+                    }
+                    for c, m, n in zip(centros, medias, totales)
+                ],
+                "matriz": {
+                    "tests": tests,
+                    "id_codes": [c.get("id_code", f"COMORB_COBERTURA_{t}") for c, t in zip(configs, tests)],
+                    "titulos": [c.get("titulo", f"Cobertura screening {t}") for c, t in zip(configs, tests)],
+                    "valores": _celdas(valores),
+                    "evaluados": _celdas(evaluados),
+                },
+            }
+
         except Exception as e:
             print(f"Error calculando cobertura: {e}")
             return {}
 
 
-def obtener_indicadores_comorbilidad(db, id_transaccion: str) -> List[Dict[str, Any]]:
+@lru_cache(maxsize=1)
+def procesador() -> ComorbilityProcessor:
+    """Procesador compartido (las reglas se compilan una sola vez)"""
+    return ComorbilityProcessor()
+
+
+# =========================
+# MOTOR DE UMBRALES SOBRE RESPUESTAS INDIVIDUALES
+# =========================
+def _fecha_de_ordinal(fecha: int) -> datetime:
+    return datetime(fecha // 10000, fecha // 100 % 100, fecha % 100)
+
+
+def _dias_periodo(fecha_inicio: int, fecha_fin: int) -> List[str]:
+    """Días del periodo (AAAAMMDD) en el formato de metadata.fecha_insercion (DD-MM-YYYY)."""
+    dia, fin = _fecha_de_ordinal(fecha_inicio), _fecha_de_ordinal(fecha_fin)
+    dias = []
+    while dia <= fin:
+        dias.append(dia.strftime("%d-%m-%Y"))
+        dia += timedelta(days=1)
+    return dias
+
+
+def _fecha_ordinal(valor: Any) -> Optional[int]:
+    """Fecha como entero AAAAMMDD (acepta DD-MM-YYYY, YYYY-MM-DD[...] y date/datetime)."""
+    if valor is None:
+        return None
+    if isinstance(valor, (date, datetime)):
+        return valor.year * 10000 + valor.month * 100 + valor.day
+    s = str(valor).strip()
+    try:
+        if len(s) >= 10 and s[2] == "-" and s[5] == "-":
+            return int(s[6:10]) * 10000 + int(s[3:5]) * 100 + int(s[0:2])
+        if len(s) >= 10 and s[4] == "-" and s[7] == "-":
+            return int(s[0:4]) * 10000 + int(s[5:7]) * 100 + int(s[8:10])
+    except ValueError:
+        return None
+    return None
+
+
+def columnas_respuestas(
+    respuestas: Iterable[Dict[str, Any]],
+    reglas: Optional[ReglasComorbilidad] = None,
+    fecha_fin: Optional[int] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Extrae de las respuestas (test_responses) columnas alineadas:
+    "test" (índice en reglas.tests), "paciente", "centro", "fecha" (AAAAMMDD)
+    y "puntuacion". Descarta respuestas de tests sin reglas, sin paciente,
+    sin fecha válida (o posterior a fecha_fin) o sin puntuación numérica.
+    """
+    reglas = reglas or cargar_reglas()
+    tests_idx = {t: i for i, t in enumerate(reglas.tests)}
+    form_idx = {f: tests_idx[t] for f, t in reglas.form_ids.items()}
+    # Pocas fechas distintas: se parsean una vez cada una
+    fechas_vistas: Dict[Any, Optional[int]] = {}
+    test, paciente, centro, fecha, punt = [], [], [], [], []
+    for r in respuestas:
+        md = r.get("metadata") or {}
+        t = form_idx.get(md.get("form_id"))
+        nreg = md.get("NREGGEN")
+        if t is None or not nreg:
+            continue
+        fecha_raw = md.get("fecha_insercion")
+        try:
+            f = fechas_vistas[fecha_raw]
+        except (KeyError, TypeError):
+            f = _fecha_ordinal(fecha_raw)
+            if isinstance(fecha_raw, str):
+                fechas_vistas[fecha_raw] = f
+        if f is None or (fecha_fin is not None and f > fecha_fin):
+            continue
+        try:
+            p = float(r.get("puntuacion"))
+        except (TypeError, ValueError):
+            continue
+        test.append(t)
+        paciente.append(str(nreg))
+        centro.append(md.get("centro") or "Centro")
+        fecha.append(f)
+        punt.append(p)
+
+    return {
+        "test": np.asarray(test, dtype=np.int64),
+        "paciente": np.asarray(paciente, dtype=object),
+        "centro": np.asarray(centro, dtype=object),
+        "fecha": np.asarray(fecha, dtype=np.int64),
+        "puntuacion": np.asarray(punt, dtype=float),
+    }
+
+
+def calcular_comorbilidad_respuestas(
+    respuestas: Iterable[Dict[str, Any]],
+    fecha_inicio: int,
+    fecha_fin: int,
+    reglas: Optional[ReglasComorbilidad] = None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Incidentes y prevalentes por (test, centro) en una pasada vectorizada
+    
+    - Prevalente: paciente con algún test en el periodo; se usa su última puntuación.
+    - Incidente: paciente cuya primera evaluación histórica del test cae en el periodo;
+      se usa esa primera puntuación.
+    
+    Args:
+        respuestas: Documentos de test_responses (metadata + puntuacion)
+        fecha_inicio: Inicio del periodo (AAAAMMDD)
+        fecha_fin: Fin del periodo (AAAAMMDD)
+        reglas: Reglas compiladas (por defecto cargar_reglas())
+    """
+    reglas = reglas or cargar_reglas()
+    tests_idx = {t: i for i, t in enumerate(reglas.tests)}
+    cols = columnas_respuestas(respuestas, reglas, fecha_fin)
+    if not len(cols["test"]):
+        return {}
+
+    test, fecha, punt = cols["test"], cols["fecha"], cols["puntuacion"]
+    _, pac_idx = np.unique(cols["paciente"], return_inverse=True)
+    centros, cen_idx = np.unique(cols["centro"], return_inverse=True)
+    validos = ~np.isnan(punt)
+
+    # Orden (test, paciente, fecha): grupos contiguos por (test, paciente)
+    orden = np.lexsort((fecha, pac_idx, test))
+    orden = orden[validos[orden]]
+    clave = test[orden] * (pac_idx.max() + 1) + pac_idx[orden]
+    es_primero = np.r_[True, clave[1:] != clave[:-1]]
+    primeras = orden[es_primero]
+
+    en_periodo = orden[fecha[orden] >= fecha_inicio]
+    clave_p = test[en_periodo] * (pac_idx.max() + 1) + pac_idx[en_periodo]
+    es_ultimo = np.r_[clave_p[1:] != clave_p[:-1], True] if len(clave_p) else np.zeros(0, dtype=bool)
+
+    filas_poblacion = {
+        "incidentes": primeras[fecha[primeras] >= fecha_inicio],
+        "prevalentes": en_periodo[es_ultimo],
+    }
+
+    n_cen = len(centros)
+    tam = len(reglas.tests) * n_cen
+
+    def _agregar(poblacion: str) -> Dict[str, Any]:
+        filas = filas_poblacion[poblacion]
+        celda = test[filas] * n_cen + cen_idx[filas]
+        positivos = {}
+        # Cada regla de la población evalúa su predicado compilado sobre las filas de su test
+        for regla in reglas.reglas_porcentaje(poblacion):
+            sel = test[filas] == tests_idx[regla.test]
+            positivos[regla.id_code] = np.bincount(
+                celda[sel], weights=regla.predicado(punt[filas][sel]), minlength=tam
+            )
+        return {
+            "total_pacientes": np.bincount(celda, minlength=tam),
+            "suma_puntuaciones": np.bincount(celda, weights=punt[filas], minlength=tam),
+            "positivos_por_regla": positivos,
+        }
+
+    agregados = {pob: _agregar(pob) for pob in filas_poblacion}
+
+    grupos = []
+    for t, i in tests_idx.items():
+        for j, c in enumerate(centros):
+            k = i * n_cen + j
+            grupo = {"test_type": t, "centro": c}
+            for pob, ag in agregados.items():
+                grupo[pob] = {
+                    "total_pacientes": ag["total_pacientes"][k],
+                    "suma_puntuaciones": ag["suma_puntuaciones"][k],
+                    "positivos_por_regla": {
+                        r.id_code: ag["positivos_por_regla"][r.id_code][k]
+                        for r in reglas.por_test[t] if r.id_code in ag["positivos_por_regla"]
+                    },
+                }
+            grupos.append(grupo)
+    return documentos_desde_grupos(grupos, reglas)
+
+
+def documentos_desde_grupos(
+    grupos: Iterable[Dict[str, Any]],
+    reglas: Optional[ReglasComorbilidad] = None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Normaliza los grupos (test, centro) de calcular_comorbilidad_respuestas al
+    formato de la colección comorbilidad.
+    """
+    reglas = reglas or cargar_reglas()
+    por_clave: Dict[tuple, Dict[str, Any]] = {}
+
+    def _doc(test_type, centro):
+        clave = (test_type, centro)
+        if clave not in por_clave:
+            por_clave[clave] = {"test_type": test_type, "centro": centro, "resultados": {}}
+        return por_clave[clave]
+
+    def _bloque(datos, test_type):
+        total = int(datos.get("total_pacientes") or 0)
+        positivos = datos.get("positivos_por_regla") or {}
+        # Solo las reglas del propio test
+        positivos = {r.id_code: int(positivos[r.id_code])
+                     for r in reglas.por_test.get(test_type, []) if r.id_code in positivos}
+        return {
+            "total_pacientes": total,
+            "pacientes_evaluados": total,
+            "pacientes_positivos": next(iter(positivos.values()), 0),
+            "positivos_por_regla": positivos,
+            "suma_puntuaciones": float(datos.get("suma_puntuaciones") or 0),
+        }
+
+    for g in grupos:
+        for poblacion in ("incidentes", "prevalentes"):
+            if g[poblacion]["total_pacientes"]:
+                _doc(g["test_type"], g["centro"])["resultados"][poblacion] = _bloque(g[poblacion], g["test_type"])
+
+    por_test: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in por_clave.values():
+        por_test.setdefault(doc["test_type"], []).append(doc)
+    return por_test
+
+
+def obtener_indicadores_comorbilidad(
+    db,
+    id_transaccion: str,
+    tests_cobertura: Optional[List[str]] = None,
+    fecha_inicio: Any = None,
+    fecha_fin: Any = None
+) -> List[Dict[str, Any]]:
     """
     Función principal para obtener todos los indicadores de comorbilidad
     
     Args:
         db: Conexión a MongoDB
         id_transaccion: ID de la transacción
+        tests_cobertura: Tests de la matriz de cobertura (por defecto, todos
+            los configurados)
+        fecha_inicio: Periodo para calcular desde test_responses si la
+            transacción no tiene datos agregados en comorbilidad
+        fecha_fin: Fin de ese periodo
         
     Returns:
         Lista de indicadores de comorbilidad procesados
     """
-    processor = ComorbilityProcessor(db)
+    processor = procesador()
+    
+    # Una sola lectura: alimenta incidentes/prevalentes y la matriz de cobertura
+    docs_por_test = processor.obtener_documentos_comorbilidad(db, id_transaccion)
+    if not docs_por_test and fecha_inicio and fecha_fin:
+        try:
+            docs_por_test = processor.calcular_desde_respuestas(db, fecha_inicio, fecha_fin)
+        except Exception as e:
+            print(f"Error calculando comorbilidad desde respuestas: {e}")
+            docs_por_test = {}
+        # Sin censo de pacientes del centro no hay cobertura real
+        tests_cobertura = []
     
     # Obtener indicadores básicos
-    indicadores = processor.obtener_datos_comorbilidad(id_transaccion)
+    indicadores = processor.obtener_datos_comorbilidad(db, id_transaccion, docs_por_test)
     
-    # Agregar indicadores de cobertura
-    for test_type in ["FRAIL", "MNA", "BARTHEL"]:
-        ind_cobertura = processor.calcular_cobertura_screening(id_transaccion, test_type)
+    # Cobertura de todos los tests en un único indicador centro × test
+    if tests_cobertura is None or tests_cobertura:
+        ind_cobertura = processor.calcular_matriz_cobertura(db, id_transaccion, docs_por_test, tests_cobertura)
         if ind_cobertura:
             indicadores.append(ind_cobertura)
     
     return indicadores
+
+
+# =========================
+# CÁLCULO DESDE RESPUESTAS EN SEGUNDO PLANO
+# =========================
+def _calcular_y_cachear(db, fecha_inicio: Any, fecha_fin: Any, clave: tuple) -> Dict[str, List[Dict[str, Any]]]:
+    t0 = time.perf_counter()
+    try:
+        docs_por_test = procesador().calcular_desde_respuestas(db, fecha_inicio, fecha_fin)
+        RESPUESTAS_CACHE.set(clave, docs_por_test)
+        print(f"🧮 Comorbilidad desde respuestas {fecha_inicio} - {fecha_fin}: "
+              f"{sum(len(v) for v in docs_por_test.values())} grupos en {time.perf_counter() - t0:.2f}s")
+        return docs_por_test
+    except Exception as e:
+        print(f"⚠️ Error calculando comorbilidad desde respuestas ({fecha_inicio} - {fecha_fin}): {e}")
+        raise
+    finally:
+        with _CALCULOS_LOCK:
+            _CALCULOS_RESPUESTAS.pop(clave, None)
+
+
+def calcular_respuestas_en_fondo(db, fecha_inicio: Any, fecha_fin: Any) -> Future:
+    """
+    Lanza (o reutiliza, si ya está en curso) el cálculo del periodo desde
+    test_responses en el hilo dedicado; el resultado queda en RESPUESTAS_CACHE
+    """
+    clave = (_fecha_ordinal(fecha_inicio), _fecha_ordinal(fecha_fin))
+    with _CALCULOS_LOCK:
+        futuro = _CALCULOS_RESPUESTAS.get(clave)
+        if futuro is None:
+            futuro = _EJECUTOR_RESPUESTAS.submit(_calcular_y_cachear, db, fecha_inicio, fecha_fin, clave)
+            _CALCULOS_RESPUESTAS[clave] = futuro
+    return futuro
+
+
+def indicadores_desde_respuestas(
+    db,
+    fecha_inicio: Any,
+    fecha_fin: Any,
+    espera: float = COMORB_RESPUESTAS_ESPERA
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Indicadores de comorbilidad del periodo calculados desde test_responses
+    (sin matriz de cobertura: no hay censo de pacientes del centro)
+    
+    Args:
+        db: Conexión a MongoDB
+        fecha_inicio: Inicio del periodo
+        fecha_fin: Fin del periodo
+        espera: Segundos que se espera a un cálculo en curso
+        
+    Returns:
+        Lista de indicadores ([] si no hay datos o el cálculo falló) o None si
+        el cálculo sigue en curso
+    """
+    clave = (_fecha_ordinal(fecha_inicio), _fecha_ordinal(fecha_fin))
+    if None in clave:
+        return []
+    docs_por_test = RESPUESTAS_CACHE.get(clave)
+    if docs_por_test is None:
+        try:
+            docs_por_test = calcular_respuestas_en_fondo(db, fecha_inicio, fecha_fin).result(timeout=max(espera, 0))
+        except FuturesTimeoutError:
+            return None
+        except Exception:
+            return []
+    if not docs_por_test:
+        return []
+    return procesador().obtener_datos_comorbilidad(db, f"{fecha_inicio} - {fecha_fin}", docs_por_test)
@@ -0,0 +1,216 @@
+"""
+Agregados estadísticos del dataset de informe (por región y de red)
+calculados de forma vectorizada con NumPy sobre todos los indicadores
+"""
+
+from typing import Any, Dict, List
+
+import numpy as np
+
+from registros_utils import Indicador
+
+
+SIN_REGION = "(Sin región)"
+
+
+def aplanar_items(indicadores: List[Indicador]) -> Dict[str, np.ndarray]:
+    """
+    Aplana los items de todos los indicadores en columnas alineadas
+
+    Returns:
+        Dict con "indicador" (índice del indicador), "centro", "region",
+        "valor" y "pacientes" (float, NaN si falta)
+    """
+    ind_idx, centros, regiones, valores, pacientes = [], [], [], [], []
+    for k, ind in enumerate(indicadores):
+        for it in ind.items:
+            ind_idx.append(k)
+            centros.append(it.centro)
+            regiones.append(it.region or SIN_REGION)
+            valores.append(np.nan if it.valor_num is None else it.valor_num)
+            pacientes.append(np.nan if it.pacientes is None else it.pacientes)
+
+    return {
+        "indicador": np.asarray(ind_idx, dtype=np.int64),
+        "centro": np.asarray(centros, dtype=object),
+        "region": np.asarray(regiones, dtype=object),
+        "valor": np.asarray(valores, dtype=float),
+        "pacientes": np.asarray(pacientes, dtype=float),
+    }
+
+
+def calcular_rollup_regiones(indicadores: List[Indicador]) -> Dict[str, Any]:
+    """
+    Calcula de una vez, para todos los indicadores y regiones:
+    nº de centros, suma, media, pacientes y media ponderada por pacientes
+
+    Returns:
+        Dict con "regiones" (ejes) y matrices (indicador × región)
+    """
+    cols = aplanar_items(indicadores)
+    n_ind = len(indicadores)
+
+    regiones = sorted(set(cols["region"].tolist()), key=lambda r: (r == SIN_REGION, r))
+    n_reg = len(regiones)
+    vacio = np.zeros((n_ind, n_reg))
+    if not len(cols["valor"]) or not n_reg:
+        return {"regiones": regiones, "n_centros": vacio, "suma": vacio, "media": vacio * np.nan,
+                "pacientes": vacio, "media_ponderada": vacio * np.nan}
+
+    pos_region = {r: j for j, r in enumerate(regiones)}
+    reg_idx = np.fromiter((pos_region[r] for r in cols["region"]), dtype=np.int64, count=len(cols["region"]))
+
+    v = cols["valor"]
+    p = cols["pacientes"]
+    validos = ~np.isnan(v)
+    con_peso = validos & ~np.isnan(p) & (p > 0)
+
+    # Celda plana (indicador, región) -> bincount sobre n_ind * n_reg
+    celda = cols["indicador"] * n_reg + reg_idx
+    tam = n_ind * n_reg
+
+    def _sum(mascara, pesos):
+        return np.bincount(celda[mascara], weights=pesos[mascara], minlength=tam).reshape(n_ind, n_reg)
+
+    n_centros = np.bincount(celda[validos], minlength=tam).reshape(n_ind, n_reg).astype(float)
+    suma = _sum(validos, v)
+    pac = _sum(con_peso, p)
+    suma_pond = _sum(con_peso, v * np.nan_to_num(p))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        media = np.where(n_centros > 0, suma / n_centros, np.nan)
+        media_pond = np.where(pac > 0, suma_pond / pac, np.nan)
+
+    return {
+        "regiones": regiones,
+        "n_centros": n_centros,
+        "suma": suma,
+        "media": media,
+        "pacientes": pac,
+        "media_ponderada": media_pond,
+    }
+
+
+def filas_rollup_indicador(rollup: Dict[str, Any], k: int) -> List[Dict[str, Any]]:
+    """Filas (una por región con datos) del rollup para el indicador k."""
+    filas = []
+    for j, region in enumerate(rollup["regiones"]):
+        n = int(rollup["n_centros"][k, j])
+        if n == 0:
+            continue
+        filas.append({
+            "region": region,
+            "n_centros": n,
+            "suma": float(rollup["suma"][k, j]),
+            "media": float(rollup["media"][k, j]),
+            "pacientes": float(rollup["pacientes"][k, j]),
+            "media_ponderada": None if np.isnan(rollup["media_ponderada"][k, j]) else float(rollup["media_ponderada"][k, j]),
+        })
+    return filas
+
+
+def calcular_estadisticas_red(indicadores: List[Indicador], factor_iqr: float = 1.5) -> Dict[str, Any]:
+    """
+    Estadísticos de red por indicador en una única pasada vectorizada:
+    media, media ponderada por pacientes, mediana, cuartiles, mín/máx,
+    desviación típica y marcas de valor atípico (criterio de Tukey)
+
+    Args:
+        indicadores: Lista de indicadores del dataset
+        factor_iqr: Multiplicador del rango intercuartílico para atípicos
+
+    Returns:
+        Dict con arrays (uno por indicador) y "atipicos": lista (por indicador)
+        de arrays booleanos alineados con sus items
+    """
+    cols = aplanar_items(indicadores)
+    n_ind = len(indicadores)
+    ind = cols["indicador"]
+    v = cols["valor"]
+    p = cols["pacientes"]
+    validos = ~np.isnan(v)
+
+    n = np.bincount(ind[validos], minlength=n_ind)
+    suma = np.bincount(ind[validos], weights=v[validos], minlength=n_ind)
+    con_peso = validos & ~np.isnan(p) & (p > 0)
+    pac_validos = ~np.isnan(p) & (p > 0)
+    pacientes = np.bincount(ind[pac_validos], weights=p[pac_validos], minlength=n_ind)
+    pac_pond = np.bincount(ind[con_peso], weights=p[con_peso], minlength=n_ind)
+    suma_pond = np.bincount(ind[con_peso], weights=(v * np.nan_to_num(p))[con_peso], minlength=n_ind)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        media = np.where(n > 0, suma / np.maximum(n, 1), np.nan)
+        media_pond = np.where(pac_pond > 0, suma_pond / np.where(pac_pond > 0, pac_pond, 1), np.nan)
+
+    # Desviación típica muestral (ddof=1)
+    desv = (v - media[ind]) ** 2
+    ss = np.bincount(ind[validos], weights=desv[validos], minlength=n_ind)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.where(n > 1, np.sqrt(ss / np.maximum(n - 1, 1)), np.nan)
+
+    # Cuantiles por grupo: orden (indicador, valor) y acceso por desplazamiento
+    idx_validos = np.flatnonzero(validos)
+    orden = idx_validos[np.lexsort((v[idx_validos], ind[idx_validos]))]
+    sv = v[orden]
+    inicio = np.concatenate(([0], np.cumsum(n)[:-1]))
+    hay = n > 0
+
+    def _cuantil(q: float) -> np.ndarray:
+        if not len(sv):
+            return np.full(n_ind, np.nan)
+        pos = inicio + q * np.maximum(n - 1, 0)
+        lo = np.clip(np.floor(pos).astype(np.int64), 0, len(sv) - 1)
+        hi = np.clip(np.ceil(pos).astype(np.int64), 0, len(sv) - 1)
+        val = sv[lo] + (pos - np.floor(pos)) * (sv[hi] - sv[lo])
+        return np.where(hay, val, np.nan)
+
+    q1 = _cuantil(0.25)
+    mediana = _cuantil(0.5)
+    q3 = _cuantil(0.75)
+    minimo = _cuantil(0.0)
+    maximo = _cuantil(1.0)
+
+    iqr = q3 - q1
+    lim_inf = q1 - factor_iqr * iqr
+    lim_sup = q3 + factor_iqr * iqr
+    with np.errstate(invalid="ignore"):
+        atipico = validos & ((v < lim_inf[ind]) | (v > lim_sup[ind]))
+
+    # Reparte las marcas por indicador (los items se aplanan en orden)
+    n_items = np.bincount(ind, minlength=n_ind)
+    atipicos = np.split(atipico, np.cumsum(n_items)[:-1]) if n_ind else []
+
+    return {
+        "n": n,
+        "media": media,
+        "media_ponderada": media_pond,
+        "mediana": mediana,
+        "q1": q1,
+        "q3": q3,
+        "min": minimo,
+        "max": maximo,
+        "std": std,
+        "suma": suma,
+        "pacientes": pacientes,
+        "atipicos": atipicos,
+    }
+
+
+def estadisticas_indicador(estadisticas: Dict[str, Any], k: int, ponderado: bool = True) -> Dict[str, Any]:
+    """
+    Estadísticos del indicador k como dict de floats (None si no hay dato)
+
+    "referencia" es la media ponderada por pacientes (o la media simple si
+    ponderado=False o no hay pacientes informados).
+    """
+    def _f(nombre):
+        x = estadisticas[nombre][k]
+        return None if np.isnan(x) else float(x)
+
+    out = {nombre: _f(nombre) for nombre in
+           ("media", "media_ponderada", "mediana", "q1", "q3", "min", "max", "std", "suma", "pacientes")}
+    out["n"] = int(estadisticas["n"][k])
+    out["atipicos"] = estadisticas["atipicos"][k]
+    out["ponderado"] = bool(ponderado and out["media_ponderada"] is not None)
+    out["referencia"] = out["media_ponderada"] if out["ponderado"] else out["media"]
+    return out
@@ -0,0 +1,111 @@
+"""
+Prueba de estrés del renderizado de gráficas desde varios hilos
+
+Genera cientos de gráficas (barras, porcentajes, regiones, tendencias y mapa
+de calor) primero en serie y después a la vez en un ThreadPoolExecutor, y
+comprueba que cada PNG concurrente es idéntico byte a byte al serie y que el
+estilo global de matplotlib queda como estaba.
+
+Uso:
+    python estres_graficas.py [--graficas 300] [--hilos 8] [--centros 8 30 120]
+"""
+
+import argparse
+import hashlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import matplotlib
+import numpy as np
+
+import estadisticas_utils
+import graficas_utils
+import main
+from benchmark_informe import dataset_sintetico
+
+
+def _trabajos(tamanos: List[int]) -> List[Tuple[str, Callable]]:
+    """Una tanda de gráficas de cada tipo por tamaño de red."""
+    trabajos: List[Tuple[str, Callable]] = []
+    for n in tamanos:
+        dataset = dataset_sintetico(n, 2, semilla=n)
+        indicadores = dataset["indicadores"]
+        palette = main._build_center_palette(indicadores)
+        red = estadisticas_utils.calcular_estadisticas_red(indicadores)
+        rollup = estadisticas_utils.calcular_rollup_regiones(indicadores)
+
+        for i, ind in enumerate(indicadores):
+            est = estadisticas_utils.estadisticas_indicador(red, i)
+            est["centros_atipicos"] = {it.centro for it, a in zip(ind.items, est["atipicos"]) if a}
+            filas = estadisticas_utils.filas_rollup_indicador(rollup, i)
+            trabajos.append((f"{ind.id_code}-{n}", lambda ind=ind, est=est, palette=palette: main._select_chart(
+                ind.items, ind.titulo, ind.unidad, palette, est, 40, 12)))
+            trabajos.append((f"regiones-{ind.id_code}-{n}", lambda ind=ind, filas=filas, palette=palette:
+                             main._plot_comparativa_regiones(ind.items, filas, ind.titulo, ind.unidad, palette)))
+
+        periodos = [f"2024-{m:02d}" for m in range(1, 7)]
+        series = [{"centro": it.centro, "valores": list(np.linspace(1, n, 6) + k)}
+                  for k, it in enumerate(indicadores[0].items[:12])]
+        trabajos.append((f"tendencia-{n}", lambda series=series, periodos=periodos, palette=palette:
+                         main._plot_tendencia(series, periodos, np.arange(6.0), "Tendencia", "%", palette)))
+
+        items = indicadores[0].items[:10]
+        matriz = {
+            "tests": ["A", "B", "C"],
+            "valores": [[None if (r + c) % 4 == 0 else (r * 13 + c * 7) % 100 for c in range(3)]
+                        for r in range(len(items))],
+        }
+        trabajos.append((f"cobertura-{n}", lambda items=items, matriz=matriz:
+                         main._plot_heatmap_cobertura(items, matriz)))
+    return trabajos
+
+
+def _huella(func: Callable) -> str:
+    buf = func()
+    return hashlib.md5(buf.getvalue()).hexdigest() if buf is not None else ""
+
+
+def main_estres(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Estrés del renderizado concurrente de gráficas")
+    parser.add_argument("--graficas", type=int, default=300)
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--centros", type=int, nargs="+", default=[8, 30, 120])
+    args = parser.parse_args(argv)
+    # Cada gráfica del lote se dibuja de verdad (sin caché) en los hilos
+    graficas_utils.CACHE_GRAFICAS.max_entradas = 0
+
+    base = _trabajos(args.centros)
+    lote = [base[i % len(base)] for i in range(args.graficas)]
+    rc_inicial = {k: matplotlib.rcParams[k] for k in graficas_utils.ESTILO_GRAFICAS}
+
+    # Referencia en serie (una vez por gráfica distinta)
+    t0 = time.perf_counter()
+    esperadas = {nombre: _huella(func) for nombre, func in base}
+    t_serie = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.hilos) as pool:
+        obtenidas = list(pool.map(lambda trabajo: (trabajo[0], _huella(trabajo[1])), lote))
+    t_concurrente = time.perf_counter() - t0
+
+    distintas = sorted({nombre for nombre, huella in obtenidas if huella != esperadas[nombre]})
+    rc_final = {k: matplotlib.rcParams[k] for k in graficas_utils.ESTILO_GRAFICAS}
+
+    print(f"📊 {len(base)} gráficas distintas en serie: {t_serie:.2f}s "
+          f"({1000 * t_serie / len(base):.0f} ms/gráfica)")
+    print(f"🧵 {len(lote)} gráficas en {args.hilos} hilos: {t_concurrente:.2f}s "
+          f"({1000 * t_concurrente / len(lote):.0f} ms/gráfica)")
+    if rc_final != rc_inicial:
+        print("❌ El estilo global de matplotlib no se ha restaurado")
+        return 1
+    if distintas:
+        print(f"❌ {len(distintas)} gráficas difieren del render en serie: {', '.join(distintas)}")
+        return 1
+    print("✅ Todas las gráficas concurrentes son idénticas a las de serie")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_estres())
@@ -0,0 +1,148 @@
+"""
+Exportación del dataset de informe (JSON / CSV / Parquet)
+en formato tabular plano, una fila por (indicador, centro)
+"""
+
+import csv
+import json
+from io import BytesIO, StringIO
+from typing import Any, Dict, Iterable, Iterator, List
+
+from registros_utils import Indicador
+
+
+COLUMNAS_DATASET = [
+    "id_transaccion",
+    "fecha_inicio",
+    "fecha_fin",
+    "id_code",
+    "titulo",
+    "categoria",
+    "objetivo",
+    "unidad",
+    "centro",
+    "centro_id",
+    "region",
+    "color",
+    "valor",
+    "valor_num",
+    "pacientes",
+]
+
+# Columnas numéricas en Parquet (float64: pacientes puede no ser entero); el resto, texto
+COLUMNAS_NUMERICAS = ("valor_num", "pacientes")
+
+FORMATOS = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def iter_filas_dataset(dataset: Dict[str, Any], palette: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    """
+    Aplana el dataset (meta + indicadores + items) en filas,
+    enriquecidas con los metadatos de catálogo ya resueltos
+
+    Args:
+        dataset: Salida de recopilar_datos_informe
+        palette: Color por centro (misma paleta que el PDF)
+    """
+    meta = dataset.get("meta") or {}
+    indicadores: List[Indicador] = dataset.get("indicadores") or []
+    for ind in indicadores:
+        matriz = ind.matriz
+        for j, it in enumerate(ind.items):
+            fila = {
+                "id_transaccion": meta.get("id_transaccion"),
+                "fecha_inicio": meta.get("fecha_inicio"),
+                "fecha_fin": meta.get("fecha_fin"),
+                "id_code": ind.id_code,
+                "titulo": ind.titulo,
+                "categoria": ind.categoria,
+                "objetivo": ind.objetivo,
+                "unidad": ind.unidad,
+                "centro": it.centro,
+                "centro_id": it.centro_id,
+                "region": it.region,
+                "color": palette.get(it.centro),
+                "valor": it.valor,
+                "valor_num": it.valor_num,
+                "pacientes": it.pacientes,
+            }
+            if not matriz:
+                yield fila
+                continue
+            # Indicador centro × test: una fila por celda, con el id_code de cada test
+            for id_code, titulo, valor in zip(matriz["id_codes"], matriz["titulos"], matriz["valores"][j]):
+                if valor is not None:
+                    yield {**fila, "id_code": id_code, "titulo": titulo, "valor": valor, "valor_num": valor}
+
+
+def iter_json(filas: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """Array JSON emitido fila a fila (sin materializar la lista completa)."""
+    yield b"["
+    primera = True
+    for fila in filas:
+        yield (b"" if primera else b",") + json.dumps(fila, ensure_ascii=False, default=str).encode("utf-8")
+        primera = False
+    yield b"]"
+
+
+def iter_csv(filas: Iterable[Dict[str, Any]], columnas: List[str] = COLUMNAS_DATASET) -> Iterator[bytes]:
+    """CSV (separador ';' para Excel en español) emitido fila a fila."""
+    buf = StringIO()
+    writer = csv.DictWriter(buf, fieldnames=columnas, delimiter=";", extrasaction="ignore")
+
+    # BOM para que Excel detecte UTF-8
+    buf.write("\ufeff")
+    writer.writeheader()
+    yield buf.getvalue().encode("utf-8")
+
+    for fila in filas:
+        buf.seek(0)
+        buf.truncate(0)
+        writer.writerow(fila)
+        yield buf.getvalue().encode("utf-8")
+
+
+def parquet_bytes(filas: Iterable[Dict[str, Any]], columnas: List[str] = COLUMNAS_DATASET,
+                  filas_por_grupo: int = 5000) -> bytes:
+    """
+    Serializa a Parquet por grupos de filas (requiere pyarrow).
+    Parquet escribe el índice al final del fichero, así que el resultado
+    se entrega completo; la memoria de trabajo se limita a un grupo.
+
+    Raises:
+        ImportError: Si pyarrow no está instalado
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (c, pa.float64() if c in COLUMNAS_NUMERICAS else pa.string()) for c in columnas
+    ])
+    out = BytesIO()
+    writer = pq.ParquetWriter(out, schema)
+    try:
+        grupo: List[Dict[str, Any]] = []
+        for fila in filas:
+            grupo.append(fila)
+            if len(grupo) >= filas_por_grupo:
+                writer.write_table(_tabla_arrow(pa, grupo, schema))
+                grupo = []
+        if grupo:
+            writer.write_table(_tabla_arrow(pa, grupo, schema))
+    finally:
+        writer.close()
+    return out.getvalue()
+
+
+def _tabla_arrow(pa, grupo: List[Dict[str, Any]], schema):
+    columnas = {}
+    for campo in schema:
+        if campo.name in COLUMNAS_NUMERICAS:
+            columnas[campo.name] = [None if f.get(campo.name) is None else float(f.get(campo.name)) for f in grupo]
+        else:
+            columnas[campo.name] = [None if f.get(campo.name) is None else str(f.get(campo.name)) for f in grupo]
+    return pa.table(columnas, schema=schema)
@@ -0,0 +1,179 @@
+"""
+Infraestructura de gráficas sin estado global de pyplot: figuras
+matplotlib.figure.Figure con lienzo Agg propio y estilo aplicado solo
+mientras se dibuja, de modo que varias gráficas pueden generarse a la vez
+desde distintos hilos. Los PNG se guardan en una caché por contenido de las
+entradas: un informe reintentado (o cancelado a medias) no repite gráficas
+"""
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from cache_utils import CacheLRU
+
+
+# Estilo moderno de las gráficas del informe (antes rcParams globales en main)
+ESTILO_GRAFICAS: Dict[str, Any] = {
+    "font.family": "sans-serif",
+    "font.sans-serif": ["DejaVu Sans", "Arial", "Helvetica", "sans-serif"],
+    "axes.spines.top": False,
+    "axes.spines.right": False,
+    "axes.spines.left": False,  # Opcional: quitar eje Y para barras horizontales
+    "axes.grid": True,
+    "grid.alpha": 0.3,
+    "grid.linestyle": "--",
+    "axes.titlesize": 14,
+    "axes.titleweight": "bold",
+    "axes.labelsize": 11,
+}
+
+DPI_GRAFICAS = 200
+
+# Canal de imagen compacto: se renderiza a PPI_GRAFICAS sobre el ancho máximo
+# con el que se imprime una gráfica (no sobre el ancho de la figura, ~10") y se
+# cuantiza a PNG con paleta. GRAFICAS_COMPACTAS=0 vuelve a dpi=200 RGBA.
+GRAFICAS_COMPACTAS = os.getenv("GRAFICAS_COMPACTAS", "1") != "0"
+PPI_GRAFICAS = int(os.getenv("PPI_GRAFICAS", "200"))
+ANCHO_IMPRESION_CM = 16.5
+COLORES_PALETA = 256
+
+# PNG ya renderizados; GRAFICAS_CACHE_MAX=0 la desactiva
+CACHE_GRAFICAS = CacheLRU(
+    max_entradas=int(os.getenv("GRAFICAS_CACHE_MAX", "256")),
+    ttl_segundos=float(os.getenv("GRAFICAS_CACHE_TTL", "1800")),
+)
+
+# matplotlib solo tiene un rcParams por proceso: el estilo se aplica al entrar
+# el primer hilo y se restaura al salir el último (contador protegido por lock),
+# así ningún hilo ve el estilo retirado a mitad de dibujo
+_lock_estilo = threading.Lock()
+_hilos_en_estilo = 0
+_rc_previo: Dict[str, Any] = {}
+
+
+@contextmanager
+def estilo_graficas() -> Iterator[None]:
+    """Contexto de estilo de las gráficas del informe (reentrante y seguro entre hilos)."""
+    global _hilos_en_estilo, _rc_previo
+    with _lock_estilo:
+        if _hilos_en_estilo == 0:
+            _rc_previo = {k: matplotlib.rcParams[k] for k in ESTILO_GRAFICAS}
+            matplotlib.rcParams.update(ESTILO_GRAFICAS)
+        _hilos_en_estilo += 1
+    try:
+        yield
+    finally:
+        with _lock_estilo:
+            _hilos_en_estilo -= 1
+            if _hilos_en_estilo == 0:
+                matplotlib.rcParams.update(_rc_previo)
+
+
+def con_estilo(func: Callable) -> Callable:
+    """Decorador: ejecuta la función de gráfica dentro de estilo_graficas()."""
+    @wraps(func)
+    def envoltura(*args, **kwargs):
+        with estilo_graficas():
+            return func(*args, **kwargs)
+    return envoltura
+
+
+def nueva_figura(figsize: Tuple[float, float], nrows: int = 1, ncols: int = 1,
+                 **subplot_kw) -> Tuple[Figure, Any]:
+    """
+    Figura independiente con su lienzo Agg (no pasa por el gestor de pyplot).
+    Debe crearse dentro de estilo_graficas() para heredar el estilo.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.subplots(nrows, ncols, **subplot_kw)
+
+
+def dpi_efectivo(fig: Figure, ancho_cm: float = ANCHO_IMPRESION_CM, ppi: int = PPI_GRAFICAS) -> float:
+    """DPI que da `ppi` píxeles por pulgada cuando la figura se imprime a ancho_cm."""
+    return ppi * (ancho_cm / 2.54) / fig.get_figwidth()
+
+
+def _png_paleta(buf: BytesIO) -> BytesIO:
+    """Re-codifica un PNG RGBA opaco como PNG con paleta (sin tramado)."""
+    img = Image.open(buf).convert("RGB")
+    out = BytesIO()
+    img.quantize(COLORES_PALETA, dither=Image.Dither.NONE).save(out, format="PNG")
+    out.seek(0)
+    return out
+
+
+def figura_a_png(fig: Figure, dpi: Optional[float] = None) -> BytesIO:
+    """Ajusta márgenes y serializa la figura a PNG (el buffer queda al inicio)."""
+    fig.tight_layout()
+    buf = BytesIO()
+    if dpi is None:
+        dpi = dpi_efectivo(fig) if GRAFICAS_COMPACTAS else DPI_GRAFICAS
+    fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight")
+    buf.seek(0)
+    return _png_paleta(buf) if GRAFICAS_COMPACTAS else buf
+
+
+# =========================
+# CACHÉ DE GRÁFICAS
+# =========================
+def _canonico(obj: Any) -> Any:
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(map(str, obj))
+    campos = getattr(type(obj), "__slots__", None)
+    if campos:
+        # Registros de registros_utils: misma huella que el dict con esos campos
+        return {c: getattr(obj, c) for c in campos}
+    raise TypeError(type(obj).__name__)
+
+
+def huella_entradas(*args, **kwargs) -> str:
+    """
+    SHA-1 de los argumentos de una gráfica en JSON canónico (claves ordenadas,
+    conjuntos ordenados, arrays como listas).
+
+    Raises:
+        TypeError: Si algún argumento no tiene representación canónica
+    """
+    texto = json.dumps([args, kwargs], sort_keys=True, default=_canonico)
+    return hashlib.sha1(texto.encode("utf-8")).hexdigest()
+
+
+def cacheada(func: Callable) -> Callable:
+    """
+    Decorador para funciones que devuelven un PNG (BytesIO o None): el
+    resultado se guarda en CACHE_GRAFICAS por nombre de función, modo de
+    imagen y huella de las entradas, y cada llamada recibe su propio BytesIO.
+    """
+    @wraps(func)
+    def envoltura(*args, **kwargs):
+        if CACHE_GRAFICAS.max_entradas <= 0:
+            return func(*args, **kwargs)
+        try:
+            clave = (func.__qualname__, GRAFICAS_COMPACTAS, PPI_GRAFICAS, huella_entradas(*args, **kwargs))
+        except (TypeError, ValueError):
+            return func(*args, **kwargs)
+
+        def _render() -> Optional[bytes]:
+            buf = func(*args, **kwargs)
+            return buf.getvalue() if buf is not None else None
+
+        png = CACHE_GRAFICAS.get_or_set(clave, _render)
+        return BytesIO(png) if png is not None else None
+    return envoltura
@@ -0,0 +1,135 @@
+"""
+Validadores HTTP (ETag / Last-Modified) y rangos de bytes para descargas de
+informes ya generados: cabeceras de caché, peticiones condicionales y
+peticiones Range sin tocar el cuerpo del PDF
+"""
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+
+# El informe de una transacción solo cambia si se regenera: el cliente puede
+# guardarlo pero debe revalidar (304 barato) antes de reutilizarlo
+CACHE_CONTROL_PDF = "private, no-cache"
+
+
+def huella_contenido(contenido: bytes) -> str:
+    """SHA-256 hexadecimal del contenido (base del ETag fuerte)."""
+    return hashlib.sha256(contenido).hexdigest()
+
+
+def etag(huella: str) -> str:
+    return f'"{huella}"'
+
+
+def _utc(fecha: datetime) -> datetime:
+    # pymongo devuelve fechas naive en UTC
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def fecha_http(fecha: datetime) -> str:
+    return format_datetime(_utc(fecha), usegmt=True)
+
+
+def cabeceras_validacion(meta: Dict[str, Any]) -> Dict[str, str]:
+    """ETag, Last-Modified y Cache-Control a partir de los metadatos del informe."""
+    cabeceras = {"ETag": etag(meta["sha256"]), "Cache-Control": CACHE_CONTROL_PDF, "Accept-Ranges": "bytes"}
+    if meta.get("generado_en"):
+        cabeceras["Last-Modified"] = fecha_http(meta["generado_en"])
+    return cabeceras
+
+
+def _coincide_etag(if_none_match: str, actual: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110 §13.1.2): lista o "*"."""
+    if if_none_match.strip() == "*":
+        return True
+    for candidata in if_none_match.split(","):
+        candidata = candidata.strip()
+        if candidata.startswith("W/"):
+            candidata = candidata[2:]
+        if candidata == actual:
+            return True
+    return False
+
+
+def no_modificado(cabeceras_peticion: Mapping[str, str], meta: Dict[str, Any]) -> bool:
+    """
+    True si la petición condicional puede responderse con 304.
+    If-None-Match tiene prioridad; If-Modified-Since solo se evalúa sin él.
+    """
+    if_none_match = cabeceras_peticion.get("if-none-match")
+    if if_none_match is not None:
+        return _coincide_etag(if_none_match, etag(meta["sha256"]))
+
+    if_modified_since = cabeceras_peticion.get("if-modified-since")
+    if if_modified_since and meta.get("generado_en"):
+        try:
+            desde = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if desde is None:
+            return False
+        return _utc(meta["generado_en"]) <= _utc(desde)
+    return False
+
+
+def rango_solicitado(cabecera_range: Optional[str], tamano: int) -> Optional[Tuple[int, int]]:
+    """
+    Rango (inicio, fin) incluidos de una cabecera "Range: bytes=...".
+    None si no hay cabecera, no es de bytes, está mal formada o pide varios
+    rangos (se responde el recurso completo, RFC 9110 §14.2).
+
+    Raises:
+        ValueError: Si el rango no es satisfacible (-> 416)
+    """
+    if not cabecera_range:
+        return None
+    unidad, _, especificacion = cabecera_range.partition("=")
+    if unidad.strip().lower() != "bytes" or "," in especificacion:
+        return None
+    inicio_txt, guion, fin_txt = especificacion.strip().partition("-")
+    inicio_txt, fin_txt = inicio_txt.strip(), fin_txt.strip()
+    if not guion or not (inicio_txt or fin_txt) or not all(t.isdigit() for t in (inicio_txt, fin_txt) if t):
+        return None
+
+    if not inicio_txt:
+        # Sufijo: los últimos N bytes
+        sufijo = int(fin_txt)
+        if sufijo == 0:
+            raise ValueError("Rango vacío")
+        return max(0, tamano - sufijo), tamano - 1
+
+    inicio = int(inicio_txt)
+    fin = int(fin_txt) if fin_txt else tamano - 1
+    if fin_txt and fin < inicio:
+        return None
+    if inicio >= tamano:
+        raise ValueError(f"Rango fuera del recurso ({tamano} bytes)")
+    return inicio, min(fin, tamano - 1)
+
+
+def rango_vigente(cabeceras_peticion: Mapping[str, str], meta: Dict[str, Any]) -> bool:
+    """
+    If-Range: el rango solo se aplica si el validador sigue vigente (ETag
+    fuerte o fecha exacta); si no, se envía el recurso completo.
+    """
+    if_range = cabeceras_peticion.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag(meta["sha256"])
+    return bool(meta.get("generado_en")) and if_range == fecha_http(meta["generado_en"])
+
+
+def metadatos_pdf(contenido: bytes, generado_en: Optional[datetime] = None) -> Dict[str, Any]:
+    """Metadatos que se guardan junto al PDF para responder sin cargarlo."""
+    return {
+        "sha256": huella_contenido(contenido),
+        "tamano": len(contenido),
+        "generado_en": generado_en or datetime.now(timezone.utc),
+    }
@@ -0,0 +1,323 @@
+"""
+Importación en streaming de los datos históricos de tests de comorbilidad
+(documentacion/datosHistoricos/*.json) a MongoDB
+
+Lee cada fichero de forma incremental (memoria acotada a un bloque de lectura
+más un lote de inserción), normaliza cada registro al esquema TestResponse
+(el que lee ComorbilityProcessor.calcular_desde_respuestas) e inserta por
+lotes con ordered=False.
+
+Uso:
+    python importar_historicos.py [ficheros...] [--coleccion test_responses] [--lote 1000] [--dry-run]
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+from comorbilidad_utils import COLECCION_RESPUESTAS
+
+
+DIR_HISTORICOS = Path(__file__).resolve().parent.parent / "documentacion" / "datosHistoricos"
+
+TAM_BLOQUE = 1 << 16
+# Un registro que no cabe en este tamaño se considera JSON corrupto
+MAX_REGISTRO = 8 << 20
+
+
+# =========================
+# LECTURA INCREMENTAL
+# =========================
+def iter_registros_json(fichero: TextIO, tam_bloque: int = TAM_BLOQUE) -> Iterator[Any]:
+    """
+    Devuelve uno a uno los elementos del array JSON del fichero sin cargarlo entero.
+    Acepta un array en la raíz o el formato unificado {"metadata": ..., "records": [...]}.
+
+    Raises:
+        ValueError: Si el fichero no contiene un array o está truncado/corrupto
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, fin = "", 0, False
+
+    def _rellenar():
+        nonlocal buf, pos, fin
+        bloque = fichero.read(tam_bloque)
+        fin = not bloque
+        buf = buf[pos:] + bloque
+        pos = 0
+
+    def _saltar_blancos():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or fin:
+                return
+            _rellenar()
+
+    _rellenar()
+    if buf.startswith("\ufeff"):
+        pos = 1
+    _saltar_blancos()
+
+    # Formato unificado: avanzar hasta el array de "records"
+    if buf[pos:pos + 1] == "{":
+        while True:
+            i = buf.find('"records"', pos)
+            j = buf.find("[", i) if i >= 0 else -1
+            if j >= 0:
+                pos = j
+                break
+            if fin:
+                raise ValueError('No se encontró el array "records"')
+            pos = i if i >= 0 else max(pos, len(buf) - len('"records"'))
+            _rellenar()
+
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("Se esperaba un array JSON")
+    pos += 1
+
+    while True:
+        _saltar_blancos()
+        if pos >= len(buf):
+            raise ValueError("JSON truncado")
+        if buf[pos] == "]":
+            return
+        if buf[pos] == ",":
+            pos += 1
+            continue
+        try:
+            registro, fin_registro = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Registro partido entre bloques: leer más (hasta un límite)
+            if fin or len(buf) - pos > MAX_REGISTRO:
+                raise ValueError(f"JSON corrupto cerca de: {buf[pos:pos + 80]!r}")
+            _rellenar()
+            continue
+        pos = fin_registro
+        yield registro
+
+
+# =========================
+# NORMALIZACIÓN
+# =========================
+def _fecha_historica(valor: Any) -> Optional[str]:
+    """Fecha en DD-MM-YYYY (formato de datosHistoricos) o None; como el modelo TestResponse."""
+    if valor is None or valor == "":
+        return None
+    if isinstance(valor, (date, datetime)):
+        return valor.strftime("%d-%m-%Y")
+    s = str(valor).strip()
+    for formato in ("%d-%m-%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(s[:10], formato).strftime("%d-%m-%Y")
+        except ValueError:
+            continue
+    return None
+
+
+def normalizar_registro(registro: Any) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Normaliza un registro histórico al documento TestResponse
+
+    Returns:
+        (documento, None) si es válido o (None, motivo) si se rechaza
+    """
+    if not isinstance(registro, dict):
+        return None, "no es un objeto"
+
+    md = registro.get("metadata") or {}
+    form_id = str(md.get("form_id") or "").strip()
+    nreggen = str(md.get("NREGGEN") or "").strip()
+    if not form_id:
+        return None, "sin form_id"
+    if not nreggen:
+        return None, "sin NREGGEN"
+
+    puntuacion = registro.get("puntuacion")
+    try:
+        puntuacion = float(puntuacion)
+    except (TypeError, ValueError):
+        return None, "puntuación no numérica"
+    if puntuacion.is_integer():
+        puntuacion = int(puntuacion)
+
+    fecha_insercion = _fecha_historica(md.get("fecha_insercion"))
+    if fecha_insercion is None:
+        return None, "sin fecha_insercion"
+
+    metadata = {
+        "form_id": form_id,
+        "NREGGEN": nreggen,
+        "sexo": md.get("sexo") or None,
+        "fecha_nacimiento": _fecha_historica(md.get("fecha_nacimiento")),
+        "centro": str(md.get("centro") or "").strip(),
+        "fecha_insercion": fecha_insercion,
+    }
+
+    doc = {
+        "metadata": metadata,
+        "preguntas": registro.get("preguntas") or {},
+        "puntuacion": puntuacion,
+        "interpretacion": registro.get("interpretacion") or "",
+    }
+    # _id determinista sobre el registro normalizado completo (preguntas incluidas):
+    # reimportar un fichero no duplica registros y dos respuestas distintas con la
+    # misma clave de paciente, centro, fecha y puntuación no se descartan
+    clave = json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str)
+    ahora = datetime.utcnow()
+    doc["_id"] = hashlib.sha1(clave.encode("utf-8")).hexdigest()
+    doc["created_at"] = ahora
+    doc["updated_at"] = ahora
+    return doc, None
+
+
+# =========================
+# IMPORTACIÓN
+# =========================
+def _insertar_lote(coleccion, lote: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+    """Inserta un lote (ordered=False). Devuelve (insertados, duplicados, errores)."""
+    from pymongo.errors import BulkWriteError
+
+    try:
+        res = coleccion.insert_many(lote, ordered=False)
+        return len(res.inserted_ids), 0, 0
+    except BulkWriteError as e:
+        errores = e.details.get("writeErrors") or []
+        duplicados = sum(1 for err in errores if err.get("code") == 11000)
+        return e.details.get("nInserted", 0), duplicados, len(errores) - duplicados
+
+
+def importar_fichero(ruta: Path, coleccion=None, tam_lote: int = 1000, max_ejemplos: int = 5,
+                     vistos: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """
+    Importa un fichero histórico
+
+    Args:
+        ruta: Fichero JSON
+        coleccion: Colección destino (None = solo validar)
+        tam_lote: Registros por insert_many
+        max_ejemplos: Ejemplos de rechazos a conservar para el informe
+        vistos: _id ya contados en una validación (compartido entre ficheros), para
+            que --dry-run cuente los duplicados igual que la inserción real
+    """
+    if coleccion is None and vistos is None:
+        vistos = set()
+    informe = {
+        "fichero": ruta.name,
+        "leidos": 0,
+        "insertados": 0,
+        "duplicados": 0,
+        "errores_escritura": 0,
+        "rechazados": Counter(),
+        "ejemplos_rechazo": [],
+        "error": None,
+    }
+    t0 = time.perf_counter()
+    lote: List[Dict[str, Any]] = []
+
+    def _volcar():
+        if coleccion is not None and lote:
+            ins, dup, err = _insertar_lote(coleccion, lote)
+            informe["insertados"] += ins
+            informe["duplicados"] += dup
+            informe["errores_escritura"] += err
+        else:
+            for doc in lote:
+                if doc["_id"] in vistos:
+                    informe["duplicados"] += 1
+                else:
+                    vistos.add(doc["_id"])
+                    informe["insertados"] += 1
+        lote.clear()
+
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            for registro in iter_registros_json(f):
+                informe["leidos"] += 1
+                doc, motivo = normalizar_registro(registro)
+                if doc is None:
+                    informe["rechazados"][motivo] += 1
+                    if len(informe["ejemplos_rechazo"]) < max_ejemplos:
+                        informe["ejemplos_rechazo"].append({"posicion": informe["leidos"], "motivo": motivo})
+                    continue
+                lote.append(doc)
+                if len(lote) >= tam_lote:
+                    _volcar()
+        _volcar()
+    except (OSError, ValueError) as e:
+        _volcar()
+        informe["error"] = str(e)
+
+    informe["segundos"] = time.perf_counter() - t0
+    informe["registros_por_segundo"] = informe["leidos"] / informe["segundos"] if informe["segundos"] > 0 else 0.0
+    return informe
+
+
+def asegurar_indices_respuestas(coleccion) -> None:
+    """Índices que usan las consultas de comorbilidad sobre respuestas individuales."""
+    coleccion.create_index("metadata.form_id")
+    coleccion.create_index([("metadata.form_id", 1), ("metadata.NREGGEN", 1), ("metadata.fecha_insercion", -1)])
+    coleccion.create_index("metadata.centro")
+
+
+def _imprimir_informe(inf: Dict[str, Any]) -> None:
+    rechazados = sum(inf["rechazados"].values())
+    print(f"📄 {inf['fichero']}: {inf['leidos']} leídos, {inf['insertados']} insertados, "
+          f"{inf['duplicados']} duplicados, {rechazados} rechazados "
+          f"({inf['segundos']:.2f}s, {inf['registros_por_segundo']:.0f} reg/s)")
+    for motivo, n in inf["rechazados"].most_common():
+        print(f"   ⚠️ {motivo}: {n}")
+    for ej in inf["ejemplos_rechazo"]:
+        print(f"      · registro #{ej['posicion']}: {ej['motivo']}")
+    if inf["errores_escritura"]:
+        print(f"   ❌ errores de escritura: {inf['errores_escritura']}")
+    if inf["error"]:
+        print(f"   ❌ {inf['error']}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Importa los datos históricos de tests de comorbilidad a MongoDB")
+    parser.add_argument("ficheros", nargs="*", type=Path,
+                        help=f"Ficheros JSON (por defecto, todos los de {DIR_HISTORICOS})")
+    parser.add_argument("--coleccion", default=COLECCION_RESPUESTAS, help="Colección destino")
+    parser.add_argument("--lote", type=int, default=1000, help="Registros por inserción")
+    parser.add_argument("--dry-run", action="store_true", help="Solo leer y validar, sin escribir en MongoDB")
+    args = parser.parse_args(argv)
+
+    ficheros = args.ficheros or sorted(DIR_HISTORICOS.glob("*.json"))
+    if not ficheros:
+        print(f"❌ No hay ficheros que importar en {DIR_HISTORICOS}")
+        return 1
+
+    coleccion = None
+    if not args.dry_run:
+        from main import conectar_calidad
+        coleccion = conectar_calidad()[args.coleccion]
+        asegurar_indices_respuestas(coleccion)
+
+    t0 = time.perf_counter()
+    informes = []
+    vistos: Optional[Set[str]] = set() if coleccion is None else None
+    for ruta in ficheros:
+        inf = importar_fichero(ruta, coleccion, tam_lote=args.lote, vistos=vistos)
+        _imprimir_informe(inf)
+        informes.append(inf)
+
+    total = time.perf_counter() - t0
+    leidos = sum(i["leidos"] for i in informes)
+    print(f"✅ Total: {leidos} leídos, {sum(i['insertados'] for i in informes)} insertados, "
+          f"{sum(i['duplicados'] for i in informes)} duplicados, "
+          f"{sum(sum(i['rechazados'].values()) for i in informes)} rechazados "
+          f"en {total:.2f}s ({leidos / total if total > 0 else 0:.0f} reg/s)")
+    return 1 if any(i["error"] for i in informes) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,44 @@
 import os
 import re
 import hashlib
+import threading
 from pathlib import Path
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import Response
+import anyio
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from dotenv import load_dotenv
 from pymongo import MongoClient
-from bson.binary import Binary
 
 import pandas as pd
 import matplotlib
-matplotlib.use("Agg")  # imprescindible en Docker (sin display)
-import matplotlib.pyplot as plt
 import numpy as np
 
-# --- CONFIGURACIÓN ESTILO GRÁFICOS ---
-# Configuramos un estilo global más moderno para matplotlib
-plt.rcParams['font.family'] = 'sans-serif'
-plt.rcParams['font.sans-serif'] = ['DejaVu Sans', 'Arial', 'Helvetica', 'sans-serif']
-plt.rcParams['axes.spines.top'] = False
-plt.rcParams['axes.spines.right'] = False
-plt.rcParams['axes.spines.left'] = False  # Opcional: quitar eje Y para barras horizontales
-plt.rcParams['axes.grid'] = True
-plt.rcParams['grid.alpha'] = 0.3
-plt.rcParams['grid.linestyle'] = '--'
-plt.rcParams['axes.titlesize'] = 14
-plt.rcParams['axes.titleweight'] = 'bold'
-plt.rcParams['axes.labelsize'] = 11
-
+import admision_utils
+import cancelacion_utils
+import estadisticas_utils
+import comorbilidad_utils
+import cohortes_utils
+import exportacion_utils
+import almacen_pdf_utils
+import graficas_utils
+import http_utils
+import tendencias_utils
+import validacion_utils
+import plantillas_utils
+import periodos_utils
+import pregeneracion_utils
+import registros_utils
+from cache_utils import CacheLRU
+
+from reportlab import rl_config
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.lib import colors
@@ -45,13 +51,13 @@ from reportlab.platypus import (
     Paragraph,
     Spacer,
     PageBreak,
-    Table,
-    TableStyle,
     Image as RLImage,
     KeepTogether
 )
-from reportlab.platypus.tableofcontents import TableOfContents
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+# Streams binarios: sin ASCII85 (+25 % de tamaño y la linealización tendría
+# que recomprimir todas las imágenes)
+rl_config.useA85 = 0
 
 
 # =========================
@@ -67,6 +73,12 @@ MARGIN_BOTTOM = 2.0 * cm
 MARGIN_LEFT = 2.0 * cm
 MARGIN_RIGHT = 2.0 * cm
 
+# Espacio útil del marco (Frame añade 6 pt de padding por lado)
+FRAME_ANCHO = PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT - 12
+FRAME_ALTO = PAGE_HEIGHT - MARGIN_TOP - MARGIN_BOTTOM - 12
+# Alto máximo de una gráfica: deja sitio en su página para el título del indicador
+MAX_ALTO_GRAFICA = FRAME_ALTO - 4 * cm
+
 DEFAULT_TITLE = "Informe Analítico de Indicadores de Calidad"
 DEFAULT_SUBTITLE = "Fundación Renal Española"
 
@@ -81,29 +93,59 @@ LOGO_CANDIDATES = [
 INDICADORES_JSON = BASE_DIR / "indicadores_enriquecidos.json"
 CENTROS_CATALOGO_JSON = BASE_DIR / "centrosCatalogo.json"
 
+# Caché de datasets por transacción (evita releer Mongo para PDF / exportación / gráficas)
+DATASET_CACHE = CacheLRU(
+    max_entradas=int(os.getenv("DATASET_CACHE_MAX", "32")),
+    ttl_segundos=float(os.getenv("DATASET_CACHE_TTL", "600")),
+)
+
+# Tamaño máximo del cuerpo de POST /informe/datos (resultados en JSON / MessagePack)
+MAX_CUERPO_INFORME = int(float(os.getenv("INFORME_CUERPO_MAX_MB", "20")) * 1024 * 1024)
+
+# Admisión de renders de PDF (concurrencia, memoria y cola con prioridad)
+ADMISION = admision_utils.ControlAdmision()
+
+# Reglas de comorbilidad compiladas una vez al arrancar
+comorbilidad_utils.procesador()
+
 
 # =========================
 # MONGODB
 # =========================
+# Un único MongoClient por proceso (tiene su propio pool y es thread-safe):
+# crear uno por petición deja pools y hilos de monitorización sin cerrar
+_MONGO: Dict[str, Any] = {"cliente": None, "db": None}
+_MONGO_LOCK = threading.Lock()
+
+
 def conectar_calidad():
     """
     Conexión a MongoDB usando variables de entorno.
     Compatible con Docker y local (si existe .env junto al archivo).
+    El cliente se crea en la primera llamada y se reutiliza.
     """
-    env_path = BASE_DIR / ".env"
-    if (env_path.exists()):
-        load_dotenv(env_path)
-
-    mongo_uri = os.getenv("MONGODB_URI") or os.getenv("MONGO_URI") or "mongodb://mongodb:27017/"
-    db_name = os.getenv("MONGODB_DBNAME") or os.getenv("DB_NAME") or "DatosCalidad"
-
-    client = MongoClient(
-        mongo_uri,
-        serverSelectionTimeoutMS=8000,
-        connectTimeoutMS=8000,
-        socketTimeoutMS=20000,
-    )
-    return client[db_name]
+    db = _MONGO["db"]
+    if db is not None:
+        return db
+
+    with _MONGO_LOCK:
+        if _MONGO["db"] is None:
+            env_path = BASE_DIR / ".env"
+            if (env_path.exists()):
+                load_dotenv(env_path)
+
+            mongo_uri = os.getenv("MONGODB_URI") or os.getenv("MONGO_URI") or "mongodb://mongodb:27017/"
+            db_name = os.getenv("MONGODB_DBNAME") or os.getenv("DB_NAME") or "DatosCalidad"
+
+            client = MongoClient(
+                mongo_uri,
+                serverSelectionTimeoutMS=8000,
+                connectTimeoutMS=8000,
+                socketTimeoutMS=20000,
+            )
+            _MONGO["cliente"] = client
+            _MONGO["db"] = client[db_name]
+        return _MONGO["db"]
 
 
 def mongo_ping() -> bool:
@@ -115,17 +157,6 @@ def mongo_ping() -> bool:
 # =========================
 # UTILIDADES
 # =========================
-def _safe_float(x: Any) -> Optional[float]:
-    if x is None:
-        return None
-    try:
-        if isinstance(x, str):
-            x = x.replace(",", ".").strip()
-        return float(x)
-    except Exception:
-        return None
-
-
 def _clean_text(s: Any) -> str:
     if s is None:
         return ""
@@ -194,32 +225,6 @@ def _find_logo_path() -> Optional[Path]:
     return None
 
 
-def _infer_periodo(docs: List[Dict[str, Any]]) -> Tuple[Optional[str], Optional[str]]:
-    """Intenta extraer las fechas de consulta de los documentos."""
-    for d in docs:
-        # Buscamos en varios posibles lugares donde el backend guarda la config
-        cfg = d.get("config") or {}
-        payload = d.get("payload") or {}
-        
-        fi = (
-            cfg.get("fecha_inicio") or cfg.get("fechaInicio") or 
-            cfg.get("FECHAINI") or cfg.get("fechaini") or
-            payload.get("fecha_inicio") or payload.get("fechaInicio")
-        )
-        ff = (
-            cfg.get("fecha_fin") or cfg.get("fechaFin") or 
-            cfg.get("FECHAFIN") or cfg.get("fechafin") or
-            payload.get("fecha_fin") or payload.get("fechaFin")
-        )
-        
-        if fi or ff:
-            # Limpiamos formato si viene con hora
-            if isinstance(fi, str) and "T" in fi: fi = fi.split("T")[0]
-            if isinstance(ff, str) and "T" in ff: ff = ff.split("T")[0]
-            return (str(fi) if fi else None, str(ff) if ff else None)
-    return (None, None)
-
-
 # =========================
 # COLORES CONSISTENTES POR CENTRO
 # =========================
@@ -240,8 +245,13 @@ def _center_color_hex(centro: str) -> str:
     idx = int(h, 16) % len(paleta_profesional)
     return paleta_profesional[idx]
 
-def _build_center_palette(indicadores: list) -> dict:
-    """Construye paleta global (estable) para TODO el PDF.
+def _build_center_palette(indicadores: List[registros_utils.Indicador]) -> dict:
+    """Construye paleta global (estable) para TODO el PDF."""
+    return _paleta_centros({it.centro for ind in indicadores for it in ind.items if it.centro})
+
+
+def _paleta_centros(centros) -> dict:
+    """Color por centro.
 
     Prioridad:
     1) color definido en centrosCatalogo.json
@@ -250,16 +260,8 @@ def _build_center_palette(indicadores: list) -> dict:
     catalogo = _load_centros_catalogo()
     by_label = catalogo.get("byLabel") or {}
 
-    centros = set()
-    for ind in indicadores:
-        for it in (ind.get("items") or []):
-            c = _clean_text(it.get("centro") or "")
-            if c:
-                centros.add(c)
-
-    centros = sorted(centros)
     palette = {}
-    for c in centros:
+    for c in sorted(centros):
         meta = by_label.get(c.lower())
         if meta and meta.get("color"):
             palette[c] = meta["color"]
@@ -271,14 +273,61 @@ def _build_center_palette(indicadores: list) -> dict:
 # =========================
 # TRANSFORMACIÓN A DATASET DE INFORME
 # =========================
-def recopilar_datos_informe(coleccion_resultados, id_transaccion: str) -> Dict[str, Any]:
-    docs = list(coleccion_resultados.find({"id_transaccion": id_transaccion}, {"_id": 0}))
-    indicadores_meta = _load_indicadores_enriquecidos()
-    centros_catalogo = _load_centros_catalogo()
+def _resolver_centro(base: Dict[str, Any], centros_catalogo: Dict[str, Any]) -> Tuple[str, Optional[str], Optional[str]]:
+    """Devuelve (label_centro, region, id).
+
+    Resolver por:
+    - id (DBx)
+    - path (.gdb)
+    - label ya proporcionado
+    """
     by_id = centros_catalogo.get("byId") or {}
     by_label = centros_catalogo.get("byLabel") or {}
     by_path = centros_catalogo.get("byPath") or {}
-    fecha_ini, fecha_fin = _infer_periodo(docs)
+
+    base_id = _clean_text(base.get("id") or base.get("baseId") or base.get("codigo") or "")
+    base_path = _clean_text(base.get("path") or base.get("baseData") or base.get("database") or "")
+    base_label = _clean_text(base.get("nombre") or base.get("centro") or base.get("label") or "")
+
+    if base_id and base_id in by_id:
+        m = by_id[base_id]
+        return (_clean_text(m.get("label") or base_label or base_id), _clean_text(m.get("region")), base_id)
+
+    if base_path and base_path.lower() in by_path:
+        m = by_path[base_path.lower()]
+        return (_clean_text(m.get("label") or base_label or base_path), _clean_text(m.get("region")), _clean_text(m.get("id")))
+
+    if base_label and base_label.lower() in by_label:
+        m = by_label[base_label.lower()]
+        return (_clean_text(m.get("label") or base_label), _clean_text(m.get("region")), _clean_text(m.get("id")))
+
+    # Fallback: lo que venga
+    return (base_label or base_path or base_id or "Centro", None, base_id or None)
+
+
+def recopilar_datos_informe(coleccion_resultados, id_transaccion: str,
+                            docs: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """Dataset de la transacción con su periodo de la cabecera en ejecuciones.
+
+    Con `docs` (resultados recibidos en la petición) no se leen de Mongo.
+    """
+    if docs is None:
+        docs = list(coleccion_resultados.find({"id_transaccion": id_transaccion}, {"_id": 0}))
+    periodo = periodos_utils.periodo_transaccion(coleccion_resultados.database, id_transaccion, docs)
+    return construir_dataset_informe(docs, id_transaccion, periodo)
+
+
+def construir_dataset_informe(docs: List[Dict[str, Any]], id_transaccion: str,
+                              periodo: Optional[periodos_utils.Periodo] = None) -> Dict[str, Any]:
+    """Dataset del informe a partir de documentos de `resultados` (leídos de Mongo o recibidos en el cuerpo).
+
+    Frontera del dataset: los documentos se convierten aquí, una sola vez, en
+    registros_utils.Indicador / ItemCentro con los campos ya normalizados.
+    Sin `periodo` se toma el declarado en los propios documentos.
+    """
+    indicadores_meta = _load_indicadores_enriquecidos()
+    centros_catalogo = _load_centros_catalogo()
+    fecha_ini, fecha_fin = periodo or periodos_utils.periodo_de_documentos(docs)
 
     meta = {
         "id_transaccion": id_transaccion,
@@ -288,34 +337,7 @@ def recopilar_datos_informe(coleccion_resultados, id_transaccion: str) -> Dict[s
         "fecha_fin": fecha_fin,
     }
 
-    agrupado: Dict[str, Dict[str, Any]] = {}
-
-    def _resolver_centro(base: Dict[str, Any]) -> Tuple[str, Optional[str], Optional[str]]:
-        """Devuelve (label_centro, region, id).
-
-        Resolver por:
-        - id (DBx)
-        - path (.gdb)
-        - label ya proporcionado
-        """
-        base_id = _clean_text(base.get("id") or base.get("baseId") or base.get("codigo") or "")
-        base_path = _clean_text(base.get("path") or base.get("baseData") or base.get("database") or "")
-        base_label = _clean_text(base.get("nombre") or base.get("centro") or base.get("label") or "")
-
-        if base_id and base_id in by_id:
-            m = by_id[base_id]
-            return (_clean_text(m.get("label") or base_label or base_id), _clean_text(m.get("region")), base_id)
-
-        if base_path and base_path.lower() in by_path:
-            m = by_path[base_path.lower()]
-            return (_clean_text(m.get("label") or base_label or base_path), _clean_text(m.get("region")), _clean_text(m.get("id")))
-
-        if base_label and base_label.lower() in by_label:
-            m = by_label[base_label.lower()]
-            return (_clean_text(m.get("label") or base_label), _clean_text(m.get("region")), _clean_text(m.get("id")))
-
-        # Fallback: lo que venga
-        return (base_label or base_path or base_id or "Centro", None, base_id or None)
+    agrupado: Dict[str, registros_utils.Indicador] = {}
 
     for d in docs:
         indice = d.get("indice") or {}
@@ -326,7 +348,7 @@ def recopilar_datos_informe(coleccion_resultados, id_transaccion: str) -> Dict[s
         label = indice.get("label") or d.get("indicador") or payload.get("indicador") or "Indicador"
         label = _clean_text(label)
 
-        centro, region, centro_id = _resolver_centro(base)
+        centro, region, centro_id = _resolver_centro(base, centros_catalogo)
 
         valor_raw = payload.get("resultado", payload.get("valor"))
         pacientes = payload.get("numero_pacientes", payload.get("pacientes"))
@@ -338,48 +360,286 @@ def recopilar_datos_informe(coleccion_resultados, id_transaccion: str) -> Dict[s
         objetivo = _clean_text(enr.get("objetivo") or "")
 
         key = id_code or titulo
-        if key not in agrupado:
-            agrupado[key] = {
+        ind = agrupado.get(key)
+        if ind is None:
+            ind = agrupado[key] = registros_utils.Indicador(id_code, titulo, categoria, objetivo, unidad)
+
+        ind.items.append(registros_utils.ItemCentro(
+            centro, region or None, centro_id, valor_raw, registros_utils.a_numero(valor_raw),
+            registros_utils.a_pacientes(pacientes)
+        ))
+
+        if not ind.unidad and unidad:
+            ind.unidad = unidad
+
+    indicadores = sorted(agrupado.values(), key=lambda x: (x.categoria, x.titulo))
+
+    return {"meta": meta, "indicadores": indicadores}
+
+
+def _integrar_comorbilidad(dataset: Dict[str, Any], indicadores_comorb: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Añade los indicadores de comorbilidad al dataset (al final, agrupados por su
+    propia categoría), resolviendo los centros contra el catálogo como el resto
+    y convirtiéndolos a registros_utils.Indicador.
+    """
+    if not indicadores_comorb:
+        return dataset
+
+    centros_catalogo = _load_centros_catalogo()
+    registros = []
+    for d in indicadores_comorb:
+        ind = registros_utils.Indicador.desde_dict(d)
+        if not ind.items:
+            continue
+        for it in ind.items:
+            centro, region, centro_id = _resolver_centro({"nombre": it.centro}, centros_catalogo)
+            it.centro, it.region, it.centro_id = centro, region or None, centro_id
+        ind.categoria = _clean_text(ind.categoria or "Comorbilidad")
+        registros.append(ind)
+
+    registros.sort(key=lambda x: (x.categoria, x.titulo))
+    dataset["indicadores"] = (dataset.get("indicadores") or []) + registros
+    return dataset
+
+
+def actualizar_cohortes(db, completo: bool = False) -> Dict[str, Any]:
+    """Procesa las respuestas nuevas (solo los pacientes afectados, o todos con `completo`)."""
+    resumen = cohortes_utils.actualizar_cohortes(db, completo=completo)
+    if resumen["pacientes"]:
+        print(f"🔄 Cohortes: {resumen['pacientes']} pacientes, {resumen['matrices']} matrices "
+              f"actualizadas en {resumen['segundos']:.2f}s")
+    return resumen
+
+
+def obtener_cohortes(db, test: Optional[str] = None, centro: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Matrices de transición de cohortes guardadas (solo lectura)."""
+    return cohortes_utils.obtener_transiciones(db, test, centro)
+
+
+def _cohortes_dataset(db) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    """Versión y matrices de cohortes para el informe (la versión se lee antes: nunca es más nueva que las matrices)."""
+    try:
+        version = cohortes_utils.version_cohortes(db)
+        return version, obtener_cohortes(db)
+    except Exception as e:
+        print(f"⚠️ Error leyendo cohortes de comorbilidad: {e}")
+        return None, []
+
+
+def _comorbilidad_dataset(db, id_transaccion: str, fut_dataset: Future) -> Tuple[List[Dict[str, Any]], bool]:
+    """Indicadores de comorbilidad de la transacción y si siguen pendientes.
+
+    Sin agregados en la colección comorbilidad se usan los calculados desde
+    test_responses para el periodo del dataset, sin esperar a un cálculo en
+    curso (pendiente = True mientras no termina).
+    """
+    indicadores = comorbilidad_utils.obtener_indicadores_comorbilidad(db, id_transaccion)
+    if indicadores:
+        return indicadores, False
+    meta = fut_dataset.result().get("meta") or {}
+    if not (meta.get("fecha_inicio") and meta.get("fecha_fin")):
+        return [], False
+    indicadores = comorbilidad_utils.indicadores_desde_respuestas(db, meta["fecha_inicio"], meta["fecha_fin"])
+    if indicadores is None:
+        print(f"⏳ Comorbilidad de {id_transaccion} calculándose desde respuestas")
+        return [], True
+    return indicadores, False
+
+
+def obtener_dataset(id_transaccion: str, db=None,
+                    cancelacion: cancelacion_utils.Cancelacion = cancelacion_utils.SIN_CANCELACION,
+                    docs: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """Dataset de la transacción desde la caché en memoria (o Mongo si no está).
+
+    resultados y comorbilidad (incluida la alternativa desde test_responses)
+    se leen en paralelo: la latencia es la de la consulta más lenta, no la
+    suma de ambas. Con `docs` (resultados recibidos en la petición) no se
+    leen los resultados de Mongo.
+    """
+    db = db if db is not None else conectar_calidad()
+    dataset = DATASET_CACHE.get(id_transaccion)
+    if dataset is not None:
+        # Las cohortes son de toda la red: cambian sin que cambie la transacción
+        try:
+            vigente = cohortes_utils.version_cohortes(db)
+        except Exception as e:
+            print(f"⚠️ Error leyendo la versión de cohortes: {e}")
+            return dataset
+        if vigente != dataset.get("version_cohortes"):
+            version, cohortes = _cohortes_dataset(db)
+            dataset = {**dataset, "cohortes": cohortes, "version_cohortes": version}
+            DATASET_CACHE.set(id_transaccion, dataset)
+        return dataset
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        fut_dataset = pool.submit(recopilar_datos_informe, db["resultados"], id_transaccion, docs)
+        fut_comorb = pool.submit(_comorbilidad_dataset, db, id_transaccion, fut_dataset)
+        # Solo lectura: las matrices se actualizan en POST /comorbilidad/cohortes/actualizar
+        fut_cohortes = pool.submit(_cohortes_dataset, db)
+        dataset = fut_dataset.result()
+        try:
+            indicadores_comorb, pendiente = fut_comorb.result()
+        except Exception as e:
+            # La comorbilidad es complementaria: su fallo no impide el informe
+            print(f"⚠️ Error obteniendo comorbilidad de {id_transaccion}: {e}")
+            indicadores_comorb, pendiente = [], False
+        version_cohortes, cohortes = fut_cohortes.result()
+
+    cancelacion.comprobar("dataset")
+
+    dataset = _integrar_comorbilidad(dataset, indicadores_comorb)
+    dataset["cohortes"] = cohortes
+    dataset["version_cohortes"] = version_cohortes
+    if pendiente:
+        dataset["meta"] = {**(dataset.get("meta") or {}), "comorbilidad_pendiente": True}
+    # No cacheamos transacciones vacías (pueden estar aún escribiéndose) ni incompletas
+    elif dataset.get("indicadores"):
+        DATASET_CACHE.set(id_transaccion, dataset)
+    return dataset
+
+
+def recopilar_datos_tendencias(
+    db,
+    ids_transaccion: Optional[List[str]] = None,
+    fecha_desde: Optional[str] = None,
+    fecha_hasta: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Dataset de tendencias: una única consulta indexada para todas las transacciones
+    y cubo (periodo × centro × indicador) construido de forma vectorizada.
+
+    El periodo de cada transacción sale de su cabecera en ejecuciones; el rango
+    de fechas se aplica sobre periodo_aplicado.desde / periodo_aplicado.hasta.
+    """
+    filtro = tendencias_utils.construir_filtro_tendencias(ids_transaccion, fecha_desde, fecha_hasta)
+    periodo_por_trx = periodos_utils.periodos_de_ejecuciones(db, filtro)
+    ids = [i for i in (ids_transaccion or []) if i] or list(periodo_por_trx)
+    docs = list(db["resultados"].find({"id_transaccion": {"$in": ids}}, tendencias_utils.PROYECCION_TENDENCIAS))
+
+    indicadores_meta = _load_indicadores_enriquecidos()
+    centros_catalogo = _load_centros_catalogo()
+
+    docs_por_trx: Dict[str, List[Dict[str, Any]]] = {}
+    for d in docs:
+        docs_por_trx.setdefault(d.get("id_transaccion") or "", []).append(d)
+    # Etiqueta del periodo: inicio ISO (ordena cronológicamente); sin cabecera, el
+    # intervalo de los documentos o su creado_en; sin fecha alguna, al final
+    etiqueta_por_trx, fecha_por_trx = {}, {}
+    for trx, trx_docs in docs_por_trx.items():
+        fi, ff = periodo_por_trx.get(trx) or (None, None)
+        if not (fi or ff):
+            fi, ff = periodos_utils.periodo_de_documentos(trx_docs)
+        fecha = fi or ff or periodos_utils.fecha_creacion(trx_docs)
+        fecha_por_trx[trx] = fecha
+        etiqueta_por_trx[trx] = fecha or trx
+    transacciones = sorted(docs_por_trx, key=lambda t: (fecha_por_trx[t] is None, fecha_por_trx[t] or "", t))
+
+    periodos, centros, codigos, valores = [], [], [], []
+    info_indicadores: Dict[str, Dict[str, Any]] = {}
+    for d in docs:
+        indice = d.get("indice") or {}
+        payload = d.get("payload") or {}
+        id_code = str(indice.get("id_code") or indice.get("id") or d.get("id_code") or "").strip()
+        label = _clean_text(indice.get("label") or d.get("indicador") or "Indicador")
+        enr = indicadores_meta.get(id_code, {})
+        titulo = _clean_text(enr.get("titulo") or label)
+        key = id_code or titulo
+
+        if key not in info_indicadores:
+            info_indicadores[key] = {
                 "id_code": id_code,
                 "titulo": titulo,
-                "categoria": categoria,
-                "objetivo": objetivo,
-                "unidad": unidad,
-                "items": [],
+                "categoria": _clean_text(enr.get("categoria") or indice.get("categoria") or d.get("categoria") or ""),
+                "unidad": payload.get("unidad") or d.get("unidad") or "",
             }
 
-        agrupado[key]["items"].append(
-            {
-                "centro": centro,
-                "region": region,
-                "centro_id": centro_id,
-                "valor": valor_raw,
-                "valor_num": _safe_float(valor_raw),
-                "pacientes": pacientes,
-            }
-        )
+        centro, _, _ = _resolver_centro(d.get("base") or {}, centros_catalogo)
+        periodos.append(etiqueta_por_trx[d.get("id_transaccion") or ""])
+        centros.append(centro)
+        codigos.append(key)
+        valores.append(registros_utils.a_numero(payload.get("resultado", payload.get("valor"))))
 
-        if not agrupado[key]["unidad"] and unidad:
-            agrupado[key]["unidad"] = unidad
+    meta = {
+        "generado_en": datetime.now().strftime("%d/%m/%Y %H:%M"),
+        "num_docs": len(docs),
+        "num_transacciones": len(docs_por_trx),
+        "transacciones": transacciones,
+        "fecha_inicio": fecha_desde,
+        "fecha_fin": fecha_hasta,
+    }
 
-    indicadores = list(agrupado.values())
-    indicadores.sort(key=lambda x: (x.get("categoria", ""), x.get("titulo", "")))
+    if not docs:
+        return {"meta": meta, "periodos": [], "centros": [], "indicadores": [], "valores": None, "info": {}}
 
-    return {"meta": meta, "indicadores": indicadores}
+    cubo = tendencias_utils.construir_cubo_tendencias(
+        periodos, centros, codigos, valores, orden_periodos=[etiqueta_por_trx[t] for t in transacciones]
+    )
+    cubo["deltas"] = tendencias_utils.calcular_deltas(cubo["valores"])
+    cubo["info"] = info_indicadores
+    cubo["meta"] = meta
+    return cubo
 
 
 # =========================
 # GRÁFICAS ESPECTACULARES
 # =========================
-def _plot_barras_coloreadas(items: List[Dict[str, Any]], titulo: str, unidad: str, palette: dict) -> Optional[BytesIO]:
-    data = []
-    for it in items:
-        v = it.get("valor_num")
-        c = (it.get("centro") or "").strip()
-        # Filtramos None, pero permitimos 0 para dibujarlos si existen
-        if v is None or not c:
-            continue
-        data.append((c, v))
+def _dibujar_referencias_red(ax, estadisticas: Optional[Dict[str, Any]], centros: List[str], bars) -> None:
+    """Banda intercuartílica, línea de media de red y borde rojo en centros atípicos."""
+    if not estadisticas:
+        return
+    q1, q3 = estadisticas.get("q1"), estadisticas.get("q3")
+    if q1 is not None and q3 is not None:
+        ax.axvspan(q1, q3, color='#2E86C1', alpha=0.07, zorder=0, label="Q1–Q3 red")
+    ref = estadisticas.get("referencia")
+    if ref is not None:
+        etiqueta = "Media ponderada red" if estadisticas.get("ponderado") else "Media red"
+        ax.axvline(ref, color='#1A3A58', linestyle='--', linewidth=1.3, zorder=5, label=f"{etiqueta}: {ref:.2f}")
+    atipicos = estadisticas.get("centros_atipicos") or set()
+    for c, bar in zip(centros, bars):
+        if c in atipicos:
+            bar.set_edgecolor('#C0392B')
+            bar.set_linewidth(2)
+    ax.legend(fontsize=8, frameon=False, loc="lower right")
+
+
+COLOR_OTROS = "#B8BEC6"
+
+
+def _agrupar_cola(data: List[Tuple[str, float]], max_centros: Optional[int],
+                  extremos: int) -> Tuple[List[Tuple[str, float]], Optional[Dict[str, Any]]]:
+    """
+    Con más de max_centros centros deja los `extremos` de cada lado (data ya
+    ordenada ascendente) y resume el resto en una barra "Otros" con su mediana.
+    Devuelve (data, resumen de "Otros" o None si no se agrupa)
+    """
+    if not max_centros or extremos <= 0 or len(data) <= max(max_centros, 2 * extremos + 1):
+        return data, None
+    cola = [v for _, v in data[extremos:-extremos]]
+    otros = {
+        "etiqueta": f"Otros ({len(cola)} centros)",
+        "n": len(cola),
+        "min": min(cola),
+        "max": max(cola),
+        "mediana": float(np.median(cola)),
+    }
+    return data[:extremos] + [(otros["etiqueta"], otros["mediana"])] + data[-extremos:], otros
+
+
+def _dibujar_otros(ax, otros: Optional[Dict[str, Any]], posicion: int) -> None:
+    """Rango mín–máx de los centros agrupados sobre la barra "Otros"."""
+    if not otros:
+        return
+    med = otros["mediana"]
+    ax.errorbar(med, posicion, xerr=[[med - otros["min"]], [otros["max"] - med]], fmt="none",
+                ecolor="#555555", elinewidth=1.2, capsize=4, zorder=6)
+
+
+@graficas_utils.con_estilo
+def _plot_barras_coloreadas(items: List[registros_utils.ItemCentro], titulo: str, unidad: str, palette: dict,
+                            estadisticas: Optional[Dict[str, Any]] = None,
+                            max_centros: Optional[int] = None, extremos: int = 0) -> Optional[BytesIO]:
+    # Filtramos None, pero permitimos 0 para dibujarlos si existen
+    data = [(it.centro, it.valor_num) for it in items if it.valor_num is not None and it.centro]
 
     if not data:
         return None
@@ -391,13 +651,18 @@ def _plot_barras_coloreadas(items: List[Dict[str, Any]], titulo: str, unidad: st
     df = pd.DataFrame(data, columns=["centro", "valor"])
     # Orden descendente por valor para lectura más clara
     df = df.sort_values(by="valor", ascending=True).reset_index(drop=True)
-    colors_list = [palette.get(c, "#4c78a8") for c in df["centro"]]
+    # Redes grandes: extremos + "Otros" (altura de la figura acotada)
+    visibles, otros = _agrupar_cola(list(zip(df["centro"], df["valor"])), max_centros, extremos)
+    if otros:
+        df = pd.DataFrame(visibles, columns=["centro", "valor"])
+    colors_list = [palette.get(c, COLOR_OTROS if otros and c == otros["etiqueta"] else "#4c78a8")
+                   for c in df["centro"]]
 
     n = len(df)
     
     # Ajuste dinámico de altura
     fig_h = max(4.5, 0.5 * n + 1.5)
-    fig, ax = plt.subplots(figsize=(10, fig_h))
+    fig, ax = graficas_utils.nueva_figura((10, fig_h))
     
     bars = ax.barh(df["centro"], df["valor"], color=colors_list, height=0.7, edgecolor='white', linewidth=1)
     
@@ -408,13 +673,20 @@ def _plot_barras_coloreadas(items: List[Dict[str, Any]], titulo: str, unidad: st
     
     offset = max_val * 0.01
 
-    for bar in bars:
+    for centro, bar in zip(df["centro"], bars):
         width = bar.get_width()
         label_x_pos = width + offset
+        texto = f'{width:.2f}'
+        if otros and centro == otros["etiqueta"]:
+            # Fuera del bigote del rango
+            label_x_pos = otros["max"] + offset
+            texto = f'mediana {width:.2f}'
         # Etiqueta de valor
-        ax.text(label_x_pos, bar.get_y() + bar.get_height()/2, f'{width:.2f}', 
+        ax.text(label_x_pos, bar.get_y() + bar.get_height()/2, texto, 
                 va='center', ha='left', fontsize=9, fontweight='bold', color='#333333')
 
+    _dibujar_otros(ax, otros, extremos)
+
     # Ajustar límite X
     ax.set_xlim(0, max_val * 1.15)
     
@@ -425,25 +697,21 @@ def _plot_barras_coloreadas(items: List[Dict[str, Any]], titulo: str, unidad: st
     # Línea sutil en el borde derecho o valor máximo referencial
     ax.axvline(x=max_val, color='#dedede', linestyle='-', linewidth=1, alpha=0.8, zorder=0)
 
-    buf = BytesIO()
-    plt.tight_layout()
-    fig.savefig(buf, format="png", dpi=200, bbox_inches='tight')
-    plt.close(fig)
-    buf.seek(0)
-    return buf
+    _dibujar_referencias_red(ax, estadisticas, list(df["centro"]), bars)
+
+    return graficas_utils.figura_a_png(fig)
 
 
-def _plot_modern_percentage(items: List[Dict[str, Any]], titulo: str, palette: dict) -> Optional[BytesIO]:
+@graficas_utils.con_estilo
+def _plot_modern_percentage(items: List[registros_utils.ItemCentro], titulo: str, palette: dict,
+                            estadisticas: Optional[Dict[str, Any]] = None,
+                            max_centros: Optional[int] = None, extremos: int = 0) -> Optional[BytesIO]:
     """
     Gráfico moderno de barras de progreso horizontal para porcentajes.
     Muestra una barra de fondo (100%), sombra y barra con degradado.
     """
-    data = []
-    for it in items:
-        c = (it.get("centro") or "").strip()
-        v = it.get("valor_num")
-        if not c or v is None: continue
-        data.append((c, max(0.0, min(100.0, float(v)))))
+    data = [(it.centro, max(0.0, min(100.0, it.valor_num))) for it in items
+            if it.valor_num is not None and it.centro]
 
     if not data:
         return None
@@ -453,15 +721,18 @@ def _plot_modern_percentage(items: List[Dict[str, Any]], titulo: str, palette: d
 
     # Ordenar por valor descendente (mayor arriba)
     data.sort(key=lambda x: x[1]) 
+    # Redes grandes: extremos + "Otros" (altura de la figura acotada)
+    data, otros = _agrupar_cola(data, max_centros, extremos)
 
     centros = [x[0] for x in data]
     valores = [x[1] for x in data]
     # Colores base
-    colors_list = [palette.get(c, "#4c78a8") for c in centros]
+    colors_list = [palette.get(c, COLOR_OTROS if otros and c == otros["etiqueta"] else "#4c78a8")
+                   for c in centros]
 
     n = len(data)
     fig_h = max(3.0, 0.7 * n + 1.2)
-    fig, ax = plt.subplots(figsize=(10, fig_h))
+    fig, ax = graficas_utils.nueva_figura((10, fig_h))
 
     # 1. Barra de fondo (Track)
     ax.barh(centros, [100]*n, color='#F0F2F5', height=0.55, align='center', edgecolor='none', zorder=1)
@@ -490,14 +761,22 @@ def _plot_modern_percentage(items: List[Dict[str, Any]], titulo: str, palette: d
     ax.set_xticks([])
     
     ax.tick_params(axis='y', length=0, labelsize=11, labelcolor='#333333', pad=12)
-    plt.yticks(fontweight='bold')
+    for etiqueta in ax.get_yticklabels():
+        etiqueta.set_fontweight('bold')
 
     # Grid vertical sutil
     ax.vlines([25, 50, 75, 100], ymin=-1, ymax=n, colors='#e0e0e0', linestyles=':', linewidth=1, zorder=0)
 
+    _dibujar_otros(ax, otros, extremos)
+
     # Etiquetas
-    for bar, val in zip(bars, valores):
+    for centro, bar, val in zip(centros, bars, valores):
         width = bar.get_width()
+        if otros and centro == otros["etiqueta"]:
+            ax.text(otros["max"] + 1.5, bar.get_y() + bar.get_height()/2,
+                    f"mediana {val:.1f}% ({otros['min']:.1f}–{otros['max']:.1f}%)",
+                    va='center', ha='left', fontsize=9, fontweight='bold', color='#333333', zorder=4)
+            continue
         # Texto dentro de la barra si cabe, o fuera si es muy pequeña
         if width > 15:
              # Texto blanco dentro de la barra con sombra
@@ -508,12 +787,9 @@ def _plot_modern_percentage(items: List[Dict[str, Any]], titulo: str, palette: d
              ax.text(width + 1.5, bar.get_y() + bar.get_height()/2, f"{val:.1f}%", 
                     va='center', ha='left', fontsize=10, fontweight='bold', color='#333333', zorder=4)
 
-    plt.tight_layout()
-    buf = BytesIO()
-    fig.savefig(buf, format="png", dpi=200, bbox_inches='tight')
-    plt.close(fig)
-    buf.seek(0)
-    return buf
+    _dibujar_referencias_red(ax, estadisticas, centros, bars)
+
+    return graficas_utils.figura_a_png(fig)
 
 
 def _is_percent_indicator(unidad: str) -> bool:
@@ -521,10 +797,56 @@ def _is_percent_indicator(unidad: str) -> bool:
     return ("%" in u) or ("porcentaje" in u)
 
 
-def _select_chart(items: List[Dict[str, Any]], titulo: str, unidad: str, palette: dict) -> Optional[BytesIO]:
-    """Elige la mejor gráfica según unidad y número de centros - SOLO BARRAS HORIZONTALES."""
+def _serie_grafica(ind: registros_utils.Indicador, palette: dict) -> Dict[str, Any]:
+    """
+    Datos de la gráfica de un indicador (los mismos que dibuja _select_chart),
+    en columnas compactas para que el cliente pinte la gráfica.
+    """
+    unidad = ind.unidad
+    matriz = ind.matriz
+    if matriz:
+        return {
+            "id_code": ind.id_code,
+            "titulo": ind.titulo,
+            "unidad": unidad,
+            "tipo": "mapa_calor",
+            "centros": [it.centro for it in ind.items],
+            "pacientes": [it.pacientes for it in ind.items],
+            "tests": matriz.get("tests"),
+            "valores": matriz.get("valores"),
+            "evaluados": matriz.get("evaluados"),
+        }
+
+    is_percent = _is_percent_indicator(unidad)
+    datos = [
+        (it.centro, max(0.0, min(100.0, it.valor_num)) if is_percent else it.valor_num, it.pacientes)
+        for it in ind.items if it.valor_num is not None and it.centro
+    ]
+    # Mismo orden que las barras horizontales del PDF (ascendente)
+    datos.sort(key=lambda d: d[1])
+
+    return {
+        "id_code": ind.id_code,
+        "titulo": ind.titulo,
+        "unidad": unidad,
+        "tipo": "porcentaje" if is_percent else "barras",
+        "centros": [d[0] for d in datos],
+        "valores": [d[1] for d in datos],
+        "pacientes": [d[2] for d in datos],
+        "colores": [palette.get(d[0], "#4c78a8") for d in datos],
+    }
+
+
+@graficas_utils.cacheada
+def _select_chart(items: List[registros_utils.ItemCentro], titulo: str, unidad: str, palette: dict,
+                  estadisticas: Optional[Dict[str, Any]] = None,
+                  max_centros: Optional[int] = None, extremos: int = 0) -> Optional[BytesIO]:
+    """
+    Elige la mejor gráfica según unidad y número de centros - SOLO BARRAS HORIZONTALES.
+    Con más de max_centros centros solo dibuja los extremos y agrupa el resto en "Otros".
+    """
     # Filtramos nulos, pero mantenemos ceros para evaluar si "todo es cero" después
-    validos = [it for it in items if it.get("valor_num") is not None]
+    validos = [it for it in items if it.valor_num is not None]
     
     # Si no hay datos (lista vacía), chart es None
     if not validos:
@@ -534,83 +856,167 @@ def _select_chart(items: List[Dict[str, Any]], titulo: str, unidad: str, palette
     
     # MODIFICADO: Usar siempre barras horizontales modernas para porcentajes
     if _is_percent_indicator(unidad):
-        return _plot_modern_percentage(validos, titulo, palette)
+        return _plot_modern_percentage(validos, titulo, palette, estadisticas, max_centros, extremos)
 
     # Para todo lo demás, barras horizontales estándar
-    return _plot_barras_coloreadas(validos, titulo, unidad, palette)
+    return _plot_barras_coloreadas(validos, titulo, unidad, palette, estadisticas, max_centros, extremos)
+
+
+@graficas_utils.cacheada
+@graficas_utils.con_estilo
+def _plot_tendencia(
+    series: List[Dict[str, Any]],
+    periodos: List[str],
+    media_red: np.ndarray,
+    titulo: str,
+    unidad: str,
+    palette: dict,
+) -> Optional[BytesIO]:
+    """
+    Evolución temporal de un indicador.
+    Con pocos centros: una línea por centro + media de red.
+    Con muchos centros: small multiples (un panel por centro con la media de red de fondo).
+    """
+    if not series or len(periodos) < 2:
+        return None
 
+    x = np.arange(len(periodos))
+    n = len(series)
+
+    if n <= 8:
+        fig, ax = graficas_utils.nueva_figura((10, 4.5))
+        for s in series:
+            ax.plot(x, s["valores"], marker="o", linewidth=1.6, markersize=4,
+                    color=palette.get(s["centro"], "#4c78a8"), label=s["centro"])
+        ax.plot(x, media_red, color="#1A3A58", linewidth=2.8, linestyle="--", label="Media red")
+        ax.set_xticks(x)
+        ax.set_xticklabels(periodos, rotation=35, ha="right", fontsize=9)
+        ax.set_ylabel(unidad or "Valor", fontweight='bold', color='#555555')
+        ax.legend(fontsize=8, ncol=3, frameon=False, loc="upper center", bbox_to_anchor=(0.5, -0.25))
+    else:
+        cols = 4
+        rows = int(np.ceil(n / cols))
+        fig, axes = graficas_utils.nueva_figura((10, 1.9 * rows + 0.6), rows, cols, sharex=True, sharey=True)
+        axes = np.atleast_1d(axes).flatten()
+        for ax in axes[n:]:
+            ax.axis("off")
+        for ax, s in zip(axes, series):
+            ax.plot(x, media_red, color="#1A3A58", alpha=0.35, linestyle="--", linewidth=1.2)
+            ax.plot(x, s["valores"], marker="o", linewidth=1.4, markersize=2.5,
+                    color=palette.get(s["centro"], "#4c78a8"))
+            ax.set_title(s["centro"], fontsize=8, fontweight="bold")
+            ax.tick_params(labelsize=6)
+            ax.grid(alpha=0.2)
+        for ax in axes[:n]:
+            ax.set_xticks(x)
+            ax.set_xticklabels(periodos, rotation=60, ha="right", fontsize=6)
+
+    return graficas_utils.figura_a_png(fig)
+
+
+@graficas_utils.cacheada
+@graficas_utils.con_estilo
+def _plot_comparativa_regiones(
+    items: List[registros_utils.ItemCentro],
+    filas_region: List[Dict[str, Any]],
+    titulo: str,
+    unidad: str,
+    palette: dict,
+) -> Optional[BytesIO]:
+    """
+    Small multiples por región (una sola figura por indicador):
+    un panel por región con las barras de sus centros y la media ponderada
+    por pacientes de la región como línea de referencia.
+    """
+    if len(filas_region) < 2:
+        return None
 
-# =========================
-# PDF: ESTILOS
-# =========================
-def _build_styles():
-    styles = getSampleStyleSheet()
-
-    # --- PALETA DE COLORES PDF ---
-    corp_dark = colors.HexColor("#1A3A58") # Azul oscuro corporativo
-    corp_blue = colors.HexColor("#2E86C1") # Azul medio
-    corp_gray = colors.HexColor("#5D6D7E") # Gris azulado
-
-    styles.add(ParagraphStyle(
-        name="H1",
-        parent=styles["Heading1"],
-        fontSize=12, # REDUCIDO DE 15 A 12
-        leading=15,  # Ajustado leading
-        spaceBefore=14,
-        spaceAfter=10,
-        textColor=corp_dark,
-        borderPadding=0,
-        fontName="Helvetica-Bold"
-    ))
-    styles.add(ParagraphStyle(
-        name="H2",
-        parent=styles["Heading2"],
-        fontSize=14,
-        leading=16,
-        spaceBefore=14,
-        spaceAfter=8,
-        textColor=corp_blue,
-        fontName="Helvetica-Bold"
-    ))
-    styles.add(ParagraphStyle(
-        name="Small",
-        parent=styles["Normal"],
-        fontSize=10,
-        leading=12,
-        textColor=colors.HexColor("#444444"),
-    ))
-    styles.add(ParagraphStyle(
-        name="Meta",
-        parent=styles["Normal"],
-        fontSize=11,
-        leading=14,
-        textColor=corp_gray,
-    ))
-    styles.add(ParagraphStyle(
-        name="CoverTitle",
-        parent=styles["Title"],
-        fontSize=28,
-        leading=34,
-        textColor=corp_dark,
-        spaceAfter=16,
-        fontName="Helvetica-Bold",
-        alignment=1 # Center
-    ))
-    styles.add(ParagraphStyle(
-        name="CoverSub",
-        parent=styles["Normal"],
-        fontSize=16,
-        leading=20,
-        textColor=corp_gray,
-        spaceAfter=20,
-        alignment=1 # Center
-    ))
-    return styles
+    por_region: Dict[str, List[Tuple[str, float]]] = {f["region"]: [] for f in filas_region}
+    for it in items:
+        r = it.region or estadisticas_utils.SIN_REGION
+        if it.valor_num is None or not it.centro or r not in por_region:
+            continue
+        por_region[r].append((it.centro, it.valor_num))
+
+    n = len(filas_region)
+    cols = 2 if n > 1 else 1
+    rows = int(np.ceil(n / cols))
+    max_centros = max(len(v) for v in por_region.values()) or 1
+    panel_h = 0.32 * max_centros + 0.9
+    fig, axes = graficas_utils.nueva_figura((10, panel_h * rows + 0.4), rows, cols, sharex=True)
+    axes = np.atleast_1d(axes).flatten()
+    for ax in axes[n:]:
+        ax.axis("off")
+
+    for ax, fila in zip(axes, filas_region):
+        datos = sorted(por_region[fila["region"]], key=lambda x: x[1])
+        centros = [d[0] for d in datos]
+        valores = [d[1] for d in datos]
+        ax.barh(centros, valores, color=[palette.get(c, "#4c78a8") for c in centros], height=0.65)
+        ref = fila["media_ponderada"] if fila["media_ponderada"] is not None else fila["media"]
+        ax.axvline(ref, color="#1A3A58", linestyle="--", linewidth=1.2)
+        ax.set_title(f"{fila['region']} (media pond.: {ref:.2f})", fontsize=9, fontweight="bold")
+        ax.tick_params(axis="y", labelsize=7, length=0)
+        ax.tick_params(axis="x", labelsize=7, labelbottom=True)
+        ax.grid(axis='y', alpha=0)
+        ax.set_ylim(-0.6, max_centros - 0.4)
+
+    for ax in axes[max(0, n - cols):n]:
+        ax.set_xlabel(unidad or "Valor", fontsize=8, color='#555555')
+
+    return graficas_utils.figura_a_png(fig)
+
+
+@graficas_utils.cacheada
+@graficas_utils.con_estilo
+def _plot_heatmap_cobertura(items: List[registros_utils.ItemCentro], matriz: Dict[str, Any]) -> Optional[BytesIO]:
+    """Mapa de calor centro × test (0-100 %) en una sola figura para toda la cobertura."""
+    centros = [it.centro for it in items]
+    tests = matriz.get("tests") or []
+    valores = np.array([[np.nan if v is None else v for v in fila] for fila in matriz.get("valores") or []],
+                       dtype=float).reshape(len(centros), len(tests))
+    if not centros or not tests or np.isnan(valores).all():
+        return None
+
+    fig, ax = graficas_utils.nueva_figura((max(6.0, 1.1 * len(tests) + 3.5), max(3.0, 0.38 * len(centros) + 1.4)))
+    cmap = matplotlib.colormaps["RdYlGn"].copy()
+    cmap.set_bad("#F0F2F5")
+    im = ax.imshow(np.ma.masked_invalid(valores), cmap=cmap, vmin=0, vmax=100, aspect="auto")
+
+    for i in range(len(centros)):
+        for j in range(len(tests)):
+            v = valores[i, j]
+            if np.isnan(v):
+                ax.text(j, i, "–", ha="center", va="center", fontsize=8, color="#888888")
+            else:
+                ax.text(j, i, f"{v:.0f}%", ha="center", va="center", fontsize=8, fontweight="bold",
+                        color="white" if v < 25 or v > 80 else "#333333")
+
+    ax.set_xticks(range(len(tests)))
+    ax.set_xticklabels(tests, fontsize=9, fontweight="bold")
+    ax.xaxis.tick_top()
+    ax.set_yticks(range(len(centros)))
+    ax.set_yticklabels(centros, fontsize=8)
+    ax.tick_params(length=0)
+    ax.grid(False)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    cbar = fig.colorbar(im, ax=ax, fraction=0.04, pad=0.02)
+    cbar.ax.tick_params(labelsize=7)
+    cbar.set_label("% pacientes evaluados", fontsize=8, color="#555555")
+
+    return graficas_utils.figura_a_png(fig)
 
 
 # =========================
 # PDF: HEADER / FOOTER
 # =========================
+@lru_cache(maxsize=8)
+def _tamano_imagen(ruta: str) -> Tuple[int, int]:
+    """Tamaño en píxeles de una imagen de disco (se lee una vez por proceso)."""
+    return ImageReader(ruta).getSize()
+
+
 def _draw_header_footer(canvas, doc, title: str, logo_path: Optional[Path]):
     canvas.saveState()
 
@@ -621,12 +1027,12 @@ def _draw_header_footer(canvas, doc, title: str, logo_path: Optional[Path]):
 
     if logo_path and logo_path.exists():
         try:
-            img = ImageReader(str(logo_path))
-            iw, ih = img.getSize()
+            iw, ih = _tamano_imagen(str(logo_path))
             target_h = 1.8 * cm
             target_w = target_h * (iw / ih)
-            # Dibujamos logo
-            canvas.drawImage(img, margin_x, y_header - target_h, width=target_w, height=target_h, mask="auto")
+            # Dibujamos logo por ruta: ReportLab lo registra una vez como XObject
+            # (el JPEG va tal cual) y cada página solo lo referencia
+            canvas.drawImage(str(logo_path), margin_x, y_header - target_h, width=target_w, height=target_h, mask="auto")
         except Exception:
             pass
 
@@ -673,17 +1079,8 @@ class InformeDoc(BaseDocTemplate):
 # =========================
 # PDF: GENERADOR
 # =========================
-def generar_informe_pdf(dataset: Dict[str, Any]) -> bytes:
-    meta = dataset.get("meta") or {}
-    indicadores = dataset.get("indicadores") or []
-
-    # Paleta global (colores consistentes en TODO el informe)
-    palette = _build_center_palette(indicadores)
-
-    buffer = BytesIO()
-    styles = _build_styles()
-    logo_path = _find_logo_path()
-
+def _nuevo_documento(buffer: BytesIO, logo_path: Optional[Path], title: str = DEFAULT_TITLE) -> InformeDoc:
+    """Documento A4 con cabecera/pie corporativos y márgenes estándar."""
     # Usamos las constantes definidas arriba
     frame = Frame(
         MARGIN_LEFT,
@@ -700,230 +1097,605 @@ def generar_informe_pdf(dataset: Dict[str, Any]) -> bytes:
         rightMargin=MARGIN_RIGHT,
         topMargin=MARGIN_TOP,
         bottomMargin=MARGIN_BOTTOM,
-        title=DEFAULT_TITLE,
+        title=title,
         author=DEFAULT_SUBTITLE,
     )
 
     def on_page(canvas, doc_):
-        _draw_header_footer(canvas, doc_, DEFAULT_TITLE, logo_path)
+        _draw_header_footer(canvas, doc_, title, logo_path)
 
     doc.addPageTemplates([PageTemplate(id="main", frames=[frame], onPage=on_page)])
+    return doc
 
-    story: List[Any] = []
 
-    # ---------- PORTADA "ESPECTACULAR" ----------
-    story.append(Spacer(1, 3.0 * cm))
+def _fmt_num(v: Optional[float], is_percent: bool = False) -> str:
+    """Formato español con 2 decimales ("" para NaN/None)."""
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return ""
+    txt = f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return txt + "%" if is_percent else txt
+
+
+def _imagen_ajustada(buf: BytesIO, target_w: float = 16.5 * cm, max_h: float = 18 * cm) -> RLImage:
+    """Imagen con el ancho objetivo, reducida si su alto no cabe en max_h."""
+    iw, ih = ImageReader(buf).getSize()
+    aspect = ih / float(iw) if iw else 0.5
+    if target_w * aspect > max_h:
+        target_w = max_h / aspect
+    buf.seek(0)
+    return RLImage(buf, width=target_w, height=target_w * aspect)
+
+
+def _elementos_matriz_cobertura(ind: registros_utils.Indicador, tpl: plantillas_utils.PlantillaCompilada) -> List[Any]:
+    """Indicador de cobertura centro × test: mapa de calor y tabla (% y evaluados/prevalentes)."""
+    styles = tpl.estilos
+    items = ind.items
+    matriz = ind.matriz or {}
+    tests = matriz.get("tests") or []
+
+    elementos: List[Any] = [Paragraph(ind.titulo or "Cobertura de screening", styles["H1"])]
+    meta_info = [f"<b>Categoría:</b> {ind.categoria}"] if ind.categoria else []
+    if ind.objetivo:
+        meta_info.append(f"<b>Objetivo:</b> {ind.objetivo}")
+    meta_info.append(f"<b>Tests:</b> {', '.join(tests)}")
+    elementos.append(Paragraph(" | ".join(meta_info), styles["Small"]))
+    elementos.append(Spacer(1, 10))
+
+    buf = _plot_heatmap_cobertura(items, matriz)
+    if buf is not None:
+        elementos.append(Paragraph(tpl.titulo_grafica, styles["H2"]))
+        elementos.append(_imagen_ajustada(buf))
+        elementos.append(Spacer(1, 10))
+
+    table_data = [["Centro", "Prevalentes"] + tests]
+    for it, fila_val, fila_ev in zip(items, matriz.get("valores") or [], matriz.get("evaluados") or []):
+        table_data.append(
+            [it.centro, "" if it.pacientes is None else str(it.pacientes)]
+            + ["–" if v is None else f"{_fmt_num(v, True)} ({int(e)})" for v, e in zip(fila_val, fila_ev)]
+        )
+    ancho_test = (PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT - 7.0 * cm) / max(len(tests), 1)
+    elementos.append(plantillas_utils.tabla(
+        table_data, "matriz", [5.0 * cm, 2.0 * cm] + [ancho_test] * len(tests), repeat_rows=1))
+    elementos.append(Paragraph("% de pacientes prevalentes evaluados (nº evaluados entre paréntesis).", styles["Small"]))
+    elementos.append(Spacer(1, 15))
+    return elementos
+
+
+def _elementos_cohortes(cohorte: Dict[str, Any], tpl: plantillas_utils.PlantillaCompilada) -> List[Any]:
+    """Sección de un test: matriz de transición de red (nº y % por fila) y resumen por centro."""
+    styles = tpl.estilos
+    categorias = cohorte.get("categorias") or []
+    red = cohorte.get("red") or {}
+    matriz = np.asarray(red.get("matriz") or [], dtype=float).reshape(len(categorias), len(categorias))
+    totales_fila = matriz.sum(axis=1)
+
+    elementos: List[Any] = [
+        Paragraph(f"Evolución de cohortes: {cohorte.get('test')}", styles["H1"]),
+        Paragraph(
+            f"<b>Pacientes con seguimiento:</b> {red.get('n_pacientes', 0)} | "
+            f"<b>Mejoran:</b> {red.get('mejoran', 0)} | <b>Empeoran:</b> {red.get('empeoran', 0)} | "
+            f"<b>Estables:</b> {red.get('estables', 0)}", styles["Small"]),
+        Spacer(1, 8),
+        Paragraph("Transiciones entre evaluaciones consecutivas (red)", styles["H2"]),
+    ]
+
+    # Filas: categoría de origen; columnas: categoría de destino
+    mat_data = [[Paragraph("<b>Desde / Hacia</b>", styles["Small"])]
+                + [Paragraph(f"<b>{c}</b>", styles["Small"]) for c in categorias]]
+    for i, c in enumerate(categorias):
+        fila = [Paragraph(c, styles["Small"])]
+        for j in range(len(categorias)):
+            n = matriz[i, j]
+            pct = 100.0 * n / totales_fila[i] if totales_fila[i] else None
+            fila.append(f"{int(n)}" + (f" ({_fmt_num(pct, True)})" if pct is not None else ""))
+        mat_data.append(fila)
+
+    ancho_cat = (PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT - 3.5 * cm) / max(len(categorias), 1)
+    # Diagonal (sin cambio) resaltada
+    diagonal = [("BACKGROUND", (i + 1, i + 1), (i + 1, i + 1), colors.HexColor("#FCF3CF"))
+                for i in range(len(categorias))]
+    elementos.append(plantillas_utils.tabla(
+        mat_data, "transicion", [3.5 * cm] + [ancho_cat] * len(categorias), extra=diagonal))
+    elementos.append(Paragraph(
+        "Categorías ordenadas de mejor a peor situación; la diagonal indica pacientes sin cambio.", styles["Small"]))
+    elementos.append(Spacer(1, 10))
+
+    centros = cohorte.get("centros") or []
+    if centros:
+        cen_data = [["Centro", "Nº pacientes", "Mejoran", "Empeoran", "Estables"]]
+        for c in centros:
+            cen_data.append([
+                c.get("centro", ""),
+                str(c.get("n_pacientes", 0)),
+                str(c.get("mejoran", 0)),
+                str(c.get("empeoran", 0)),
+                str(c.get("estables", 0)),
+            ])
+        elementos.append(Paragraph("Resumen por centro", styles["H2"]))
+        elementos.append(plantillas_utils.tabla(
+            cen_data, "resumen", [6.5 * cm, 2.5 * cm, 2.5 * cm, 2.5 * cm, 2.5 * cm], repeat_rows=1))
+    elementos.append(Spacer(1, 15))
+    return elementos
+
+
+# =========================
+# PDF: BLOQUES DE LA PLANTILLA
+# =========================
+def _portada_tarjeta(meta: Dict[str, Any], tpl: plantillas_utils.PlantillaCompilada,
+                     logo_path: Optional[Path]) -> List[Any]:
+    """Portada con logo grande y tarjeta de metadatos."""
+    styles = tpl.estilos
+    elementos: List[Any] = [Spacer(1, 3.0 * cm)]
     # Logo centrado y más grande
     if logo_path and logo_path.exists():
         try:
-            img = ImageReader(str(logo_path))
-            iw, ih = img.getSize()
-            max_w = 12 * cm
-            max_h = 5 * cm
-            scale = min(max_w / iw, max_h / ih)
-            w, h = iw * scale, ih * scale
-            story.append(RLImage(str(logo_path), width=w, height=h)) 
-            story.append(Spacer(1, 1.5 * cm))
+            iw, ih = _tamano_imagen(str(logo_path))
+            scale = min(12 * cm / iw, 5 * cm / ih)
+            elementos.append(RLImage(str(logo_path), width=iw * scale, height=ih * scale))
+            elementos.append(Spacer(1, 1.5 * cm))
         except Exception:
             pass
 
-    story.append(Paragraph(DEFAULT_TITLE, styles["CoverTitle"]))
-    story.append(Paragraph(DEFAULT_SUBTITLE, styles["CoverSub"]))
-    
-    story.append(Spacer(1, 1.5 * cm))
-    
-    # Caja de metadatos estilizada
+    elementos.append(Paragraph(DEFAULT_TITLE, styles["CoverTitle"]))
+    elementos.append(Paragraph(DEFAULT_SUBTITLE, styles["CoverSub"]))
+    elementos.append(Spacer(1, 1.5 * cm))
+
     periodo_txt = "-"
     if meta.get("fecha_inicio") or meta.get("fecha_fin"):
         periodo_txt = f"{meta.get('fecha_inicio') or '?'} al {meta.get('fecha_fin') or '?'}"
 
-    # Tabla decorativa para la portada
     cover_data = [
-        ["FECHA DE GENERACIÓN", meta.get('generado_en','')],
+        ["FECHA DE GENERACIÓN", meta.get('generado_en', '')],
         ["PERIODO ANALIZADO", periodo_txt],
-        ["ID TRANSACCIÓN", meta.get('id_transaccion','')],
-        ["REGISTROS PROCESADOS", str(meta.get('num_docs',0))]
+        ["ID TRANSACCIÓN", meta.get('id_transaccion', '')],
+        ["REGISTROS PROCESADOS", str(meta.get('num_docs', 0))]
     ]
-    
-    t_cover = Table(cover_data, colWidths=[6*cm, 8*cm])
-    t_cover.setStyle(TableStyle([
-        ('BACKGROUND', (0,0), (0,-1), colors.HexColor("#F2F4F4")),
-        ('TEXTCOLOR', (0,0), (0,-1), colors.HexColor("#1A3A58")),
-        ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
-        ('FONTSIZE', (0,0), (-1,-1), 10),
-        ('BOTTOMPADDING', (0,0), (-1,-1), 8),
-        ('TOPPADDING', (0,0), (-1,-1), 8),
-        ('GRID', (0,0), (-1,-1), 0.5, colors.white), 
-        ('ALIGN', (0,0), (0,-1), 'RIGHT'),
-        ('ALIGN', (1,0), (1,-1), 'LEFT'),
-        ('FONTNAME', (0,0), (0,-1), 'Helvetica-Bold'),
-    ]))
-    story.append(t_cover)
+    elementos.append(plantillas_utils.tabla(cover_data, "portada", [6 * cm, 8 * cm]))
+    return elementos
 
-    story.append(PageBreak())
 
-    # ---------- ÍNDICE ----------
-    story.append(Paragraph("Índice", styles["H1"]))
-    story.append(Spacer(1, 8))
+def _portada_clasica(meta: Dict[str, Any], tpl: plantillas_utils.PlantillaCompilada,
+                     logo_path: Optional[Path]) -> List[Any]:
+    """Portada del informe original: logo, título y metadatos en líneas."""
+    styles = tpl.estilos
+    elementos: List[Any] = [Spacer(1, 2.0 * cm)]
+    if logo_path and logo_path.exists():
+        try:
+            iw, ih = _tamano_imagen(str(logo_path))
+            scale = min(14 * cm / iw, 6 * cm / ih)
+            elementos.append(RLImage(str(logo_path), width=iw * scale, height=ih * scale))
+            elementos.append(Spacer(1, 1.2 * cm))
+        except Exception:
+            elementos.append(Paragraph("[No se pudo cargar el logo]", styles["Meta"]))
+            elementos.append(Spacer(1, 1.0 * cm))
 
-    toc = TableOfContents()
-    toc.levelStyles = [
-        ParagraphStyle(name="TOC0", fontSize=11, leftIndent=0, firstLineIndent=0, spaceAfter=6),
-    ]
-    story.append(toc)
+    elementos.append(Paragraph(DEFAULT_TITLE, styles["CoverTitle"]))
+    elementos.append(Paragraph(DEFAULT_SUBTITLE, styles["CoverSub"]))
+    elementos.append(Spacer(1, 0.6 * cm))
+
+    elementos.append(Paragraph(f"<b>Transacción:</b> {meta.get('id_transaccion', '')}", styles["Meta"]))
+    elementos.append(Paragraph(f"<b>Generado:</b> {meta.get('generado_en', '')}", styles["Meta"]))
+    if meta.get("fecha_inicio") or meta.get("fecha_fin"):
+        periodo_txt = f"Periodo: {meta.get('fecha_inicio') or '-'} → {meta.get('fecha_fin') or '-'}"
+        elementos.append(Paragraph(f"<b>{periodo_txt}</b>", styles["Meta"]))
+    elementos.append(Paragraph(f"<b>Registros base:</b> {meta.get('num_docs', 0)}", styles["Meta"]))
+    return elementos
+
+
+_PORTADAS = {"tarjeta": _portada_tarjeta, "clasica": _portada_clasica}
+
+
+def _leyenda_centros(palette: Dict[str, str], tpl: plantillas_utils.PlantillaCompilada) -> List[Any]:
+    """Leyenda global de colores por centro."""
+    styles = tpl.estilos
+    elementos: List[Any] = [Paragraph("Leyenda de centros (colores)", styles["H1"]), Spacer(1, 8)]
+    if not palette:
+        return elementos + [Paragraph("No se han detectado centros para generar paleta.", styles["Small"])]
+
+    by_label = _load_centros_catalogo().get("byLabel") or {}
+    data = [["Centro", "Región", "Color (HEX)"]]
+    for c in sorted(palette):
+        m = by_label.get(c.lower()) or {}
+        data.append([c, m.get("region") or "", palette[c]])
+    elementos.append(plantillas_utils.tabla(data, "leyenda", [8.2 * cm, 5.0 * cm, 2.3 * cm], repeat_rows=1))
+    return elementos
+
+
+def _bloque_cabecera(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    styles = ctx["tpl"].estilos
+    elementos: List[Any] = [Paragraph(ind.titulo or "Indicador", styles["H1"])]
+    meta_info = []
+    if ind.categoria: meta_info.append(f"<b>Categoría:</b> {ind.categoria}")
+    if ind.objetivo: meta_info.append(f"<b>Objetivo:</b> {ind.objetivo}")
+    if ind.unidad: meta_info.append(f"<b>Unidad:</b> {ind.unidad}")
+    if meta_info:
+        elementos.append(Paragraph(" | ".join(meta_info), styles["Small"]))
+    elementos.append(Spacer(1, 10))
+    return elementos
+
+
+def _bloque_grafica(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    tpl, est = ctx["tpl"], ctx["est"]
+    styles = tpl.estilos
+    unidad = ind.unidad
+    buf_global = _select_chart(ind.items, ind.titulo or "Indicador", unidad, ctx["palette"], est,
+                               tpl.max_centros_grafica, tpl.extremos_grafica)
+
+    if buf_global is not None:
+        try:
+            # Si es circular (donut), lo hacemos un poco más pequeño visualmente en la página
+            target_w = 12.0 * cm if _is_percent_indicator(unidad) else 16.5 * cm
+            n_centros = est["n"]
+            agrupada = bool(tpl.max_centros_grafica) and \
+                n_centros > max(tpl.max_centros_grafica, 2 * tpl.extremos_grafica + 1)
+            # Con nota al pie se reserva su alto para que quede en la misma página
+            max_h = MAX_ALTO_GRAFICA - (1.2 * cm if agrupada else 0)
+            img = _imagen_ajustada(buf_global, target_w, max_h=max_h)
+            # Tabla contenedora para centrar
+            elementos = [
+                Paragraph(tpl.titulo_grafica, styles["H2"]),
+                plantillas_utils.tabla([[img]], "centrado", [PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT]),
+            ]
+            if agrupada:
+                elementos.append(Paragraph(
+                    f"Se muestran los {tpl.extremos_grafica} centros con mayor y menor valor; los "
+                    f"{n_centros - 2 * tpl.extremos_grafica} restantes se resumen en «Otros» (mediana y rango). "
+                    f"Detalle completo en la tabla.", styles["Small"]))
+            elementos.append(Spacer(1, 10))
+            return elementos
+        except Exception:
+            return []
+
+    if est["n"] > 0 and est["min"] == 0 and est["max"] == 0:
+        return [
+            Spacer(1, 10),
+            plantillas_utils.tabla([["Los datos resultantes para este indicador son 0 (Cero)."]], "mensaje", [16 * cm]),
+            Spacer(1, 10),
+        ]
+    return [Paragraph("Datos insuficientes para generar gráfica.", styles["Small"])]
+
+
+def _bloque_tabla(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    tpl, est = ctx["tpl"], ctx["est"]
+    table_data = [list(tpl.columnas)]
+    filas_atipicas = []
+
+    for j, it in enumerate(ind.items):
+        val_raw = it.valor
+        pacs = it.pacientes
+        centro = it.centro
+        if tpl.marcar_atipicos and est["atipicos"][j]:
+            filas_atipicas.append(j + 1)
+            centro = f"{centro} *"
+        table_data.append([
+            centro,
+            "" if val_raw is None else str(val_raw),
+            "" if pacs is None else str(pacs),
+        ])
+
+    if tpl.totales:
+        # FILA DE TOTALES (media ponderada por pacientes o media simple de red)
+        is_percent = _is_percent_indicator(ind.unidad)
+        if is_percent:
+            label_total = "MEDIA PONDERADA" if est["ponderado"] else "PROMEDIO"
+            final_val = est["referencia"]
+        else:
+            label_total = "TOTAL"
+            final_val = est["suma"] if est["n"] > 0 else None
+        table_data.append([label_total, _fmt_num(final_val, is_percent), str(int(est["pacientes"] or 0))])
+
+    extra = [("TEXTCOLOR", (0, f), (-1, f), colors.HexColor("#C0392B")) for f in filas_atipicas]
+    ctx["filas_atipicas"] = filas_atipicas
+    return [Spacer(1, 5), tpl.tabla_indicador(table_data, extra)]
+
+
+def _bloque_estadisticas(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    """Resumen estadístico de red."""
+    est = ctx["est"]
+    elementos: List[Any] = []
+    if est["n"] > 1:
+        is_percent = _is_percent_indicator(ind.unidad)
+        stats_data = [
+            ["Mediana", "Q1", "Q3", "Mínimo", "Máximo", "Desv. típica"],
+            [_fmt_num(est[k], is_percent) for k in ("mediana", "q1", "q3", "min", "max")] + [_fmt_num(est["std"])],
+        ]
+        elementos.append(Spacer(1, 6))
+        elementos.append(plantillas_utils.tabla(stats_data, "estadisticas", [2.75 * cm] * 6))
+        if ctx.get("filas_atipicas"):
+            elementos.append(Paragraph(
+                "* Valor atípico respecto a la red (fuera de Q1 − 1,5·RIC / Q3 + 1,5·RIC).", ctx["tpl"].estilos["Small"]))
+    elementos.append(Spacer(1, 15))
+    return elementos
+
+
+def _bloque_regiones(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    """Comparativa por región: una figura small-multiples y tabla de medias."""
+    filas_region = estadisticas_utils.filas_rollup_indicador(ctx["rollup"], ctx["i"])
+    if len(filas_region) < 2:
+        return []
+    styles = ctx["tpl"].estilos
+    unidad = ind.unidad
+    elementos: List[Any] = [Paragraph("Comparativa por región", styles["H2"])]
+    buf_reg = _plot_comparativa_regiones(ind.items, filas_region, ind.titulo or "Indicador",
+                                         unidad, ctx["palette"])
+    if buf_reg is not None:
+        elementos.append(_imagen_ajustada(buf_reg, max_h=MAX_ALTO_GRAFICA))
+        elementos.append(Spacer(1, 8))
+
+    is_percent = _is_percent_indicator(unidad)
+    reg_data = [["Región", "Nº centros", "Media", "Media pond.", "Nº pacientes"]]
+    for f in filas_region:
+        reg_data.append([
+            f["region"],
+            str(f["n_centros"]),
+            _fmt_num(f["media"], is_percent),
+            _fmt_num(f["media_ponderada"], is_percent),
+            str(int(f["pacientes"])),
+        ])
+    elementos.append(plantillas_utils.tabla(reg_data, "resumen", [6.0 * cm, 2.3 * cm, 2.6 * cm, 2.6 * cm, 2.5 * cm],
+                                            repeat_rows=1))
+    elementos.append(Spacer(1, 15))
+    return elementos
+
+
+def _bloque_regiones_por_region(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    """Una gráfica por región con al menos dos centros (disposición del informe original)."""
+    styles = ctx["tpl"].estilos
+    titulo = ind.titulo or "Indicador"
+    region_map: Dict[str, List[registros_utils.ItemCentro]] = {}
+    for it in ind.items:
+        region_map.setdefault(it.region or estadisticas_utils.SIN_REGION, []).append(it)
+
+    elementos: List[Any] = []
+    for region in sorted(region_map, key=lambda x: (x == estadisticas_utils.SIN_REGION, x)):
+        sub_items = region_map[region]
+        if len({i.centro for i in sub_items if i.centro}) < 2:
+            continue
+        ctx["cancelacion"].comprobar(f"región {region}")
+        buf_reg = _select_chart(sub_items, f"{titulo} — {region}", ind.unidad, ctx["palette"])
+        elementos.append(Spacer(1, 8))
+        elementos.append(Paragraph(f"Comparativa por región: {region}", styles["H2"]))
+        if buf_reg is not None:
+            elementos.append(_imagen_ajustada(buf_reg, max_h=MAX_ALTO_GRAFICA))
+    return elementos
+
+
+def _bloque_nota_colores(ind: registros_utils.Indicador, ctx: Dict[str, Any]) -> List[Any]:
+    return [Spacer(1, 6), Paragraph("Colores consistentes por centro en todo el informe.", ctx["tpl"].estilos["Small"])]
+
+
+def _altura(elementos: List[Any]) -> float:
+    """Alto que ocuparán los flowables en el marco (una sola medición por flowable)."""
+    total = 0.0
+    for f in elementos:
+        _, h = f.wrap(FRAME_ANCHO, FRAME_ALTO)
+        total += h + f.getSpaceBefore() + f.getSpaceAfter()
+    return total
+
+
+def _anadir_grupo(story: List[Any], bloques: List[List[Any]], tpl: plantillas_utils.PlantillaCompilada) -> None:
+    """
+    Añade un grupo de bloques midiendo su alto antes de maquetar: si cabe en
+    una página va en un KeepTogether; si no, los bloques iniciales que caben
+    (cabecera + gráfica) van juntos y el resto fluye, partiendo las tablas
+    con la cabecera repetida (repeatRows). Así se evita que ReportLab
+    reintente el KeepTogether de una sección que nunca cabe.
+    """
+    bloques = [b for b in bloques if b]
+    if not bloques:
+        return
+    if not tpl.mantener_juntos:
+        story.extend(el for b in bloques for el in b)
+        return
+
+    altos = [_altura(b) for b in bloques]
+    if sum(altos) <= FRAME_ALTO or not tpl.partir_secciones:
+        story.append(KeepTogether([el for b in bloques for el in b]))
+        return
+
+    cabeza: List[Any] = []
+    acumulado, k = 0.0, 0
+    while k < len(bloques) and acumulado + altos[k] <= FRAME_ALTO:
+        cabeza.extend(bloques[k])
+        acumulado += altos[k]
+        k += 1
+    if cabeza:
+        story.append(KeepTogether(cabeza))
+    for b in bloques[k:]:
+        story.extend(b)
+
+
+_BLOQUES_INDICADOR = {
+    "cabecera": _bloque_cabecera,
+    "grafica": _bloque_grafica,
+    "tabla": _bloque_tabla,
+    "estadisticas": _bloque_estadisticas,
+    "regiones": _bloque_regiones,
+    "regiones_por_region": _bloque_regiones_por_region,
+    "nota_colores": _bloque_nota_colores,
+}
+
+
+def generar_informe_pdf(dataset: Dict[str, Any], ponderado: bool = True,
+                        plantilla: str = plantillas_utils.PLANTILLA_POR_DEFECTO,
+                        cancelacion: cancelacion_utils.Cancelacion = cancelacion_utils.SIN_CANCELACION) -> bytes:
+    """
+    Genera el PDF del informe.
+
+    Args:
+        dataset: Salida de recopilar_datos_informe
+        ponderado: Si True, la media de red (fila de totales y líneas de referencia)
+            se pondera por nº de pacientes; si False, media simple entre centros.
+        plantilla: Disposición del informe (plantillas_utils.PLANTILLAS)
+        cancelacion: Plazo / desconexión; se comprueba antes de cada bloque
+            (cada gráfica) y antes de maquetar
+
+    Raises:
+        KeyError: Si la plantilla no existe
+        cancelacion_utils.RenderCancelado: Si se cancela en un punto de control
+    """
+    tpl = plantillas_utils.compilar_plantilla(plantilla)
+    meta = dataset.get("meta") or {}
+    indicadores = dataset.get("indicadores") or []
+
+    # Paleta global (colores consistentes en TODO el informe)
+    palette = _build_center_palette(indicadores)
+
+    # Rollup por región: calculado una sola vez para todos los indicadores
+    rollup = dataset.get("regiones") or estadisticas_utils.calcular_rollup_regiones(indicadores)
+    # Estadísticos de red (media ponderada, cuartiles, atípicos...) en una sola pasada
+    estadisticas_red = dataset.get("estadisticas") or estadisticas_utils.calcular_estadisticas_red(indicadores)
+
+    buffer = BytesIO()
+    logo_path = _find_logo_path()
+    doc = _nuevo_documento(buffer, logo_path)
+
+    story: List[Any] = _PORTADAS[tpl.portada](meta, tpl, logo_path)
     story.append(PageBreak())
 
+    if tpl.indice:
+        story += [Paragraph("Índice", tpl.estilos["H1"]), Spacer(1, 8), plantillas_utils.indice(), PageBreak()]
+
+    if tpl.leyenda_centros:
+        story += _leyenda_centros(palette, tpl)
+        story.append(PageBreak())
+
     # ---------- SECCIONES POR INDICADOR ----------
     for i, ind in enumerate(indicadores):
-        titulo = ind.get("titulo") or "Indicador"
-        categoria = ind.get("categoria") or ""
-        objetivo = ind.get("objetivo") or ""
-        unidad = ind.get("unidad") or ""
-        items = ind.get("items") or []
+        # Cobertura centro × test: un mapa de calor en lugar de una gráfica por test
+        etapa = f"indicador {i + 1}/{len(indicadores)}"
+        if ind.matriz:
+            cancelacion.comprobar(f"{etapa} (cobertura)")
+            _anadir_grupo(story, [_elementos_matriz_cobertura(ind, tpl)], tpl)
+            continue
 
-        # Usamos una lista temporal para agrupar los elementos de este indicador
-        # e intentar mantenerlos juntos en la página.
-        indicator_elements = []
+        est = estadisticas_utils.estadisticas_indicador(estadisticas_red, i, ponderado)
+        est["centros_atipicos"] = {it.centro for it, a in zip(ind.items, est["atipicos"]) if a}
+        ctx = {"tpl": tpl, "i": i, "est": est, "palette": palette, "rollup": rollup, "cancelacion": cancelacion}
+
+        for grupo in tpl.grupos:
+            elementos_grupo = []
+            for bloque in grupo:
+                # Las gráficas ya dibujadas quedan en graficas_utils.CACHE_GRAFICAS
+                cancelacion.comprobar(f"{etapa} ({bloque})")
+                elementos_grupo.append(_BLOQUES_INDICADOR[bloque](ind, ctx))
+            _anadir_grupo(story, elementos_grupo, tpl)
+        if tpl.salto_pagina:
+            story.append(PageBreak())
+
+    # ---------- COHORTES LONGITUDINALES DE COMORBILIDAD ----------
+    for cohorte in dataset.get("cohortes") or []:
+        _anadir_grupo(story, [_elementos_cohortes(cohorte, tpl)], tpl)
+
+    cancelacion.comprobar("maquetación")
+    # IMPORTANTE: Usamos multiBuild
+    doc.multiBuild(story)
+
+    pdf_bytes = buffer.getvalue()
+    buffer.close()
+    return pdf_bytes
 
-        # 1. TÍTULO Y METADATOS
-        indicator_elements.append(Paragraph(titulo, styles["H1"]))
-        
+
+def generar_informe_tendencias_pdf(tendencias: Dict[str, Any],
+                                   cancelacion: cancelacion_utils.Cancelacion = cancelacion_utils.SIN_CANCELACION) -> bytes:
+    """Informe multi-periodo: por indicador, gráfica de evolución y tabla de deltas."""
+    meta = tendencias.get("meta") or {}
+    periodos = tendencias.get("periodos") or []
+    centros = tendencias.get("centros") or []
+    codigos = tendencias.get("indicadores") or []
+    info = tendencias.get("info") or {}
+    deltas = tendencias.get("deltas") or {}
+
+    palette = _paleta_centros(c for c in centros if c)
+
+    buffer = BytesIO()
+    styles = plantillas_utils.estilos()
+    logo_path = _find_logo_path()
+    titulo_doc = "Informe de Tendencias de Indicadores de Calidad"
+    doc = _nuevo_documento(buffer, logo_path, title=titulo_doc)
+
+    story: List[Any] = []
+    story.append(Spacer(1, 3.0 * cm))
+    story.append(Paragraph(titulo_doc, styles["CoverTitle"]))
+    story.append(Paragraph(DEFAULT_SUBTITLE, styles["CoverSub"]))
+    story.append(Spacer(1, 1.5 * cm))
+
+    periodo_txt = f"{periodos[0]} al {periodos[-1]}" if periodos else "-"
+    cover_data = [
+        ["FECHA DE GENERACIÓN", meta.get('generado_en', '')],
+        ["PERIODOS ANALIZADOS", f"{len(periodos)} ({periodo_txt})"],
+        ["TRANSACCIONES", str(meta.get('num_transacciones', 0))],
+        ["REGISTROS PROCESADOS", str(meta.get('num_docs', 0))],
+    ]
+    story.append(plantillas_utils.tabla(cover_data, "portada", [6 * cm, 8 * cm]))
+    story.append(PageBreak())
+
+    story.append(Paragraph("Índice", styles["H1"]))
+    story.append(Spacer(1, 8))
+    story.append(plantillas_utils.indice())
+    story.append(PageBreak())
+
+    if not codigos:
+        story.append(Paragraph("No se encontraron resultados para las transacciones solicitadas.", styles["Small"]))
+
+    orden = sorted(range(len(codigos)), key=lambda k: (info.get(codigos[k], {}).get("categoria", ""),
+                                                        info.get(codigos[k], {}).get("titulo", "")))
+    for n, k in enumerate(orden):
+        cancelacion.comprobar(f"indicador {n + 1}/{len(orden)}")
+        ind = info.get(codigos[k], {})
+        titulo = ind.get("titulo") or codigos[k]
+        unidad = ind.get("unidad") or ""
+        is_percent = _is_percent_indicator(unidad)
+
+        indicator_elements = [Paragraph(titulo, styles["H1"])]
         meta_info = []
-        if categoria: meta_info.append(f"<b>Categoría:</b> {categoria}")
-        if objetivo: meta_info.append(f"<b>Objetivo:</b> {objetivo}")
+        if ind.get("categoria"): meta_info.append(f"<b>Categoría:</b> {ind['categoria']}")
         if unidad: meta_info.append(f"<b>Unidad:</b> {unidad}")
-        
         if meta_info:
             indicator_elements.append(Paragraph(" | ".join(meta_info), styles["Small"]))
-        
         indicator_elements.append(Spacer(1, 10))
 
-        # 2. GENERACIÓN DE GRÁFICA (AHORA VA ANTES QUE LA TABLA)
-        valores_numeros = [it.get("valor_num") for it in items if it.get("valor_num") is not None]
-        all_zeros = (len(valores_numeros) > 0) and (sum(valores_numeros) == 0)
-        
-        buf_global = _select_chart(items, titulo, unidad, palette)
-        
-        if buf_global is not None:
-            try:
-                buf_global.seek(0)
-                img_reader = ImageReader(buf_global)
-                iw, ih = img_reader.getSize()
-                aspect = ih / float(iw) if iw else 0.5
-                
-                # Ajustamos ancho de visualización en PDF
-                target_w = 16.5 * cm
-                # Si es circular (donut), lo hacemos un poco más pequeño visualmente en la página
-                if _is_percent_indicator(unidad):
-                     target_w = 12.0 * cm # Reducción visual en página
-                     
-                target_h = target_w * aspect
-                
-                buf_global.seek(0)
-                # Centramos la imagen
-                indicator_elements.append(Paragraph("Visualización Gráfica", styles["H2"]))
-                # Tabla contenedora para centrar
-                img = RLImage(buf_global, width=target_w, height=target_h)
-                indicator_elements.append(Table([[img]], colWidths=[PAGE_WIDTH - MARGIN_LEFT - MARGIN_RIGHT], style=[('ALIGN', (0,0), (-1,-1), 'CENTER')]))
-                indicator_elements.append(Spacer(1, 10))
-            except Exception:
-                pass
+        series = tendencias_utils.series_por_indicador(tendencias, k)
+        buf = _plot_tendencia(series, periodos, deltas["media_red"][:, k], titulo, unidad, palette)
+        if buf is not None:
+            img_reader = ImageReader(buf)
+            iw, ih = img_reader.getSize()
+            aspect = ih / float(iw) if iw else 0.5
+            target_w = 16.5 * cm
+            # Los small multiples pueden ser muy altos: limitamos a la página
+            if target_w * aspect > 20 * cm:
+                target_w = 20 * cm / aspect
+            buf.seek(0)
+            indicator_elements.append(Paragraph("Evolución temporal", styles["H2"]))
+            indicator_elements.append(RLImage(buf, width=target_w, height=target_w * aspect))
+            indicator_elements.append(Spacer(1, 10))
         else:
-            if all_zeros:
-                indicator_elements.append(Spacer(1, 10))
-                t_msg = Table([["Los datos resultantes para este indicador son 0 (Cero)."]], colWidths=[16*cm])
-                t_msg.setStyle(TableStyle([
-                    ('BACKGROUND', (0,0), (-1,-1), colors.HexColor("#F0F0F0")),
-                    ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-                    ('TEXTCOLOR', (0,0), (-1,-1), colors.HexColor("#888888")),
-                    ('FONTNAME', (0,0), (-1,-1), 'Helvetica-Oblique'),
-                    ('BOX', (0,0), (-1,-1), 1, colors.HexColor("#CCCCCC")),
-                    ('TOPPADDING', (0,0), (-1,-1), 12),
-                    ('BOTTOMPADDING', (0,0), (-1,-1), 12),
-                ]))
-                indicator_elements.append(t_msg)
-                indicator_elements.append(Spacer(1, 10))
-            else:
-                indicator_elements.append(Paragraph("Datos insuficientes para generar gráfica.", styles["Small"]))
-
-        # 3. TABLA DE DATOS (AHORA VA DEBAJO DEL GRÁFICO)
-        table_data = [["Centro", "Resultado", "Nº pacientes"]] # Valor -> Resultado
-        
-        total_pacientes = 0
-        total_valor = 0.0
-        count_centros = 0
-
-        for it in items:
-            val = it.get("valor_num")
-            val_raw = it.get("valor")
-            pacs = it.get("pacientes")
-            
-            # Acumuladores
-            if pacs is not None:
-                try: 
-                    total_pacientes += int(pacs)
-                except: pass
-            
-            if val is not None:
-                total_valor += val
-                count_centros += 1
+            indicator_elements.append(Paragraph("Se necesitan al menos dos periodos para mostrar la evolución.", styles["Small"]))
 
+        # Tabla de deltas: primer valor, último valor y diferencia por centro
+        table_data = [["Centro", "Primer periodo", "Último periodo", "Δ"]]
+        for s in series:
+            j = centros.index(s["centro"])
             table_data.append([
-                it.get("centro", ""),
-                "" if val_raw is None else str(val_raw),
-                "" if pacs is None else str(pacs),
+                s["centro"],
+                _fmt_num(deltas["primero"][j, k], is_percent),
+                _fmt_num(deltas["ultimo"][j, k], is_percent),
+                _fmt_num(deltas["delta"][j, k]),
             ])
+        red = deltas["media_red"][:, k]
+        validos = red[~np.isnan(red)]
+        if len(validos):
+            table_data.append(["MEDIA RED", _fmt_num(validos[0], is_percent), _fmt_num(validos[-1], is_percent),
+                               _fmt_num(validos[-1] - validos[0])])
 
-        # FILA DE TOTALES
-        is_percent = _is_percent_indicator(unidad)
-        label_total = "PROMEDIO" if is_percent else "TOTAL"
-        
-        val_total_str = ""
-        if count_centros > 0:
-            final_val = total_valor / count_centros if is_percent else total_valor
-            # Formato simple: 2 decimales
-            val_total_str = f"{final_val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-            if is_percent: val_total_str += "%"
-
-        table_data.append([
-            label_total,
-            val_total_str,
-            str(total_pacientes)
-        ])
-        
-        # Estilo de tabla
-        tbl_style = TableStyle([
-            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2471A3")), 
-            ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-            ("FONTSIZE", (0, 0), (-1, 0), 10),
-            ("FONTSIZE", (0, 1), (-1, -1), 10),
-            ("ALIGN", (1, 1), (2, -1), "CENTER"), 
-            ("GRID", (0, 0), (-1, -1), 0.5, colors.HexColor("#D5D8DC")),
-            ("ROWBACKGROUNDS", (0, 1), (-2, -1), [colors.white, colors.HexColor("#F4F6F7")]), # Alternar hasta penultima
-            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-            ("TOPPADDING", (0, 0), (-1, -1), 6),
-            # Estilo fila TOTAL
-            ("BACKGROUND", (0, -1), (-1, -1), colors.HexColor("#D6EAF8")),
-            ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
-            ("TEXTCOLOR", (0, -1), (-1, -1), colors.HexColor("#154360")),
-            ("TOPPADDING", (0, -1), (-1, -1), 8),
-        ])
-
-        tbl = Table(table_data, colWidths=[9.5 * cm, 3.0 * cm, 3.0 * cm])
-        tbl.setStyle(tbl_style)
-        
-        indicator_elements.append(Spacer(1, 5))
+        tbl = plantillas_utils.tabla(table_data, "serie", [7.5 * cm, 3.0 * cm, 3.0 * cm, 2.5 * cm], repeat_rows=1)
         indicator_elements.append(tbl)
         indicator_elements.append(Spacer(1, 15))
 
-        # 4. AGRUPACIÓN (KeepTogether)
-        # Intentamos mantener título, gráfico y tabla juntos.
-        # KeepTogether intentará meter todo en la página actual. Si no cabe, saltará a la siguiente.
-        story.append(KeepTogether(indicator_elements))
+        story.extend(indicator_elements)
+        story.append(PageBreak())
 
-    # IMPORTANTE: Usamos multiBuild
+    cancelacion.comprobar("maquetación")
     doc.multiBuild(story)
 
     pdf_bytes = buffer.getvalue()
@@ -934,48 +1706,161 @@ def generar_informe_pdf(dataset: Dict[str, Any]) -> bytes:
 # =========================
 # CACHE PDF EN MONGO
 # =========================
-def obtener_pdf_guardado(db, id_transaccion: str) -> Optional[bytes]:
-    col = db["informes_pdf"]
-    doc = col.find_one({"id_transaccion": id_transaccion}, {"_id": 0, "pdf": 1})
-    if not doc:
+def _filtro_informe(id_transaccion: str, ponderado: bool, plantilla: str) -> Dict[str, Any]:
+    return {"id_transaccion": id_transaccion, "ponderado": ponderado, "plantilla": plantilla}
+
+
+def _doc_informe(db, id_transaccion: str, ponderado: bool, plantilla: str,
+                 proyeccion: Dict[str, int]) -> Optional[Dict[str, Any]]:
+    """
+    Entrada vigente de la caché: un PDF de otra versión de la plantilla (o
+    anterior a versionarlas) o con otras matrices de cohortes no se sirve y se
+    regenera al pedirlo; el evictor retira los que nadie vuelve a pedir.
+    """
+    filtro = {
+        **_filtro_informe(id_transaccion, ponderado, plantilla),
+        "version_plantilla": plantillas_utils.compilar_plantilla(plantilla).version,
+        "version_cohortes": cohortes_utils.version_cohortes(db),
+    }
+    return db[almacen_pdf_utils.COLECCION_INFORMES].find_one(filtro, {"_id": 0, **proyeccion})
+
+
+def abrir_pdf_guardado(db, id_transaccion: str, ponderado: bool = True,
+                       plantilla: str = plantillas_utils.PLANTILLA_POR_DEFECTO):
+    """Fichero con seek() del informe guardado (GridFS o PDF embebido antiguo), o None."""
+    doc = _doc_informe(db, id_transaccion, ponderado, plantilla, {"archivo_id": 1, "pdf": 1})
+    return almacen_pdf_utils.abrir_pdf(db, doc) if doc else None
+
+
+def obtener_pdf_guardado(db, id_transaccion: str, ponderado: bool = True,
+                         plantilla: str = plantillas_utils.PLANTILLA_POR_DEFECTO) -> Optional[bytes]:
+    fuente = abrir_pdf_guardado(db, id_transaccion, ponderado, plantilla)
+    if fuente is None:
         return None
+    try:
+        return fuente.read()
+    finally:
+        fuente.close()
 
-    pdf = doc.get("pdf")
-    if isinstance(pdf, Binary):
-        return bytes(pdf)
-    if isinstance(pdf, (bytes, bytearray)):
-        return bytes(pdf)
-    return None
 
+def obtener_metadatos_pdf(db, id_transaccion: str, ponderado: bool = True,
+                          plantilla: str = plantillas_utils.PLANTILLA_POR_DEFECTO) -> Optional[Dict[str, Any]]:
+    """
+    Huella SHA-256, tamaño y fecha de generación del informe guardado, sin
+    leer el PDF (proyección). None si no hay informe vigente en caché.
+    """
+    doc = _doc_informe(db, id_transaccion, ponderado, plantilla, {"sha256": 1, "tamano": 1, "generado_en": 1})
+    if doc is None or not doc.get("sha256") or doc.get("tamano") is None:
+        return None
+    return doc
+
+
+def guardar_pdf(db, id_transaccion: str, pdf_bytes: bytes, ponderado: bool = True,
+                plantilla: str = plantillas_utils.PLANTILLA_POR_DEFECTO,
+                version_cohortes: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Guarda el PDF en GridFS (trozos de 255 KB, legibles por rangos) y sus
+    metadatos en informes_pdf (huella, tamaño, versiones de plantilla y de
+    cohortes con que se generó y uso para el evictor); el fichero anterior,
+    si lo había, queda retirado.
+    """
+    col = db[almacen_pdf_utils.COLECCION_INFORMES]
+    filtro = _filtro_informe(id_transaccion, ponderado, plantilla)
+    meta = http_utils.metadatos_pdf(pdf_bytes)
+    uso = {
+        "version_plantilla": plantillas_utils.compilar_plantilla(plantilla).version,
+        "version_cohortes": version_cohortes,
+        "ultimo_acceso": meta["generado_en"],
+        "lecturas": 0,
+    }
+    anterior = col.find_one(filtro, {"_id": 0, "archivo_id": 1})
 
-def guardar_pdf(db, id_transaccion: str, pdf_bytes: bytes) -> None:
-    col = db["informes_pdf"]
+    nombre = f"informe_{id_transaccion}_{plantilla}{'' if ponderado else '_simple'}.pdf"
+    archivo_id = almacen_pdf_utils.subir_pdf(db, nombre, pdf_bytes, {**filtro, "sha256": meta["sha256"]})
     col.update_one(
-        {"id_transaccion": id_transaccion},
-        {"$set": {"id_transaccion": id_transaccion, "pdf": Binary(pdf_bytes)}},
+        filtro,
+        {"$set": {**filtro, **meta, **uso, "archivo_id": archivo_id}, "$unset": {"pdf": ""}},
         upsert=True
     )
+    if anterior and anterior.get("archivo_id") is not None:
+        # Se borra más tarde: puede haber descargas por rangos del fichero anterior en curso
+        almacen_pdf_utils.retirar_pdf(db, anterior["archivo_id"])
+    return meta
 
 
-def obtener_o_generar_pdf(id_transaccion: str) -> bytes:
-    db = conectar_calidad()
-
-    cached = obtener_pdf_guardado(db, id_transaccion)
+def _pdf_en_cache(db, id_transaccion: str, ponderado: bool, plantilla: str) -> Optional[bytes]:
+    cached = obtener_pdf_guardado(db, id_transaccion, ponderado, plantilla)
     if cached and cached.startswith(b"%PDF"):
+        almacen_pdf_utils.registrar_acceso(db, _filtro_informe(id_transaccion, ponderado, plantilla))
         return cached
+    return None
+
+
+def obtener_o_generar_pdf(id_transaccion: str, ponderado: bool = True,
+                          plantilla: str = plantillas_utils.PLANTILLA_POR_DEFECTO,
+                          prioridad: int = admision_utils.PRIORIDAD_INTERACTIVA,
+                          cancelacion: Optional[cancelacion_utils.Cancelacion] = None,
+                          docs: Optional[List[Dict[str, Any]]] = None) -> bytes:
+    """
+    PDF en caché o generado pasando por el control de admisión, con plazo
+    (RENDER_PLAZO_SEGUNDOS por defecto; en pregeneración, contado desde la
+    admisión) y cancelación entre etapas. Con `docs` se genera desde esos
+    resultados en lugar de leerlos de Mongo.
+
+    Raises:
+        admision_utils.ColaLlena: Si no hay turno para generarlo (-> 429)
+        cancelacion_utils.RenderCancelado: Plazo agotado o cliente desconectado
+    """
+    rechazable = prioridad != admision_utils.PRIORIDAD_PREGENERACION
+    # La pregeneración espera turno sin plazo: el de render empieza cuando se admite
+    if cancelacion is None and rechazable:
+        cancelacion = cancelacion_utils.Cancelacion()
+    db = conectar_calidad()
 
-    # Ajusta esta colección si tu backend guarda en otra:
-    col_resultados = db["resultados"]
-    dataset = recopilar_datos_informe(col_resultados, id_transaccion=id_transaccion)
+    cached = _pdf_en_cache(db, id_transaccion, ponderado, plantilla)
+    if cached:
+        return cached
 
-    pdf_bytes = generar_informe_pdf(dataset)
+    num_docs = len(docs) if docs is not None else db["resultados"].count_documents({"id_transaccion": id_transaccion})
+    coste_mb = admision_utils.estimar_memoria_mb(num_docs)
+    with ADMISION.admitir(prioridad, coste_mb, rechazable, cancelacion):
+        cancelacion = cancelacion or cancelacion_utils.Cancelacion()
+        # Otra petición del mismo informe puede haberlo generado mientras esperaba turno
+        cached = _pdf_en_cache(db, id_transaccion, ponderado, plantilla)
+        if cached:
+            return cached
+        cancelacion.comprobar("lectura")
+        dataset = obtener_dataset(id_transaccion, db, cancelacion, docs)
+        pdf_bytes = generar_informe_pdf(dataset, ponderado=ponderado, plantilla=plantilla, cancelacion=cancelacion)
 
     if pdf_bytes and pdf_bytes.startswith(b"%PDF"):
-        guardar_pdf(db, id_transaccion, pdf_bytes)
+        # Vista web rápida: la primera página se muestra antes de terminar la descarga
+        pdf_bytes = almacen_pdf_utils.linealizar_pdf(pdf_bytes)
+        # Sin la comorbilidad aún calculada no se guarda: la siguiente petición la incluirá
+        if not (dataset.get("meta") or {}).get("comorbilidad_pendiente"):
+            guardar_pdf(db, id_transaccion, pdf_bytes, ponderado, plantilla, dataset.get("version_cohortes"))
 
     return pdf_bytes
 
 
+def pregenerar_informe(id_transaccion: str, ponderado: bool, plantilla: str) -> bool:
+    """Genera y guarda el informe si aún no está en caché (True si lo ha generado)."""
+    db = conectar_calidad()
+    if obtener_metadatos_pdf(db, id_transaccion, ponderado, plantilla) is not None:
+        return False
+    if not db["resultados"].find_one({"id_transaccion": id_transaccion}, {"_id": 1}):
+        return False
+    return bool(obtener_o_generar_pdf(id_transaccion, ponderado, plantilla, admision_utils.PRIORIDAD_PREGENERACION))
+
+
+PREGENERADOR = pregeneracion_utils.Pregenerador(
+    conectar=conectar_calidad,
+    generar=pregenerar_informe,
+    ocupado=lambda: ADMISION.activos(admision_utils.PRIORIDAD_INTERACTIVA) > 0,
+    variantes=[(True, plantillas_utils.PLANTILLA_POR_DEFECTO)],
+)
+
+
 # =========================
 # API (FASTAPI)
 # =========================
@@ -985,6 +1870,58 @@ app = FastAPI(
     version="1.0.0",
 )
 
+def _asegurar_indices_tendencias() -> None:
+    # En segundo plano: con Mongo aún sin arrancar no retrasa el arranque del servicio
+    try:
+        tendencias_utils.asegurar_indices_tendencias(conectar_calidad())
+    except Exception as e:
+        print(f"⚠️ Índices de tendencias: {e}")
+
+
+@app.on_event("startup")
+def iniciar_tareas_fondo():
+    """
+    Índices de informes_pdf (TTL incluido) y evictor periódico de la caché de
+    PDF, índices de tendencias; con PREGENERAR_INFORMES=1, vigilante de
+    resultados que pregenera los informes de las transacciones nuevas.
+    """
+    almacen_pdf_utils.iniciar_evictor(conectar_calidad, plantillas_utils.versiones())
+    threading.Thread(target=_asegurar_indices_tendencias, name="indices-tendencias", daemon=True).start()
+    if pregeneracion_utils.ACTIVA:
+        PREGENERADOR.iniciar()
+
+
+@app.on_event("shutdown")
+def cerrar_mongo():
+    """Cierra el cliente compartido de MongoDB."""
+    with _MONGO_LOCK:
+        if _MONGO["cliente"] is not None:
+            _MONGO["cliente"].close()
+        _MONGO["cliente"] = _MONGO["db"] = None
+
+@app.exception_handler(admision_utils.ColaLlena)
+def cola_llena_handler(request: Request, exc: admision_utils.ColaLlena):
+    print(f"⏳ [{request.method} {request.url.path}] 429: {exc}")
+    return JSONResponse(status_code=429, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(cancelacion_utils.RenderCancelado)
+def render_cancelado_handler(request: Request, exc: cancelacion_utils.RenderCancelado):
+    print(f"🛑 [{request.method} {request.url.path}] Render cancelado: {exc}")
+    # 499: cliente desconectado (nadie leerá la respuesta); 504: plazo agotado
+    estado = 499 if exc.motivo == "Cliente desconectado" else 504
+    return JSONResponse(status_code=estado, content={"detail": str(exc)})
+
+def _cancelacion_peticion(request: Request) -> cancelacion_utils.Cancelacion:
+    """Plazo por defecto y desconexión del cliente, consultada desde el hilo del threadpool."""
+    def desconectado() -> bool:
+        try:
+            return anyio.from_thread.run(request.is_disconnected)
+        except RuntimeError:
+            # Fuera de un hilo de anyio (llamada directa): no hay cliente que vigilar
+            return False
+    return cancelacion_utils.Cancelacion(desconectado=desconectado)
+
 @app.get("/")
 def read_root():
     return {"status": "ok", "service": "calidad-python-pdf"}
@@ -997,25 +1934,307 @@ def health_check():
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Database error: {str(e)}")
 
+# Endpoints de render síncronos: corren en el threadpool y el control de
+# admisión puede hacerlos esperar sin bloquear el bucle de eventos
 @app.post("/informe")
-async def generar_informe_endpoint(id_transaccion: str = Query(..., description="UUID de la transacción")):
+def generar_informe_endpoint(
+    request: Request,
+    id_transaccion: str = Query(..., description="UUID de la transacción"),
+    ponderado: bool = Query(True, description="Media de red ponderada por nº de pacientes (False: media simple)"),
+    plantilla: str = Query(plantillas_utils.PLANTILLA_POR_DEFECTO, description="Disposición: compacta | regiones"),
+    prioridad: str = Query("interactiva", description="interactiva | lote (procesos por lotes ceden el turno)"),
+):
     """
     Genera (o recupera) el informe PDF para una transacción dada.
-    Devuelve el archivo PDF en streaming.
+    Devuelve el archivo PDF en streaming. 429 + Retry-After si la cola de
+    renders está llena; 504 si se agota el plazo de render.
     """
     if not id_transaccion:
         raise HTTPException(status_code=400, detail="Falta id_transaccion")
+    if plantilla not in plantillas_utils.PLANTILLAS:
+        raise HTTPException(status_code=400, detail=f"Plantilla no soportada: {plantilla}. "
+                                                    f"Usa una de {', '.join(plantillas_utils.PLANTILLAS)}.")
+    if prioridad not in ("interactiva", "lote"):
+        raise HTTPException(status_code=400, detail=f"Prioridad no soportada: {prioridad}. Usa interactiva o lote.")
 
     try:
-        print(f"🔹 [POST /informe] Solicitud recibida para id_transaccion={id_transaccion}")
-        pdf_bytes = obtener_o_generar_pdf(id_transaccion)
+        print(f"🔹 [POST /informe] Solicitud recibida para id_transaccion={id_transaccion} plantilla={plantilla}")
+        pdf_bytes = obtener_o_generar_pdf(id_transaccion, ponderado, plantilla, admision_utils.PRIORIDADES[prioridad],
+                                          _cancelacion_peticion(request))
 
         if not pdf_bytes:
             raise HTTPException(status_code=404, detail="No se encontraron datos para generar informe o error interno.")
 
         return Response(content=pdf_bytes, media_type="application/pdf")
 
+    except (HTTPException, admision_utils.ColaLlena, cancelacion_utils.RenderCancelado):
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error interno generando PDF: {str(e)}")
+
+@app.post("/informe/datos")
+async def generar_informe_datos_endpoint(
+    request: Request,
+    id_transaccion: str = Query(..., description="UUID de la transacción"),
+    ponderado: bool = Query(True, description="Media de red ponderada por nº de pacientes (False: media simple)"),
+    plantilla: str = Query(plantillas_utils.PLANTILLA_POR_DEFECTO, description="Disposición: compacta | regiones"),
+    prioridad: str = Query("interactiva", description="interactiva | lote (procesos por lotes ceden el turno)"),
+):
+    """
+    Como POST /informe, pero con los resultados de la transacción en el cuerpo
+    (JSON o MessagePack según Content-Type) en lugar de releerlos de Mongo:
+    {"id_transaccion": "...", "resultados": [documentos de resultado.schema.json]}.
+    Mongo solo se usa para comorbilidad/cohortes y para guardar el PDF.
+    422 si el cuerpo no cumple el esquema; 413 si supera INFORME_CUERPO_MAX_MB.
+    """
+    if plantilla not in plantillas_utils.PLANTILLAS:
+        raise HTTPException(status_code=400, detail=f"Plantilla no soportada: {plantilla}. "
+                                                    f"Usa una de {', '.join(plantillas_utils.PLANTILLAS)}.")
+    if prioridad not in ("interactiva", "lote"):
+        raise HTTPException(status_code=400, detail=f"Prioridad no soportada: {prioridad}. Usa interactiva o lote.")
+
+    cuerpo = await request.body()
+    print(f"🔹 [POST /informe/datos] id_transaccion={id_transaccion} plantilla={plantilla} "
+          f"cuerpo={len(cuerpo) / 1024:.0f} KB ({request.headers.get('content-type')})")
+    if len(cuerpo) > MAX_CUERPO_INFORME:
+        raise HTTPException(status_code=413, detail=f"Cuerpo de {len(cuerpo)} bytes; máximo {MAX_CUERPO_INFORME}.")
+    try:
+        docs = await run_in_threadpool(validacion_utils.resultados_desde_cuerpo, cuerpo,
+                                       request.headers.get("content-type"), id_transaccion)
+    except validacion_utils.CuerpoInvalido as e:
+        raise HTTPException(status_code=422, detail={"mensaje": str(e), "errores": e.errores})
+
+    try:
+        pdf_bytes = await run_in_threadpool(obtener_o_generar_pdf, id_transaccion, ponderado, plantilla,
+                                            admision_utils.PRIORIDADES[prioridad], _cancelacion_peticion(request), docs)
+        if not pdf_bytes:
+            raise HTTPException(status_code=404, detail="No se pudo generar el informe con los resultados recibidos.")
+        return Response(content=pdf_bytes, media_type="application/pdf")
+
+    except (HTTPException, admision_utils.ColaLlena, cancelacion_utils.RenderCancelado):
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error interno generando PDF: {str(e)}")
+
+@app.api_route("/informe/{id_transaccion}.pdf", methods=["GET", "HEAD"])
+def descargar_informe_endpoint(
+    request: Request,
+    id_transaccion: str,
+    ponderado: bool = Query(True, description="Media de red ponderada por nº de pacientes (False: media simple)"),
+    plantilla: str = Query(plantillas_utils.PLANTILLA_POR_DEFECTO, description="Disposición: compacta | regiones"),
+):
+    """
+    Informe PDF (linealizado) como recurso cacheable: ETag fuerte (SHA-256 del
+    PDF), Last-Modified y Cache-Control; If-None-Match / If-Modified-Since -> 304.
+    Range (con If-Range) -> 206 leyendo de GridFS solo los trozos pedidos.
+    HEAD se responde solo con los metadatos guardados (no genera ni lee el PDF).
+    Si hay que generarlo y la cola de renders está llena -> 429 + Retry-After;
+    plazo de render agotado -> 504.
+    """
+    if plantilla not in plantillas_utils.PLANTILLAS:
+        raise HTTPException(status_code=400, detail=f"Plantilla no soportada: {plantilla}. "
+                                                    f"Usa una de {', '.join(plantillas_utils.PLANTILLAS)}.")
+
+    rango_txt = request.headers.get("range")
+    print(f"🔹 [{request.method} /informe/{id_transaccion}.pdf] plantilla={plantilla} ponderado={ponderado}"
+          f"{' range=' + rango_txt if rango_txt else ''}")
+    db = conectar_calidad()
+    meta = obtener_metadatos_pdf(db, id_transaccion, ponderado, plantilla)
+    pdf_bytes = None
+    if meta is None:
+        if request.method == "HEAD":
+            raise HTTPException(status_code=404, detail="Informe no generado todavía.")
+        pdf_bytes = obtener_o_generar_pdf(id_transaccion, ponderado, plantilla,
+                                          cancelacion=_cancelacion_peticion(request))
+        if not pdf_bytes or not pdf_bytes.startswith(b"%PDF"):
+            raise HTTPException(status_code=404, detail="No se encontraron datos para generar informe.")
+        meta = http_utils.metadatos_pdf(pdf_bytes)
+
+    cabeceras = http_utils.cabeceras_validacion(meta)
+    if http_utils.no_modificado(request.headers, meta):
+        almacen_pdf_utils.registrar_acceso(db, _filtro_informe(id_transaccion, ponderado, plantilla))
+        return Response(status_code=304, headers=cabeceras)
+
+    tamano = meta["tamano"]
+    cabeceras["Content-Disposition"] = f'inline; filename="informe_{id_transaccion}.pdf"'
+    try:
+        rango = http_utils.rango_solicitado(rango_txt, tamano) if http_utils.rango_vigente(request.headers, meta) else None
+    except ValueError:
+        return Response(status_code=416, headers={**cabeceras, "Content-Range": f"bytes */{tamano}"})
+
+    inicio, fin = rango if rango else (0, tamano - 1)
+    cabeceras["Content-Length"] = str(fin - inicio + 1)
+    estado = 200
+    if rango:
+        estado = 206
+        cabeceras["Content-Range"] = f"bytes {inicio}-{fin}/{tamano}"
+    if request.method == "HEAD":
+        return Response(status_code=estado, headers=cabeceras, media_type="application/pdf")
+
+    # Recién generado: ya está en memoria; si no, se lee de GridFS por trozos
+    if pdf_bytes is not None:
+        fuente = BytesIO(pdf_bytes)
+    else:
+        fuente = abrir_pdf_guardado(db, id_transaccion, ponderado, plantilla)
+        if fuente is None:
+            raise HTTPException(status_code=404, detail="Informe no encontrado.")
+        # Un visor pide muchos rangos por lectura: solo cuenta la que empieza en 0
+        almacen_pdf_utils.registrar_acceso(db, _filtro_informe(id_transaccion, ponderado, plantilla),
+                                           contar=inicio == 0)
+    return StreamingResponse(almacen_pdf_utils.iter_rango(fuente, inicio, fin), status_code=estado,
+                             headers=cabeceras, media_type="application/pdf")
+
+
+@app.get("/admin/cache/informes")
+def ocupacion_cache_informes_endpoint(top: int = Query(10, ge=0, le=100, description="Informes más leídos a listar")):
+    """
+    Ocupación de la caché de PDF (entradas, bytes frente al presupuesto, por
+    plantilla, entradas obsoletas, más leídos y última pasada del evictor),
+    de las cachés de datasets y gráficas en memoria y de la pregeneración.
+    """
+    db = conectar_calidad()
+    return {
+        "informes_pdf": almacen_pdf_utils.ocupacion(db, plantillas_utils.versiones(), top),
+        "datasets": DATASET_CACHE.estado(),
+        "graficas": graficas_utils.CACHE_GRAFICAS.estado(),
+        "pregeneracion": PREGENERADOR.estado(),
+    }
+
+
+@app.get("/admin/renders")
+def estado_renders_endpoint():
+    """Control de admisión: renders en curso, profundidad de cola y tiempos de espera."""
+    return ADMISION.estado()
+
+
+@app.post("/admin/cache/informes/evictar")
+def evictar_cache_informes_endpoint():
+    """Ejecuta ya una pasada del evictor (versiones obsoletas, huérfanos y presupuesto)."""
+    print("🧹 [POST /admin/cache/informes/evictar]")
+    return almacen_pdf_utils.evictar(conectar_calidad(), plantillas_utils.versiones())
+
+
+@app.post("/informe/tendencias")
+def generar_informe_tendencias_endpoint(
+    request: Request,
+    id_transaccion: Optional[List[str]] = Query(None, description="Transacciones a comparar (repetible)"),
+    fecha_desde: Optional[str] = Query(None, description="Inicio mínimo del periodo (YYYY-MM-DD)"),
+    fecha_hasta: Optional[str] = Query(None, description="Fin máximo del periodo (YYYY-MM-DD)"),
+):
+    """
+    Genera un informe de tendencias multi-periodo a partir de varias transacciones
+    (lista explícita o rango de fechas sobre el periodo de la cabecera en ejecuciones).
+    """
+    if not id_transaccion and not (fecha_desde or fecha_hasta):
+        raise HTTPException(status_code=400, detail="Indica id_transaccion (uno o varios) o un rango fecha_desde/fecha_hasta")
+
+    try:
+        print(f"🔹 [POST /informe/tendencias] transacciones={id_transaccion} rango={fecha_desde}→{fecha_hasta}")
+        db = conectar_calidad()
+        try:
+            tendencias = recopilar_datos_tendencias(db, id_transaccion, fecha_desde, fecha_hasta)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Rango de fechas no válido: {e}")
+
+        if not tendencias.get("indicadores"):
+            raise HTTPException(status_code=404, detail="No se encontraron resultados para las transacciones solicitadas.")
+
+        coste_mb = admision_utils.estimar_memoria_mb(tendencias["meta"]["num_docs"])
+        cancelacion = _cancelacion_peticion(request)
+        with ADMISION.admitir(admision_utils.PRIORIDAD_INTERACTIVA, coste_mb, cancelacion=cancelacion):
+            pdf_bytes = generar_informe_tendencias_pdf(tendencias, cancelacion)
+        return Response(content=pdf_bytes, media_type="application/pdf")
+
+    except (HTTPException, admision_utils.ColaLlena, cancelacion_utils.RenderCancelado):
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error interno generando informe de tendencias: {str(e)}")
+
+
+@app.get("/informe/dataset")
+def exportar_dataset_endpoint(
+    id_transaccion: str = Query(..., description="UUID de la transacción"),
+    format: str = Query("json", description="Formato de salida: json | csv | parquet"),
+):
+    """
+    Devuelve los datos que hay detrás del informe (una fila por indicador y centro),
+    enriquecidos con metadatos de catálogo. Nunca genera gráficas ni PDF.
+    """
+    formato = (format or "").lower()
+    if formato not in exportacion_utils.FORMATOS:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado: {format}. Usa json, csv o parquet.")
+
+    print(f"🔹 [GET /informe/dataset] id_transaccion={id_transaccion} formato={formato}")
+    dataset = obtener_dataset(id_transaccion)
+    if not dataset.get("indicadores"):
+        raise HTTPException(status_code=404, detail="No se encontraron resultados para la transacción.")
+
+    palette = _build_center_palette(dataset["indicadores"])
+    filas = exportacion_utils.iter_filas_dataset(dataset, palette)
+    nombre = f"dataset_{id_transaccion}.{formato}"
+    headers = {"Content-Disposition": f'attachment; filename="{nombre}"'}
+    media_type = exportacion_utils.FORMATOS[formato]
+
+    if formato == "parquet":
+        try:
+            contenido = exportacion_utils.parquet_bytes(filas)
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Exportación Parquet no disponible (falta pyarrow).")
+        return Response(content=contenido, media_type=media_type, headers=headers)
+
+    generador = exportacion_utils.iter_csv(filas) if formato == "csv" else exportacion_utils.iter_json(filas)
+    return StreamingResponse(generador, media_type=media_type, headers=headers)
+
+
+@app.get("/comorbilidad/cohortes")
+def cohortes_endpoint(
+    test: Optional[str] = Query(None, description="Test (FRAIL, BARTHEL, ...); todos si se omite"),
+    centro: Optional[str] = Query(None, description="Centro; todos si se omite"),
+):
+    """
+    Matrices de transición entre categorías (p. ej. robusto -> prefrágil -> frágil)
+    de las cohortes longitudinales de comorbilidad, por centro y de red.
+    Solo lectura: las respuestas nuevas se procesan con POST /comorbilidad/cohortes/actualizar.
+    """
+    categorias = comorbilidad_utils.cargar_reglas().categorias
+    if test and test not in categorias:
+        raise HTTPException(status_code=400, detail=f"Test no soportado: {test}. "
+                                                    f"Usa uno de {', '.join(categorias)}.")
+
+    print(f"🔹 [GET /comorbilidad/cohortes] test={test} centro={centro}")
+    return {"tests": obtener_cohortes(conectar_calidad(), test, centro)}
+
+
+@app.post("/comorbilidad/cohortes/actualizar")
+def actualizar_cohortes_endpoint(
+    completo: bool = Query(False, description="Recalcular todos los pacientes, no solo los de respuestas nuevas"),
+):
+    """Actualiza historiales y matrices de cohortes con las respuestas nuevas."""
+    print(f"🔹 [POST /comorbilidad/cohortes/actualizar] completo={completo}")
+    return actualizar_cohortes(conectar_calidad(), completo)
+
+
+@app.get("/indicadores/{id_code}/chart-data")
+def chart_data_endpoint(
+    id_code: str,
+    id_transaccion: str = Query(..., description="UUID de la transacción"),
+):
+    """
+    Serie ordenada centro/valor, colores de la paleta del informe, unidad y tipo de
+    gráfica de un indicador, para que el dashboard la pinte en el navegador.
+    """
+    dataset = obtener_dataset(id_transaccion)
+    indicadores = dataset.get("indicadores") or []
+    ind = next((x for x in indicadores if x.id_code == id_code), None)
+    if ind is None:
+        raise HTTPException(status_code=404, detail=f"Indicador {id_code} no encontrado en la transacción.")
+
+    # Paleta global del informe: mismos colores que en el PDF
+    palette = _build_center_palette(indicadores)
+    return _serie_grafica(ind, palette)
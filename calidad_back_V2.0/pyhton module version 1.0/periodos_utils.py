@@ -0,0 +1,96 @@
+"""
+Periodo de datos de cada transacción de resultados
+
+Fuente principal: la cabecera de la colección ejecuciones
+(periodo_aplicado.desde/hasta, misma id_transaccion), que escribe
+guardarResultadosLocal.js. Si falta, el intervalo de metadata_calculo de los
+propios resultados, los campos config/payload del formato anterior y, solo
+para ordenar, creado_en. Las fechas se devuelven en ISO (YYYY-MM-DD), que
+ordena cronológicamente como texto.
+"""
+
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+COLECCION_EJECUCIONES = "ejecuciones"
+PROYECCION_EJECUCIONES = {"_id": 0, "id_transaccion": 1, "periodo_aplicado": 1}
+
+Periodo = Tuple[Optional[str], Optional[str]]
+
+
+def fecha_iso(valor: Any) -> Optional[str]:
+    """YYYY-MM-DD desde date/datetime, "YYYY-MM-DD[...]" o "DD-MM-YYYY" / "DD/MM/YYYY" (None si no es fecha)."""
+    if valor is None:
+        return None
+    if isinstance(valor, (date, datetime)):
+        return valor.strftime("%Y-%m-%d")
+    s = str(valor).strip()
+    if len(s) >= 10 and s[4] == "-" and s[7] == "-":
+        s = s[:10]
+    elif len(s) >= 10 and s[2] in "-/" and s[5] in "-/":
+        s = f"{s[6:10]}-{s[3:5]}-{s[0:2]}"
+    else:
+        return None
+    try:
+        datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        return None
+    return s
+
+
+def periodo_de_intervalo(intervalo: Any) -> Periodo:
+    """Periodo de metadata_calculo.intervalo ("inicio - fin", o "inicio,fin" si llegó como array)."""
+    if not isinstance(intervalo, str):
+        return (None, None)
+    for sep in (" - ", ","):
+        if sep in intervalo:
+            fi, ff = intervalo.split(sep, 1)
+            return (fecha_iso(fi), fecha_iso(ff))
+    return (None, None)
+
+
+def periodo_de_documentos(docs: Iterable[Dict[str, Any]]) -> Periodo:
+    """Periodo declarado en los documentos de resultados (sin cabecera en ejecuciones)."""
+    for d in docs:
+        fi, ff = periodo_de_intervalo((d.get("metadata_calculo") or {}).get("intervalo"))
+        if fi or ff:
+            return (fi, ff)
+        # Formato anterior: fechas de la consulta en config o en el payload
+        cfg = d.get("config") or {}
+        payload = d.get("payload") or {}
+        fi = fecha_iso(
+            cfg.get("fecha_inicio") or cfg.get("fechaInicio") or cfg.get("FECHAINI") or cfg.get("fechaini")
+            or payload.get("fecha_inicio") or payload.get("fechaInicio")
+        )
+        ff = fecha_iso(
+            cfg.get("fecha_fin") or cfg.get("fechaFin") or cfg.get("FECHAFIN") or cfg.get("fechafin")
+            or payload.get("fecha_fin") or payload.get("fechaFin")
+        )
+        if fi or ff:
+            return (fi, ff)
+    return (None, None)
+
+
+def fecha_creacion(docs: Iterable[Dict[str, Any]]) -> Optional[str]:
+    """creado_en más antiguo de los documentos (ISO), para ordenar transacciones sin periodo."""
+    fechas = [f for f in (fecha_iso(d.get("creado_en")) for d in docs) if f]
+    return min(fechas) if fechas else None
+
+
+def periodos_de_ejecuciones(db, filtro: Dict[str, Any]) -> Dict[str, Periodo]:
+    """Periodo (desde, hasta) por id_transaccion de las cabeceras de ejecuciones que cumplen el filtro."""
+    periodos = {}
+    for ej in db[COLECCION_EJECUCIONES].find(filtro, PROYECCION_EJECUCIONES):
+        periodo = ej.get("periodo_aplicado") or {}
+        periodos[ej.get("id_transaccion") or ""] = (fecha_iso(periodo.get("desde")), fecha_iso(periodo.get("hasta")))
+    return periodos
+
+
+
+def periodo_transaccion(db, id_transaccion: str, docs: Iterable[Dict[str, Any]] = ()) -> Periodo:
+    """Periodo de una transacción: cabecera en ejecuciones o, si no la hay, el de sus documentos."""
+    periodo = periodos_de_ejecuciones(db, {"id_transaccion": id_transaccion}).get(id_transaccion)
+    if periodo and (periodo[0] or periodo[1]):
+        return periodo
+    return periodo_de_documentos(docs)
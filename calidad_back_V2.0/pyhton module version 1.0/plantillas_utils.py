@@ -0,0 +1,357 @@
+"""
+Plantillas declarativas del informe PDF (portada, índice, leyenda, orden de
+los bloques de cada indicador y columnas de tabla), compiladas una vez por
+proceso en estilos y fábricas de tablas reutilizables
+"""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from reportlab.lib import colors
+from reportlab.lib.styles import ParagraphStyle, StyleSheet1, getSampleStyleSheet
+from reportlab.lib.units import cm
+from reportlab.platypus import Table, TableStyle
+from reportlab.platypus.tableofcontents import TableOfContents
+
+
+PLANTILLA_POR_DEFECTO = "compacta"
+
+# Subir al cambiar el dibujo del informe en main (gráficas, portada, estilos):
+# los PDF guardados con otra versión se descartan y se regeneran
+VERSION_MAQUETACION = "1"
+
+# Con más centros que MAX_CENTROS_GRAFICA la gráfica muestra los EXTREMOS_GRAFICA
+# de cada lado y agrupa el resto en "Otros" (el detalle queda en la tabla)
+MAX_CENTROS_GRAFICA = int(os.getenv("MAX_CENTROS_GRAFICA", "40"))
+EXTREMOS_GRAFICA = int(os.getenv("EXTREMOS_GRAFICA", "12"))
+
+# Cada indicador se compone de "grupos" de bloques; con mantener_juntos cada
+# grupo va en un KeepTogether (salvo que no quepa en una página y
+# partir_secciones lo permita). Bloques disponibles: cabecera, grafica, tabla,
+# estadisticas, regiones (small multiples), regiones_por_region (una gráfica
+# por región, como el informe original) y nota_colores.
+PLANTILLAS: Dict[str, Dict[str, Any]] = {
+    "compacta": {
+        "descripcion": "Una sección compacta por indicador: gráfica, tabla con totales y comparativa por región",
+        "portada": "tarjeta",
+        "indice": True,
+        "leyenda_centros": False,
+        "grupos": [["cabecera", "grafica", "tabla", "estadisticas"], ["regiones"]],
+        "mantener_juntos": True,
+        # Secciones más altas que una página: gráfica con su título y tabla paginada
+        "partir_secciones": True,
+        "salto_pagina": False,
+        "titulo_grafica": "Visualización Gráfica",
+        # max_centros None/0: una barra por centro siempre
+        "grafica": {"max_centros": MAX_CENTROS_GRAFICA, "extremos": EXTREMOS_GRAFICA},
+        "tabla": {
+            "columnas": [("Centro", 9.5), ("Resultado", 3.0), ("Nº pacientes", 3.0)],
+            "estilo": "datos",
+            "totales": True,
+            "marcar_atipicos": True,
+        },
+    },
+    "regiones": {
+        "descripcion": "Leyenda de centros, tabla antes de la gráfica y una gráfica por región; un indicador por página",
+        "portada": "clasica",
+        "indice": True,
+        "leyenda_centros": True,
+        "grupos": [["cabecera", "tabla", "grafica", "regiones_por_region", "nota_colores"]],
+        "mantener_juntos": False,
+        "salto_pagina": True,
+        "titulo_grafica": "Comparativa global",
+        "tabla": {
+            "columnas": [("Centro", 9.5), ("Valor", 3.0), ("Nº pacientes", 3.0)],
+            "estilo": "datos_simple",
+            "totales": False,
+            "marcar_atipicos": False,
+        },
+    },
+}
+
+BLOQUES = {"cabecera", "grafica", "tabla", "estadisticas", "regiones", "regiones_por_region", "nota_colores"}
+PORTADAS = {"tarjeta", "clasica"}
+
+_GRIS_REJILLA = colors.HexColor("#D5D8DC")
+_ZEBRA = [colors.white, colors.HexColor("#F4F6F7")]
+
+ESTILOS_TABLA: Dict[str, List[Tuple]] = {
+    "portada": [
+        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor("#F2F4F4")),
+        ('TEXTCOLOR', (0, 0), (0, -1), colors.HexColor("#1A3A58")),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+        ('TOPPADDING', (0, 0), (-1, -1), 8),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.white),
+        ('ALIGN', (0, 0), (0, -1), 'RIGHT'),
+        ('ALIGN', (1, 0), (1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ],
+    # Tabla de indicador con fila final de totales
+    "datos": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2471A3")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, 0), 10),
+        ("FONTSIZE", (0, 1), (-1, -1), 10),
+        ("ALIGN", (1, 1), (2, -1), "CENTER"),
+        ("GRID", (0, 0), (-1, -1), 0.5, _GRIS_REJILLA),
+        ("ROWBACKGROUNDS", (0, 1), (-2, -1), _ZEBRA),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ("TOPPADDING", (0, 0), (-1, -1), 6),
+        ("BACKGROUND", (0, -1), (-1, -1), colors.HexColor("#D6EAF8")),
+        ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+        ("TEXTCOLOR", (0, -1), (-1, -1), colors.HexColor("#154360")),
+        ("TOPPADDING", (0, -1), (-1, -1), 8),
+    ],
+    "datos_simple": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#F0F4F8")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#1f3b57")),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, 0), 10),
+        ("FONTSIZE", (0, 1), (-1, -1), 9.5),
+        ("ALIGN", (1, 1), (2, -1), "RIGHT"),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#DDDDDD")),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.whitesmoke]),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ],
+    "estadisticas": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#F2F4F4")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#1A3A58")),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+        ("GRID", (0, 0), (-1, -1), 0.5, _GRIS_REJILLA),
+    ],
+    # Tablas secundarias (regiones, cohortes por centro)
+    "resumen": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2E86C1")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9.5),
+        ("ALIGN", (1, 1), (-1, -1), "CENTER"),
+        ("GRID", (0, 0), (-1, -1), 0.5, _GRIS_REJILLA),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), _ZEBRA),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ],
+    # Series por centro (tendencias)
+    "serie": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2471A3")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9.5),
+        ("ALIGN", (1, 1), (-1, -1), "CENTER"),
+        ("GRID", (0, 0), (-1, -1), 0.5, _GRIS_REJILLA),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), _ZEBRA),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ],
+    # Matriz centro × test
+    "matriz": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#2471A3")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+        ("ALIGN", (1, 0), (-1, -1), "CENTER"),
+        ("GRID", (0, 0), (-1, -1), 0.5, _GRIS_REJILLA),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), _ZEBRA),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ],
+    # Matriz de transición origen × destino
+    "transicion": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#D6EAF8")),
+        ("BACKGROUND", (0, 1), (0, -1), colors.HexColor("#F2F4F4")),
+        ("FONTSIZE", (1, 1), (-1, -1), 8.5),
+        ("ALIGN", (1, 1), (-1, -1), "CENTER"),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("GRID", (0, 0), (-1, -1), 0.5, _GRIS_REJILLA),
+    ],
+    "leyenda": [
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1f3b57")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, 0), 10),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#DDDDDD")),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.white]),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ],
+    "mensaje": [
+        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor("#F0F0F0")),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.HexColor("#888888")),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Oblique'),
+        ('BOX', (0, 0), (-1, -1), 1, colors.HexColor("#CCCCCC")),
+        ('TOPPADDING', (0, 0), (-1, -1), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+    ],
+    "centrado": [('ALIGN', (0, 0), (-1, -1), 'CENTER')],
+}
+
+
+# =========================
+# ESTILOS (una vez por proceso)
+# =========================
+@lru_cache(maxsize=1)
+def estilos() -> StyleSheet1:
+    """Hoja de estilos de párrafo del informe (compartida: no modificar)."""
+    styles = getSampleStyleSheet()
+
+    # --- PALETA DE COLORES PDF ---
+    corp_dark = colors.HexColor("#1A3A58") # Azul oscuro corporativo
+    corp_blue = colors.HexColor("#2E86C1") # Azul medio
+    corp_gray = colors.HexColor("#5D6D7E") # Gris azulado
+
+    styles.add(ParagraphStyle(
+        name="H1",
+        parent=styles["Heading1"],
+        fontSize=12, # REDUCIDO DE 15 A 12
+        leading=15,  # Ajustado leading
+        spaceBefore=14,
+        spaceAfter=10,
+        textColor=corp_dark,
+        borderPadding=0,
+        fontName="Helvetica-Bold"
+    ))
+    styles.add(ParagraphStyle(
+        name="H2",
+        parent=styles["Heading2"],
+        fontSize=14,
+        leading=16,
+        spaceBefore=14,
+        spaceAfter=8,
+        textColor=corp_blue,
+        fontName="Helvetica-Bold"
+    ))
+    styles.add(ParagraphStyle(
+        name="Small",
+        parent=styles["Normal"],
+        fontSize=10,
+        leading=12,
+        textColor=colors.HexColor("#444444"),
+    ))
+    styles.add(ParagraphStyle(
+        name="Meta",
+        parent=styles["Normal"],
+        fontSize=11,
+        leading=14,
+        textColor=corp_gray,
+    ))
+    styles.add(ParagraphStyle(
+        name="CoverTitle",
+        parent=styles["Title"],
+        fontSize=28,
+        leading=34,
+        textColor=corp_dark,
+        spaceAfter=16,
+        fontName="Helvetica-Bold",
+        alignment=1 # Center
+    ))
+    styles.add(ParagraphStyle(
+        name="CoverSub",
+        parent=styles["Normal"],
+        fontSize=16,
+        leading=20,
+        textColor=corp_gray,
+        spaceAfter=20,
+        alignment=1 # Center
+    ))
+    styles.add(ParagraphStyle(name="TOC0", fontSize=11, leftIndent=0, firstLineIndent=0, spaceAfter=6))
+    return styles
+
+
+@lru_cache(maxsize=None)
+def estilo_tabla(nombre: str) -> TableStyle:
+    """TableStyle compilado del registro ESTILOS_TABLA (compartido: no modificar)."""
+    return TableStyle(ESTILOS_TABLA[nombre])
+
+
+def tabla(
+    datos: List[List[Any]],
+    estilo: str,
+    anchos: Optional[Sequence[float]] = None,
+    extra: Optional[List[Tuple]] = None,
+    repeat_rows: int = 0
+) -> Table:
+    """
+    Tabla con un estilo del registro más comandos propios de esta tabla
+    (p. ej. filas atípicas resaltadas), sin reconstruir el estilo base
+    """
+    t = Table(datos, colWidths=anchos, repeatRows=repeat_rows)
+    t.setStyle(estilo_tabla(estilo))
+    if extra:
+        t.setStyle(TableStyle(extra))
+    return t
+
+
+def indice() -> TableOfContents:
+    """Índice con el estilo del informe (el TableOfContents guarda estado: uno por documento)."""
+    toc = TableOfContents()
+    toc.levelStyles = [estilos()["TOC0"]]
+    return toc
+
+
+# =========================
+# PLANTILLAS COMPILADAS
+# =========================
+class PlantillaCompilada:
+    """Plantilla validada con anchos en puntos y estilos ya construidos"""
+
+    def __init__(self, nombre: str, config: Dict[str, Any]):
+        grupos = [tuple(g) for g in config.get("grupos") or []]
+        desconocidos = {b for g in grupos for b in g} - BLOQUES
+        if desconocidos:
+            raise ValueError(f"Plantilla {nombre}: bloques desconocidos {sorted(desconocidos)}")
+        if config.get("portada") not in PORTADAS:
+            raise ValueError(f"Plantilla {nombre}: portada desconocida {config.get('portada')}")
+
+        cfg_tabla = config.get("tabla") or {}
+        cfg_grafica = config.get("grafica") or {}
+        self.nombre = nombre
+        # Versión de maquetación + huella de la configuración de la plantilla
+        huella = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:8]
+        self.version = f"{VERSION_MAQUETACION}.{huella}"
+        self.descripcion = config.get("descripcion", "")
+        self.portada: str = config["portada"]
+        self.indice: bool = bool(config.get("indice", True))
+        self.leyenda_centros: bool = bool(config.get("leyenda_centros"))
+        self.grupos: Tuple[Tuple[str, ...], ...] = tuple(grupos)
+        self.mantener_juntos: bool = bool(config.get("mantener_juntos"))
+        self.partir_secciones: bool = bool(config.get("partir_secciones", True))
+        self.salto_pagina: bool = bool(config.get("salto_pagina"))
+        self.titulo_grafica: str = config.get("titulo_grafica", "Visualización Gráfica")
+        self.max_centros_grafica: Optional[int] = cfg_grafica.get("max_centros", MAX_CENTROS_GRAFICA)
+        self.extremos_grafica: int = int(cfg_grafica.get("extremos", EXTREMOS_GRAFICA))
+        self.columnas: List[str] = [c for c, _ in cfg_tabla.get("columnas", [])]
+        self.anchos: List[float] = [w * cm for _, w in cfg_tabla.get("columnas", [])]
+        self.estilo_tabla: str = cfg_tabla.get("estilo", "datos")
+        self.totales: bool = bool(cfg_tabla.get("totales"))
+        self.marcar_atipicos: bool = bool(cfg_tabla.get("marcar_atipicos"))
+        self.estilos = estilos()
+        # Fuerza la compilación de todos los estilos de tabla
+        for nombre_estilo in ESTILOS_TABLA:
+            estilo_tabla(nombre_estilo)
+
+    def tabla_indicador(self, datos: List[List[Any]], extra: Optional[List[Tuple]] = None) -> Table:
+        return tabla(datos, self.estilo_tabla, self.anchos, extra, repeat_rows=1)
+
+
+@lru_cache(maxsize=None)
+def compilar_plantilla(nombre: str = PLANTILLA_POR_DEFECTO) -> PlantillaCompilada:
+    """
+    Plantilla compilada (una vez por proceso y nombre)
+
+    Raises:
+        KeyError: Si la plantilla no existe
+    """
+    if nombre not in PLANTILLAS:
+        raise KeyError(nombre)
+    return PlantillaCompilada(nombre, PLANTILLAS[nombre])
+
+
+def versiones() -> Dict[str, str]:
+    """Versión vigente de cada plantilla ({nombre: version})."""
+    return {nombre: compilar_plantilla(nombre).version for nombre in PLANTILLAS}
@@ -0,0 +1,178 @@
+"""
+Pregeneración de informes al completarse una transacción: un vigilante de
+`resultados` (change stream o, si MongoDB no es un replica set, sondeo por
+_id) detecta las transacciones nuevas, espera a que dejen de llegar
+documentos y encola el informe con prioridad baja, de modo que el PDF ya está
+en informes_pdf cuando alguien lo descarga
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+ACTIVA = os.getenv("PREGENERAR_INFORMES", "0") == "1"
+MODO = os.getenv("PREGEN_MODO", "auto").lower()  # auto | change_stream | sondeo
+ESPERA_SEGUNDOS = float(os.getenv("PREGEN_ESPERA_SEGUNDOS", "30"))  # sin documentos nuevos = completa
+SONDEO_SEGUNDOS = float(os.getenv("PREGEN_SONDEO_SEGUNDOS", "15"))
+VENTANA_MINUTOS = float(os.getenv("PREGEN_VENTANA_MINUTOS", "60"))  # al arrancar mira hacia atrás
+CONCURRENCIA = max(1, int(os.getenv("PREGEN_CONCURRENCIA", "1")))
+PAUSA_OCUPADO = 2.0  # segundos entre comprobaciones mientras hay informes interactivos en curso
+
+
+class Pregenerador:
+    """
+    Vigilante + cola de pregeneración
+
+    Args:
+        conectar: Devuelve la base de datos de calidad
+        generar: generar(id_transaccion, ponderado, plantilla) -> True si ha
+            renderizado, False si el informe ya estaba en caché
+        ocupado: True mientras haya informes interactivos generándose; los
+            trabajos esperan a que termine (nunca compiten con un usuario)
+        variantes: (ponderado, plantilla) a pregenerar por transacción, en
+            orden de prioridad
+    """
+
+    def __init__(self, conectar: Callable[[], Any], generar: Callable[[str, bool, str], bool],
+                 ocupado: Callable[[], bool], variantes: Sequence[Tuple[bool, str]]):
+        self.conectar = conectar
+        self.generar = generar
+        self.ocupado = ocupado
+        self.variantes = list(variantes)
+        self._lock = threading.Lock()
+        self._pendientes: Dict[str, float] = {}  # id_transaccion -> último documento visto
+        self._cola: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._orden = itertools.count()
+        self._hilos: List[threading.Thread] = []
+        self.estadisticas: Dict[str, Any] = {
+            "modo": None, "detectadas": 0, "encoladas": 0, "generadas": 0,
+            "en_cache": 0, "errores": 0, "ultima": None,
+        }
+
+    # ---------- Detección ----------
+    def anotar(self, id_transaccion: Optional[str]) -> None:
+        """Llega un documento de la transacción: reinicia su espera."""
+        if not id_transaccion:
+            return
+        with self._lock:
+            if id_transaccion not in self._pendientes:
+                self.estadisticas["detectadas"] += 1
+            self._pendientes[id_transaccion] = time.monotonic()
+
+    def encolar_completas(self) -> List[str]:
+        """Encola las transacciones sin documentos nuevos desde hace ESPERA_SEGUNDOS."""
+        ahora = time.monotonic()
+        with self._lock:
+            completas = [t for t, visto in self._pendientes.items() if ahora - visto >= ESPERA_SEGUNDOS]
+            for id_transaccion in completas:
+                del self._pendientes[id_transaccion]
+        for id_transaccion in completas:
+            for prioridad, (ponderado, plantilla) in enumerate(self.variantes):
+                self._cola.put((prioridad, next(self._orden), (id_transaccion, ponderado, plantilla)))
+                self.estadisticas["encoladas"] += 1
+        return completas
+
+    def _vigilar_change_stream(self, db) -> None:
+        pipeline = [
+            {"$match": {"operationType": "insert"}},
+            {"$project": {"fullDocument.id_transaccion": 1}},
+        ]
+        reanudar = None
+        while True:
+            try:
+                with db["resultados"].watch(pipeline, resume_after=reanudar, max_await_time_ms=1000) as stream:
+                    self.estadisticas["modo"] = "change_stream"
+                    while stream.alive:
+                        cambio = stream.try_next()
+                        if cambio is not None:
+                            self.anotar((cambio.get("fullDocument") or {}).get("id_transaccion"))
+                        reanudar = stream.resume_token
+                        self.encolar_completas()
+            except OperationFailure:
+                # Sin replica set no hay change streams (p. ej. el mongo standalone de docker-compose)
+                raise
+            except PyMongoError as e:
+                print(f"⚠️ Pregeneración: change stream interrumpido ({e}); reanudando")
+                time.sleep(SONDEO_SEGUNDOS)
+
+    def _vigilar_sondeo(self, db) -> None:
+        """
+        Sondeo por _id creciente (índice por defecto): cada vuelta lee solo el
+        id_transaccion de los documentos insertados desde la anterior.
+        """
+        self.estadisticas["modo"] = "sondeo"
+        ultimo_id = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(minutes=VENTANA_MINUTOS))
+        while True:
+            try:
+                cursor = db["resultados"].find({"_id": {"$gt": ultimo_id}}, {"id_transaccion": 1}).sort("_id", 1)
+                for doc in cursor:
+                    ultimo_id = doc["_id"]
+                    self.anotar(doc.get("id_transaccion"))
+            except PyMongoError as e:
+                print(f"⚠️ Pregeneración: error sondeando resultados: {e}")
+            self.encolar_completas()
+            time.sleep(SONDEO_SEGUNDOS)
+
+    def _vigilar(self) -> None:
+        db = self.conectar()
+        if MODO != "sondeo":
+            try:
+                self._vigilar_change_stream(db)
+            except OperationFailure as e:
+                if MODO == "change_stream":
+                    print(f"❌ Pregeneración: change stream no disponible: {e}")
+                    return
+                print("ℹ️ Pregeneración: MongoDB sin change streams, se usa sondeo")
+        self._vigilar_sondeo(db)
+
+    # ---------- Generación ----------
+    def _trabajar(self) -> None:
+        while True:
+            _, _, (id_transaccion, ponderado, plantilla) = self._cola.get()
+            try:
+                while self.ocupado():
+                    time.sleep(PAUSA_OCUPADO)
+                t0 = time.perf_counter()
+                if self.generar(id_transaccion, ponderado, plantilla):
+                    self.estadisticas["generadas"] += 1
+                    print(f"📄 Pregenerado informe {id_transaccion} ({plantilla}) en {time.perf_counter() - t0:.1f}s")
+                else:
+                    self.estadisticas["en_cache"] += 1
+                self.estadisticas["ultima"] = {"id_transaccion": id_transaccion, "plantilla": plantilla,
+                                               "fecha": datetime.now(timezone.utc)}
+            except Exception as e:
+                self.estadisticas["errores"] += 1
+                print(f"⚠️ Pregeneración de {id_transaccion} ({plantilla}) fallida: {e}")
+            finally:
+                self._cola.task_done()
+
+    def iniciar(self) -> None:
+        """Arranca el vigilante y CONCURRENCIA trabajadores (hilos demonio)."""
+        if self._hilos:
+            return
+        self._hilos.append(threading.Thread(target=self._vigilar, name="pregen-vigilante", daemon=True))
+        for i in range(CONCURRENCIA):
+            self._hilos.append(threading.Thread(target=self._trabajar, name=f"pregen-{i}", daemon=True))
+        for hilo in self._hilos:
+            hilo.start()
+        print(f"🛰️ Pregeneración de informes activa (espera {ESPERA_SEGUNDOS:.0f}s, {CONCURRENCIA} hilo(s))")
+
+    def estado(self) -> Dict[str, Any]:
+        with self._lock:
+            pendientes = len(self._pendientes)
+        return {
+            "activa": bool(self._hilos),
+            "pendientes": pendientes,
+            "en_cola": self._cola.qsize(),
+            "espera_segundos": ESPERA_SEGUNDOS,
+            "concurrencia": CONCURRENCIA,
+            **self.estadisticas,
+        }
@@ -0,0 +1,116 @@
+"""
+Registros compactos del dataset de informe: cada indicador y cada valor por
+centro son objetos con __slots__ (sin diccionario por instancia) y campos ya
+normalizados en la frontera del dataset, de modo que gráficas, tablas,
+estadísticas y exportación leen atributos en lugar de .get() con valores por
+defecto
+"""
+
+from typing import Any, Dict, List, Optional, Union
+
+
+def a_numero(x: Any) -> Optional[float]:
+    """float o None (tolera texto con coma decimal)."""
+    if x is None:
+        return None
+    try:
+        if isinstance(x, str):
+            x = x.replace(",", ".").strip()
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def a_pacientes(x: Any) -> Optional[Union[int, float]]:
+    """Número de pacientes: int si es entero, float si no, None si no es numérico."""
+    n = a_numero(x)
+    if n is None or n != n:
+        return None
+    return int(n) if n.is_integer() else n
+
+
+class ItemCentro:
+    """
+    Valor de un indicador en un centro
+
+    Campos normalizados: centro es el texto ya resuelto contra el catálogo
+    (nunca None), region None si no se conoce, valor_num float o None y
+    pacientes número (a_pacientes) o None; valor se conserva tal como llegó
+    para la tabla del informe.
+    """
+
+    __slots__ = ("centro", "region", "centro_id", "valor", "valor_num", "pacientes")
+
+    def __init__(self, centro: str, region: Optional[str] = None, centro_id: Optional[str] = None,
+                 valor: Any = None, valor_num: Optional[float] = None,
+                 pacientes: Optional[Union[int, float]] = None):
+        self.centro = centro
+        self.region = region
+        self.centro_id = centro_id
+        self.valor = valor
+        self.valor_num = valor_num
+        self.pacientes = pacientes
+
+    @classmethod
+    def desde_dict(cls, d: Dict[str, Any]) -> "ItemCentro":
+        """Item en el formato dict anterior (p. ej. los de comorbilidad_utils)."""
+        valor = d.get("valor")
+        return cls(
+            centro=d.get("centro") or "",
+            region=d.get("region") or None,
+            centro_id=d.get("centro_id"),
+            valor=valor,
+            valor_num=a_numero(d.get("valor_num", valor)),
+            pacientes=a_pacientes(d.get("pacientes")),
+        )
+
+    def a_dict(self) -> Dict[str, Any]:
+        return {campo: getattr(self, campo) for campo in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"ItemCentro({self.centro!r}, valor_num={self.valor_num!r}, pacientes={self.pacientes!r})"
+
+
+class Indicador:
+    """
+    Indicador del informe con sus items por centro
+
+    matriz solo existe en indicadores centro × test (cobertura de screening):
+    {"tests", "id_codes", "titulos", "valores", "evaluados"} alineada con items.
+    """
+
+    __slots__ = ("id_code", "titulo", "categoria", "objetivo", "unidad", "items", "matriz")
+
+    def __init__(self, id_code: str = "", titulo: str = "", categoria: str = "", objetivo: str = "",
+                 unidad: str = "", items: Optional[List[ItemCentro]] = None,
+                 matriz: Optional[Dict[str, Any]] = None):
+        self.id_code = id_code
+        self.titulo = titulo
+        self.categoria = categoria
+        self.objetivo = objetivo
+        self.unidad = unidad
+        self.items: List[ItemCentro] = items if items is not None else []
+        self.matriz = matriz
+
+    @classmethod
+    def desde_dict(cls, d: Dict[str, Any]) -> "Indicador":
+        """Indicador en el formato dict anterior; los items se convierten también."""
+        return cls(
+            id_code=d.get("id_code") or "",
+            titulo=d.get("titulo") or "",
+            categoria=d.get("categoria") or "",
+            objetivo=d.get("objetivo") or "",
+            unidad=d.get("unidad") or "",
+            items=[ItemCentro.desde_dict(it) for it in d.get("items") or []],
+            matriz=d.get("matriz") or None,
+        )
+
+    def a_dict(self) -> Dict[str, Any]:
+        d = {campo: getattr(self, campo) for campo in self.__slots__}
+        d["items"] = [it.a_dict() for it in self.items]
+        if d["matriz"] is None:
+            del d["matriz"]
+        return d
+
+    def __repr__(self) -> str:
+        return f"Indicador({self.id_code!r}, {self.titulo!r}, {len(self.items)} items)"
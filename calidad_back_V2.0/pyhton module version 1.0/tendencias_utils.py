@@ -0,0 +1,172 @@
+"""
+Utilidades para construir informes de tendencia multi-periodo
+a partir de varias transacciones de resultados en MongoDB
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from periodos_utils import COLECCION_EJECUCIONES
+
+
+# Campos necesarios para el cubo (evita traer metadata_calculo, SQL, etc.)
+PROYECCION_TENDENCIAS = {
+    "_id": 0,
+    "id_transaccion": 1,
+    "metadata_calculo.intervalo": 1,
+    "creado_en": 1,
+    "base": 1,
+    "indice": 1,
+    "payload.resultado": 1,
+    "payload.valor": 1,
+    "payload.numero_pacientes": 1,
+    "payload.pacientes": 1,
+    "payload.unidad": 1,
+    "unidad": 1,
+    "categoria": 1,
+    "indicador": 1,
+    "id_code": 1,
+}
+
+
+def asegurar_indices_tendencias(db) -> None:
+    """Crea (si no existen) los índices que usa la consulta de tendencias (una vez, al arrancar)."""
+    db["resultados"].create_index("id_transaccion")
+    db[COLECCION_EJECUCIONES].create_index("id_transaccion")
+    db[COLECCION_EJECUCIONES].create_index([("periodo_aplicado.desde", 1), ("periodo_aplicado.hasta", 1)])
+
+
+def _dia(fecha_iso: str) -> datetime:
+    return datetime.strptime(fecha_iso[:10], "%Y-%m-%d")
+
+
+def construir_filtro_tendencias(
+    ids_transaccion: Optional[Sequence[str]] = None,
+    fecha_desde: Optional[str] = None,
+    fecha_hasta: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Construye el filtro de las cabeceras de ejecuciones de las tendencias
+
+    Args:
+        ids_transaccion: Lista explícita de transacciones
+        fecha_desde: Inicio mínimo del periodo (periodo_aplicado.desde, ISO)
+        fecha_hasta: Fin máximo del periodo (periodo_aplicado.hasta, ISO)
+
+    Returns:
+        Filtro MongoDB sobre la colección ejecuciones
+
+    Raises:
+        ValueError: Sin transacciones ni rango, o con una fecha no ISO
+    """
+    ids = [i for i in (ids_transaccion or []) if i]
+    if ids:
+        return {"id_transaccion": {"$in": ids}}
+
+    filtro: Dict[str, Any] = {}
+    if fecha_desde:
+        filtro["periodo_aplicado.desde"] = {"$gte": _dia(fecha_desde)}
+    if fecha_hasta:
+        # Hasta el final del día (las fechas se guardan a las 00:00 UTC)
+        filtro["periodo_aplicado.hasta"] = {"$lt": _dia(fecha_hasta) + timedelta(days=1)}
+    if not filtro:
+        raise ValueError("Se requiere una lista de transacciones o un rango de fechas")
+    return filtro
+
+
+def construir_cubo_tendencias(
+    periodos: Sequence[str],
+    centros: Sequence[str],
+    indicadores: Sequence[str],
+    valores: Sequence[Optional[float]],
+    orden_periodos: Optional[Sequence[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Construye el cubo (periodo × centro × indicador) de forma vectorizada
+
+    Las cuatro secuencias son columnas alineadas (una fila por resultado).
+    Si hay varias filas para la misma celda se promedian. Los periodos se
+    ordenan según orden_periodos (cronológico) o, sin él, como texto.
+
+    Returns:
+        Dict con ejes ordenados ("periodos", "centros", "indicadores")
+        y el array "valores" (NaN donde no hay dato)
+    """
+    v = np.asarray([np.nan if x is None else x for x in valores], dtype=float)
+    per_ejes, per_idx = np.unique(np.asarray(periodos, dtype=object).astype(str), return_inverse=True)
+    if orden_periodos is not None:
+        posicion = {p: i for i, p in enumerate(orden_periodos)}
+        perm = np.argsort([posicion.get(p, len(posicion)) for p in per_ejes], kind="stable")
+        per_ejes, per_idx = per_ejes[perm], np.argsort(perm)[per_idx]
+    cen_ejes, cen_idx = np.unique(np.asarray(centros, dtype=object).astype(str), return_inverse=True)
+    ind_ejes, ind_idx = np.unique(np.asarray(indicadores, dtype=object).astype(str), return_inverse=True)
+
+    forma = (len(per_ejes), len(cen_ejes), len(ind_ejes))
+    suma = np.zeros(forma, dtype=float)
+    cuenta = np.zeros(forma, dtype=np.int32)
+
+    validos = ~np.isnan(v)
+    celdas = (per_idx[validos], cen_idx[validos], ind_idx[validos])
+    np.add.at(suma, celdas, v[validos])
+    np.add.at(cuenta, celdas, 1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cubo = np.where(cuenta > 0, suma / np.maximum(cuenta, 1), np.nan)
+
+    return {
+        "periodos": per_ejes.tolist(),
+        "centros": cen_ejes.tolist(),
+        "indicadores": ind_ejes.tolist(),
+        "valores": cubo,
+    }
+
+
+def calcular_deltas(cubo: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Calcula, por centro e indicador, el primer y último valor disponible
+    y su diferencia, además de la media de red por periodo
+
+    Args:
+        cubo: Array (periodo × centro × indicador)
+
+    Returns:
+        Dict con arrays "primero", "ultimo", "delta" (centro × indicador)
+        y "media_red" (periodo × indicador)
+    """
+    n_per = cubo.shape[0]
+    presentes = ~np.isnan(cubo)
+    hay_dato = presentes.any(axis=0)
+
+    # Índice del primer / último periodo con dato (por celda centro × indicador)
+    idx_primero = np.argmax(presentes, axis=0)
+    idx_ultimo = n_per - 1 - np.argmax(presentes[::-1], axis=0)
+
+    primero = np.take_along_axis(cubo, idx_primero[np.newaxis], axis=0)[0]
+    ultimo = np.take_along_axis(cubo, idx_ultimo[np.newaxis], axis=0)[0]
+    primero = np.where(hay_dato, primero, np.nan)
+    ultimo = np.where(hay_dato, ultimo, np.nan)
+
+    with np.errstate(invalid="ignore"):
+        cuenta = presentes.sum(axis=1)
+        media_red = np.where(cuenta > 0, np.nansum(cubo, axis=1) / np.maximum(cuenta, 1), np.nan)
+
+    return {
+        "primero": primero,
+        "ultimo": ultimo,
+        "delta": ultimo - primero,
+        "media_red": media_red,
+    }
+
+
+def series_por_indicador(tendencias: Dict[str, Any], idx_indicador: int) -> List[Dict[str, Any]]:
+    """Devuelve las series (una por centro con datos) de un indicador del cubo."""
+    cubo = tendencias["valores"]
+    series = []
+    for j, centro in enumerate(tendencias["centros"]):
+        fila = cubo[:, j, idx_indicador]
+        if np.isnan(fila).all():
+            continue
+        series.append({"centro": centro, "valores": fila})
+    return series
@@ -0,0 +1,149 @@
+"""
+Resultados de una transacción recibidos en el cuerpo de la petición (JSON o
+MessagePack) y validados contra resultado.schema.json, el $jsonSchema de la
+colección resultados: el informe se genera sin volver a leerlos de Mongo
+"""
+
+import json
+import re
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from bson import ObjectId
+
+
+# Copia de calidad_back_V2.0/controllers/db/schemas/resultado.schema.json
+# (el contenedor de Python solo ve este directorio): mantenerlas iguales
+RESULTADO_SCHEMA_JSON = Path(__file__).resolve().parent / "resultado.schema.json"
+
+TIPOS_MSGPACK = {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+MAX_ERRORES = 20
+
+_OBJECT_ID = re.compile(r"^[0-9a-fA-F]{24}$")
+
+
+class CuerpoInvalido(ValueError):
+    """Cuerpo ilegible o documentos que no cumplen el esquema (-> 422)."""
+
+    def __init__(self, mensaje: str, errores: Optional[List[str]] = None):
+        super().__init__(mensaje)
+        self.errores = errores or []
+
+
+def _es_numero(v: Any) -> bool:
+    return isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)
+
+
+def _es_fecha(v: Any) -> bool:
+    # JSON no tiene fechas: se aceptan también en ISO 8601 (Date de Node serializado)
+    if isinstance(v, datetime):
+        return True
+    if isinstance(v, str):
+        try:
+            datetime.fromisoformat(v.replace("Z", "+00:00"))
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+# bsonType -> comprobación sobre el valor ya decodificado
+_BSON_TYPES: Dict[str, Callable[[Any], bool]] = {
+    "string": lambda v: isinstance(v, str),
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "bool": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+    "int": lambda v: isinstance(v, int) and not isinstance(v, bool) and -2 ** 31 <= v < 2 ** 31,
+    "long": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "double": _es_numero,  # un 5.0 de JS llega como 5 en JSON
+    "decimal": _es_numero,
+    "date": _es_fecha,
+    "objectId": lambda v: isinstance(v, ObjectId) or (isinstance(v, str) and bool(_OBJECT_ID.match(v))),
+}
+
+
+@lru_cache(maxsize=None)
+def esquema(ruta: Path = RESULTADO_SCHEMA_JSON) -> Dict[str, Any]:
+    return json.loads(ruta.read_text(encoding="utf-8"))
+
+
+def validar(valor: Any, regla: Dict[str, Any], ruta: str = "$") -> List[str]:
+    """
+    Errores de `valor` frente a una regla $jsonSchema (subconjunto usado en
+    los esquemas del proyecto: bsonType, required, properties y
+    additionalProperties). Lista vacía si es válido.
+    """
+    tipos = regla.get("bsonType")
+    if tipos is not None:
+        tipos = [tipos] if isinstance(tipos, str) else tipos
+        if not any(_BSON_TYPES.get(t, lambda v: False)(valor) for t in tipos):
+            return [f"{ruta}: se esperaba {'|'.join(tipos)}, llegó {type(valor).__name__}"]
+
+    if not isinstance(valor, dict):
+        return []
+    errores = [f"{ruta}.{campo}: obligatorio" for campo in regla.get("required", []) if campo not in valor]
+    propiedades = regla.get("properties") or {}
+    for campo, v in valor.items():
+        if campo in propiedades:
+            errores += validar(v, propiedades[campo], f"{ruta}.{campo}")
+        elif regla.get("additionalProperties") is False:
+            errores.append(f"{ruta}.{campo}: campo no permitido")
+    return errores
+
+
+def decodificar_cuerpo(cuerpo: bytes, content_type: Optional[str]) -> Any:
+    """
+    JSON o MessagePack según Content-Type.
+
+    Raises:
+        CuerpoInvalido: Si no se puede decodificar (o falta msgpack)
+    """
+    tipo = (content_type or "application/json").split(";")[0].strip().lower()
+    try:
+        if tipo in TIPOS_MSGPACK:
+            try:
+                import msgpack
+            except ImportError:
+                raise CuerpoInvalido("MessagePack no disponible en el servidor (falta msgpack); envía JSON")
+            # timestamp=3: las fechas (extensión timestamp) llegan como datetime
+            return msgpack.unpackb(cuerpo, raw=False, timestamp=3)
+        return json.loads(cuerpo)
+    except CuerpoInvalido:
+        raise
+    except Exception as e:
+        raise CuerpoInvalido(f"Cuerpo {tipo} ilegible: {e}")
+
+
+def resultados_desde_cuerpo(cuerpo: bytes, content_type: Optional[str], id_transaccion: str) -> List[Dict[str, Any]]:
+    """
+    Documentos de `resultados` de la transacción enviados en el cuerpo:
+    {"id_transaccion": "...", "resultados": [ {documento}, ... ]}
+
+    Raises:
+        CuerpoInvalido: Cuerpo ilegible, sin resultados, de otra transacción o
+            con documentos que no cumplen resultado.schema.json
+    """
+    datos = decodificar_cuerpo(cuerpo, content_type)
+    if not isinstance(datos, dict) or not isinstance(datos.get("resultados"), list):
+        raise CuerpoInvalido('Se esperaba {"id_transaccion": ..., "resultados": [...]}')
+    if datos.get("id_transaccion") not in (None, id_transaccion):
+        raise CuerpoInvalido(f"El cuerpo es de la transacción {datos['id_transaccion']}, no de {id_transaccion}")
+    docs = datos["resultados"]
+    if not docs:
+        raise CuerpoInvalido("Sin resultados en el cuerpo")
+
+    regla = esquema()
+    errores: List[str] = []
+    for i, doc in enumerate(docs):
+        errores += validar(doc, regla, f"resultados[{i}]")
+        if isinstance(doc, dict) and doc.get("id_transaccion") not in (None, id_transaccion):
+            errores.append(f"resultados[{i}].id_transaccion: distinto de {id_transaccion}")
+        if len(errores) >= MAX_ERRORES:
+            break
+    if errores:
+        raise CuerpoInvalido(f"Resultados no válidos frente a {RESULTADO_SCHEMA_JSON.name}", errores[:MAX_ERRORES])
+    return docs